@@ -0,0 +1,73 @@
+"""Rate-limiter throughput and memory with a million distinct users
+
+    python bench/rate_limiter.py [users]
+
+Compares RateLimiter with the list-of-datetimes check the bot used before
+(rebuilt inline below), each user searching twice, and reports checks per
+second, bytes per tracked user and how long a sweep of expired keys takes.
+"""
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dummypawn
+
+def old_limiter():
+    """The original check: a list of datetimes per user, filtered on every call"""
+    user_rate_limits = {}
+
+    def hit(user_id: int, chat_id: int = 0) -> bool:
+        now = datetime.now()
+        hits = [t for t in user_rate_limits.get(user_id, []) if now - t < timedelta(minutes=1)]
+        user_rate_limits[user_id] = hits
+        if len(hits) >= 3:
+            return False
+        hits.append(now)
+        return True
+
+    return hit
+
+def throughput(hit, users: int) -> float:
+    started = time.perf_counter()
+    for _ in range(2):
+        for user_id in range(users):
+            # Own chat per user, so no scope rejects and every check records
+            hit(user_id, user_id)
+    return 2 * users / (time.perf_counter() - started)
+
+def bytes_per_user(hit, users: int) -> float:
+    tracemalloc.start()
+    try:
+        for user_id in range(users):
+            hit(user_id)
+        return tracemalloc.get_traced_memory()[0] / users
+    finally:
+        tracemalloc.stop()
+
+def main(users: int):
+    candidates = (
+        ("old list-of-datetimes", old_limiter),
+        ("user scope", lambda: dummypawn.RateLimiter("3/60", "", "").hit),
+        ("user+chat", lambda: dummypawn.RateLimiter("3/60", "20/60", "").hit),
+    )
+    for name, make in candidates:
+        print(f"{name:22} {throughput(make(), users):>12,.0f} checks/s")
+    for name, make in candidates[:2]:
+        print(f"{name:22} {bytes_per_user(make(), users):>12.0f} B/user")
+
+    limiter = dummypawn.RateLimiter("3/60", "", "")
+    for user_id in range(users):
+        limiter.hit(user_id)
+    scope = limiter.scopes[0][1]
+    started = time.perf_counter()
+    removed = scope.sweep(time.monotonic() + scope.window + 1)
+    print(f"sweep removed {removed:,} expired users in {time.perf_counter() - started:.3f}s")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,65 @@
+"""Per-call vs pooled Serper sessions against a local fake Serper server
+
+    python bench/serper_pool.py [queries] [concurrency]
+
+"per-call" opens a ClientSession for every request, as the bot did before
+the shared pool; "pooled" goes through query_serper() and its long-lived
+session. Reports milliseconds per query.
+"""
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+from aiohttp import web
+
+import dummypawn
+
+PAYLOAD = {"organic": [{"title": "title", "link": "https://example.com", "snippet": "snippet"}] * 10}
+
+async def fake_search(request: web.Request) -> web.Response:
+    await request.read()
+    return web.json_response(PAYLOAD)
+
+async def per_call(url: str):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json={"q": "x"}) as resp:
+            return await resp.json()
+
+async def pooled(url: str):
+    return await dummypawn.query_serper("web", "x")
+
+async def measure(fn, url: str, queries: int, concurrency: int) -> float:
+    started = time.perf_counter()
+    for _ in range(0, queries, concurrency):
+        await asyncio.gather(*(fn(url) for _ in range(concurrency)))
+    return (time.perf_counter() - started) / queries * 1e3
+
+async def main(queries: int, concurrency: int):
+    app = web.Application()
+    app.router.add_post("/search", fake_search)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/search"
+    dummypawn.SERPER_URLS["web"] = url
+    try:
+        # Warm both paths so the first connection setup is not counted
+        await per_call(url)
+        await pooled(url)
+        for name, fn in (("per-call", per_call), ("pooled", pooled)):
+            print(f"{name:9} {await measure(fn, url, queries, concurrency):.3f} ms/query")
+    finally:
+        await dummypawn.close_serper_session()
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*(args + [500, 50][len(args):])))
@@ -0,0 +1,83 @@
+"""Update throughput of the multi-process worker mode
+
+    python bench/workers.py [workers] [updates]
+
+Starts a WorkerPool of this script, routes /help updates from distinct chats
+through it and reports updates per second once every worker has exited.
+Telegram is replaced in the workers by a stand-in that burns 2 ms of CPU per
+API call, standing in for rendering and serialization. Compare runs with 1
+and N workers on a host with at least N free cores; on fewer cores the extra
+processes only compete for the same CPU.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Only the CPU stand-in should limit throughput, not the flood limits
+os.environ.setdefault("SEND_GLOBAL_RATE", "1e9")
+os.environ.setdefault("SEND_PRIVATE_RATE", "1e9")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dummypawn
+from aiogram import types
+
+CPU_PER_CALL = 0.002
+
+def help_update(update_id: int) -> dict:
+    chat_id = 1000 + update_id
+    # Dated now, or the backlog gate would skip them as stale
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": "/help",
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": 5}]
+        }
+    }
+
+def run_worker():
+    handled = 0
+
+    async def make_request(bot, method, timeout=None):
+        nonlocal handled
+        end = time.perf_counter() + CPU_PER_CALL
+        while time.perf_counter() < end:
+            pass
+        handled += 1
+        return types.Message(message_id=1, date=datetime.now(), chat=types.Chat(id=1, type="private"))
+
+    dummypawn.bot.session.make_request = make_request
+    asyncio.run(dummypawn.main())
+    print(f"worker {dummypawn.WORKER_INDEX} handled {handled}", file=sys.stderr)
+
+async def run_supervisor(workers: int, updates: int):
+    pool = dummypawn.WorkerPool(workers)
+    pool.start()
+    # Let every worker finish importing before the clock starts
+    await asyncio.sleep(4)
+    # Arrives as one getUpdates reply, split the way poll_for_workers() does
+    body = json.dumps({"ok": True, "result": [help_update(i) for i in range(updates)]}, separators=(",", ":"))
+    started = time.perf_counter()
+    for update, raw in dummypawn.split_updates(body.encode()):
+        await pool.dispatch(update, raw)
+    # Workers drain what they were sent before exiting
+    await pool.stop()
+    elapsed = time.perf_counter() - started
+    print(f"workers={workers} updates={updates} {elapsed:.2f}s {updates / elapsed:.0f} updates/s "
+          f"on {os.cpu_count()} cores")
+
+if __name__ == "__main__":
+    if dummypawn.WORKER_INDEX >= 0:
+        run_worker()
+    else:
+        workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+        updates = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+        # Workers are started as `python <argv>`; they must not see the counts
+        del sys.argv[1:]
+        asyncio.run(run_supervisor(workers, updates))
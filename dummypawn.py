@@ -1,21 +1,45 @@
+import abc
 import aiohttp
+import atexit
+import hashlib
+import heapq
+import html
+import itertools
+import json
 import logging
+import logging.handlers
 import asyncio
+import base64
+import binascii
+import contextlib
+import contextvars
 import os
+import queue
 import random
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, Router, types
+import signal
+import sqlite3
+import struct
+import sys
+import time
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode, ChatType
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, CallbackQuery
 from aiogram.filters import Command
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 from colorama import init, Fore
 
-init(autoreset=True)
+# Startup timings are measured from here
+PROCESS_STARTED = time.monotonic()
 
-# Imports for Dummy HTTP Server
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+init(autoreset=True)
 
 # Configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "BOT_TOKEN")
@@ -24,6 +48,24 @@ UPDATES_CHANNEL = "https://t.me/WorkGlows"
 SUPPORT_GROUP = "https://t.me/SoulMeetsHQ"
 BOT_USERNAME = "DummyPawnBot"
 
+# HTTP server / update delivery. Setting WEBHOOK_URL (public base URL)
+# switches from long polling to webhook mode.
+PORT = int(os.getenv("PORT", "8000"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Multi-process mode: WORKERS > 1 runs a supervisor that owns the webhook or
+# polling connection and hands each update to one of WORKERS processes by
+# chat id, so a chat's sessions always live in the same worker. Workers serve
+# their own metrics on 127.0.0.1:PORT+1+index. Per-user and global search
+# limits only hold across workers with REDIS_URL. This can only add throughput
+# when handlers are CPU-bound and the host has a free core per worker; on
+# fewer cores it is slower. Measure with bench/workers.py before enabling it.
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Set by the supervisor for the processes it starts
+WORKER_INDEX = int(os.getenv("DUMMYPAWN_WORKER_INDEX", "-1"))
+
 # Random Images for Start Command
 IMAGES = [
     "https://ik.imagekit.io/asadofc/Images1.png",
@@ -75,6 +117,161 @@ SERPER_URLS = {
     "vid": "https://google.serper.dev/videos"
 }
 
+# Serper HTTP client tuning (one pooled session shared for the bot's lifetime)
+SERPER_POOL_SIZE = int(os.getenv("SERPER_POOL_SIZE", "20"))
+SERPER_KEEPALIVE = float(os.getenv("SERPER_KEEPALIVE", "30"))
+SERPER_DNS_TTL = int(os.getenv("SERPER_DNS_TTL", "300"))
+SERPER_CONNECT_TIMEOUT = float(os.getenv("SERPER_CONNECT_TIMEOUT", "3"))
+SERPER_READ_TIMEOUT = float(os.getenv("SERPER_READ_TIMEOUT", "8"))
+SERPER_TOTAL_TIMEOUT = float(os.getenv("SERPER_TOTAL_TIMEOUT", "10"))
+
+# Serper resilience: retries with jittered exponential backoff, a circuit
+# breaker that fails fast during outages, and optional hedged requests
+# (a second call after the observed p95 latency; costs extra credits)
+SERPER_MAX_RETRIES = int(os.getenv("SERPER_MAX_RETRIES", "2"))
+SERPER_BACKOFF_BASE = float(os.getenv("SERPER_BACKOFF_BASE", "0.2"))
+# Longest backoff; a Retry-After above it fails the search instead of waiting
+SERPER_BACKOFF_MAX = float(os.getenv("SERPER_BACKOFF_MAX", "2"))
+SERPER_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+SERPER_BREAKER_THRESHOLD = int(os.getenv("SERPER_BREAKER_THRESHOLD", "5"))
+SERPER_BREAKER_COOLDOWN = float(os.getenv("SERPER_BREAKER_COOLDOWN", "30"))
+SERPER_HEDGE = os.getenv("SERPER_HEDGE", "0") == "1"
+SERPER_HEDGE_MIN_DELAY = float(os.getenv("SERPER_HEDGE_MIN_DELAY", "0.3"))
+SERPER_HEDGE_MIN_SAMPLES = 20
+
+# Shared query-result cache (seconds per mode, entries overall)
+QUERY_CACHE_TTLS = {
+    "web": float(os.getenv("QUERY_CACHE_TTL_WEB", "900")),
+    "img": float(os.getenv("QUERY_CACHE_TTL_IMG", "3600")),
+    "vid": float(os.getenv("QUERY_CACHE_TTL_VID", "1800")),
+    "news": float(os.getenv("QUERY_CACHE_TTL_NEWS", "120"))
+}
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "512"))
+
+# Result paging: results per Serper page, pages per session, and how close
+# to the end of loaded results the next page is prefetched
+SERPER_PAGE_SIZE = int(os.getenv("SERPER_PAGE_SIZE", "10"))
+SERPER_MAX_PAGES = int(os.getenv("SERPER_MAX_PAGES", "5"))
+PREFETCH_DISTANCE = int(os.getenv("PREFETCH_DISTANCE", "3"))
+# Pictures per album view; Telegram media groups hold 2-10
+ALBUM_SIZE = min(10, max(2, int(os.getenv("ALBUM_SIZE", "10"))))
+# "all" searches query every mode at once; modes still running this many
+# seconds in are dropped from the merged session
+ALL_SEARCH_MODES = ("web", "img", "vid", "news")
+ALL_SEARCH_DEADLINE = float(os.getenv("ALL_SEARCH_DEADLINE", "4"))
+# Inline queries shorter than this are answered empty, so half-typed queries
+# spend neither Serper credits nor rate limit; Telegram caches that answer
+# for INLINE_EMPTY_CACHE_TIME seconds
+INLINE_MIN_QUERY_LENGTH = int(os.getenv("INLINE_MIN_QUERY_LENGTH", "3"))
+INLINE_EMPTY_CACHE_TIME = int(os.getenv("INLINE_EMPTY_CACHE_TIME", "3600"))
+# Next/Previous taps on one session within this many seconds (or while an
+# edit is in flight) become a single edit to the final position
+PAGE_EDIT_DEBOUNCE = float(os.getenv("PAGE_EDIT_DEBOUNCE", "0.2"))
+
+# Per-user search sessions (Next/Previous state)
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "5000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+
+# Telegram file_id cache for photos sent by URL. FILE_ID_CACHE_PATH (JSON)
+# keeps it across restarts; FILE_ID_WARMUP_CHAT_ID is a chat (e.g. a private
+# channel) the start images are uploaded to at boot.
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "2048"))
+FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", "")
+FILE_ID_WARMUP_CHAT_ID = os.getenv("FILE_ID_WARMUP_CHAT_ID", "")
+
+# Image URL probing: how many results ahead to check, how many checks run at
+# once, and how long a verdict is trusted
+IMAGE_PROBE_AHEAD = int(os.getenv("IMAGE_PROBE_AHEAD", "3"))
+IMAGE_PROBE_CONCURRENCY = int(os.getenv("IMAGE_PROBE_CONCURRENCY", "8"))
+IMAGE_PROBE_TIMEOUT = float(os.getenv("IMAGE_PROBE_TIMEOUT", "3"))
+IMAGE_BAD_TTL = float(os.getenv("IMAGE_BAD_TTL", "1800"))
+IMAGE_GOOD_TTL = float(os.getenv("IMAGE_GOOD_TTL", "1800"))
+IMAGE_STATUS_MAX_ENTRIES = int(os.getenv("IMAGE_STATUS_MAX_ENTRIES", "10000"))
+# Telegram refuses photos by URL above 5 MB
+TELEGRAM_PHOTO_URL_MAX_BYTES = 5 * 1024 * 1024
+
+# Outbound Telegram flood control (messages per second) and load shedding
+# The bot-wide rate is split evenly between workers
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30")) / (WORKERS if WORKER_INDEX >= 0 else 1)
+SEND_PRIVATE_RATE = float(os.getenv("SEND_PRIVATE_RATE", "1"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_QUEUE_LIMIT = int(os.getenv("SEND_QUEUE_LIMIT", "200"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Search admission control: at most SEARCH_CONCURRENCY searches (Serper calls
+# plus result uploads) run at once per process, up to SEARCH_QUEUE_LIMIT wait
+# with private chats, button taps and inline queries ahead of group triggers,
+# and one still queued after SEARCH_QUEUE_DEADLINE seconds is answered "busy"
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", str(SERPER_POOL_SIZE)))
+SEARCH_QUEUE_LIMIT = int(os.getenv("SEARCH_QUEUE_LIMIT", "100"))
+SEARCH_QUEUE_DEADLINE = float(os.getenv("SEARCH_QUEUE_DEADLINE", "5"))
+
+# Optional on-disk state (SQLite, WAL) so sessions and query results survive
+# restarts. Writes are batched every STATE_FLUSH_INTERVAL seconds.
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))
+SESSION_PERSIST_TTL = float(os.getenv("SESSION_PERSIST_TTL", str(24 * 3600)))
+
+# Shared state for running several workers: with REDIS_URL set, sessions,
+# cached query results and rate-limit counters live in Redis (or anything
+# speaking its protocol) instead of this process, and STATE_DB_PATH is unused
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "dummypawn:")
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "2"))
+
+# Search rate limits as "<searches>/<seconds>"; empty disables a scope
+RATE_LIMIT_USER = os.getenv("RATE_LIMIT_USER", "3/60")
+RATE_LIMIT_CHAT = os.getenv("RATE_LIMIT_CHAT", "")
+RATE_LIMIT_GLOBAL = os.getenv("RATE_LIMIT_GLOBAL", "")
+# Inline queries fire as the user types and pages, so they get their own
+# per-user budget instead of RATE_LIMIT_USER/RATE_LIMIT_CHAT; the global
+# limit still covers both
+RATE_LIMIT_INLINE = os.getenv("RATE_LIMIT_INLINE", "20/60")
+
+# Updates that queued while the bot was down. "drop" skips backlog updates
+# older than BACKLOG_MAX_AGE seconds, plus backlog button taps and inline
+# queries, which carry no date; "process" handles the backlog in order,
+# BACKLOG_CONCURRENCY updates at a time
+BACKLOG_POLICY = os.getenv("BACKLOG_POLICY", "drop")
+BACKLOG_MAX_AGE = float(os.getenv("BACKLOG_MAX_AGE", "120"))
+BACKLOG_CONCURRENCY = int(os.getenv("BACKLOG_CONCURRENCY", "4"))
+
+# Per-handler timing: wall time, and how much of it went to awaiting Serper,
+# Telegram, the send queue and the state backend. Handlers slower than
+# SLOW_HANDLER_SECONDS are logged with that breakdown (0 turns the log off,
+# HANDLER_TIMING=0 the whole middleware).
+HANDLER_TIMING = os.getenv("HANDLER_TIMING", "1") == "1"
+SLOW_HANDLER_SECONDS = float(os.getenv("SLOW_HANDLER_SECONDS", "3"))
+# Telegram user ids allowed to use /debug (comma-separated)
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
+# /debug profile: CPU seconds between stack samples, longest run, stacks shown
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_TOP_STACKS = 8
+
+def describe_rate_policy(spec: str) -> str:
+    """Wording for a "<searches>/<seconds>" policy, e.g. "3 searches per minute"
+
+    Empty when the scope is disabled.
+    """
+    spec = spec.strip()
+    if not spec or spec == "0":
+        return ""
+    limit, _, window = spec.partition("/")
+    limit, seconds = int(limit), float(window or 60)
+    searches = "1 search" if limit == 1 else f"{limit} searches"
+    for size, unit in ((3600, "hour"), (60, "minute"), (1, "second")):
+        if seconds >= size and seconds % size == 0:
+            count = int(seconds // size)
+            return f"{searches} per {unit}" if count == 1 else f"{searches} per {count} {unit}s"
+    return f"{searches} per {seconds:g} seconds"
+
+# Shown in /help and rate limit replies
+RATE_LIMIT_TEXT = describe_rate_policy(RATE_LIMIT_USER)
+
 # Message Dictionaries - Shortened
 START_MESSAGES = {
     "welcome": (
@@ -84,9 +281,11 @@ START_MESSAGES = {
         f"• <code>/web [query]</code> - Web search\n"
         f"• <code>/img [query]</code> - Image search\n"
         f"• <code>/vid [query]</code> - Video search\n"
-        f"• <code>/news [query]</code> - News search\n\n"
+        f"• <code>/news [query]</code> - News search\n"
+        f"• <code>/all [query]</code> - Everything at once\n\n"
         f"<b>Groups:</b> Use 'dummy [query] [type]'\n"
-        f"<b>Private:</b> Just type your query\n\n"
+        f"<b>Private:</b> Just type your query\n"
+        f"<b>Inline:</b> Type <code>@{BOT_USERNAME} [query] [type]</code> in any chat\n\n"
         f"Try: <code>/web python</code> or add me to groups!"
     )
 }
@@ -98,7 +297,8 @@ HELP_MESSAGES = {
         f"• <code>/web [query]</code> - Web search\n"
         f"• <code>/img [query]</code> - Images\n"
         f"• <code>/vid [query]</code> - Videos\n"
-        f"• <code>/news [query]</code> - News\n\n"
+        f"• <code>/news [query]</code> - News\n"
+        f"• <code>/all [query]</code> - All of them\n\n"
         f"<b>Smart Usage:</b>\n"
         f"• <b>Private:</b> <code>cats image</code>\n"
         f"• <b>Groups:</b> <code>dummy cats image</code>\n\n"
@@ -108,14 +308,16 @@ HELP_MESSAGES = {
         f"<b>🆘 Help - Dummy Pawn</b>\n\n"
         f"<b>All Features:</b>\n"
         f"• Navigate with Previous/Next buttons\n"
-        f"• Rate limit: 3 searches per minute\n"
+        f"• Rate limit: {RATE_LIMIT_TEXT or 'none'}\n"
         f"• Individual sessions per chat\n"
         f"• Rich media display\n\n"
         f"<b>Trigger Words:</b>\n"
         f"Web: site, link, search, google\n"
         f"Image: pic, photo, wallpaper, pfp\n"
         f"Video: clip, movie, film, reel\n"
-        f"News: headline, update, breaking\n\n"
+        f"News: headline, update, breaking\n"
+        f"All: all, everything\n"
+        f"Album: album, gallery\n\n"
         f"<i>Click minimize for basic view</i>"
     )
 }
@@ -126,7 +328,10 @@ QUERY_ANSWERS = {
     "help_minimized": "📋 Showing basic help",
     "help_updated": "✅ Help updated",
     "help_same": "Already showing this view",
-    "help_error": "❌ Failed to update help"
+    "help_error": "❌ Failed to update help",
+    "album_loading": "📚 Loading album...",
+    "album_busy": "⏳ Still loading the last album",
+    "busy": "⏳ Too many searches right now, tap again in a moment"
 }
 
 # Trigger Words Dictionary for Easy Reference
@@ -134,11 +339,16 @@ TRIGGER_WORDS = {
     "web_triggers": ["web", "site", "website", "link", "search", "google"],
     "img_triggers": ["image", "img", "pic", "picture", "photo", "wallpaper", "pfp", "dp"],
     "vid_triggers": ["video", "vid", "clip", "movie", "film", "short", "reel"],
-    "news_triggers": ["news", "headline", "update", "report", "breaking", "alert"]
+    "news_triggers": ["news", "headline", "update", "report", "breaking", "alert"],
+    "all_triggers": ["all", "everything"],
+    "album_triggers": ["album", "gallery"]
 }
 
 ERROR_MESSAGES = {
-    "rate_limit": "⏰ Rate limit exceeded. You can make 3 searches per minute. Please wait.",
+    "rate_limit": (
+        f"⏰ Rate limit exceeded. You can make {RATE_LIMIT_TEXT}. Please wait."
+        if RATE_LIMIT_TEXT else "⏰ Rate limit exceeded. Please wait."
+    ),
     "empty_query": "😕 Please provide a search query.",
     "no_data": "💔 No data received from API. Please try again later.",
     "no_results": "💔 No {mode} results found for '{query}'.",
@@ -155,24 +365,38 @@ ERROR_MESSAGES = {
     "no_more": "🙌 No more results available buddy.",
     "first_result": "😖 This is the first result dumbass.",
     "cannot_edit": "🤐 Cannot edit this message.",
-    "edit_failed": "🤐 Failed to update message."
+    "edit_failed": "🤐 Failed to update message.",
+    "busy": "⏳ I'm handling too many searches right now. Please try again in a moment.",
+    "no_album": "💔 Not enough pictures for an album.",
+    "album_expired": "❗ This album is no longer active. Please search again.",
+    "debug_usage": "🛠 Usage: /debug profile &lt;seconds&gt;",
+    "profile_running": "⏳ A profile is already running.",
+    "profile_unavailable": "🙁 Profiling needs a platform with interval timers."
 }
 
 SUCCESS_MESSAGES = {
     "updated": "❤️ Updated",
     "deleted": "❤️ Message deleted",
-    "already_showing": "❤️ Already showing this result"
+    "already_showing": "❤️ Already showing this result",
+    "profile_started": "🔬 Profiling for {seconds:g}s..."
+}
+
+INLINE_MESSAGES = {
+    "rate_limit": "⏰ Rate limit exceeded, try again shortly",
+    "no_results": "💔 No results, tap to open the bot",
+    "busy": "⏳ Too many searches right now, try again in a moment"
 }
 
 GROUP_MESSAGES = {
     "usage_error": "❗ Usage: dummy [query] [type]\nExample: dummy cats image",
-    "unknown_type": "❗ Unknown search type '{search_type}'\nAvailable types: web, image, video, news"
+    "unknown_type": "❗ Unknown search type '{search_type}'\nAvailable types: web, image, video, news, all, album"
 }
 
 BUTTON_TEXTS = {
     "previous": "Previous",
     "next": "Next",
     "close": "Close",
+    "album": "📚 Album",
     "updates": "Updates",
     "support": "Support",
     "add_to_group": "Add Me To Your Group",
@@ -186,7 +410,8 @@ BOT_COMMANDS = [
     {"command": "web", "description": "🌐 Search the web"},
     {"command": "img", "description": "🏜️ Search for images"},
     {"command": "vid", "description": "🎬 Search for videos"},
-    {"command": "news", "description": "📰 Search for news"}
+    {"command": "news", "description": "📰 Search for news"},
+    {"command": "all", "description": "🧭 Search everything at once"}
 ]
 
 SEARCH_TYPE_MAPPING = {
@@ -226,14 +451,59 @@ SEARCH_TYPE_MAPPING = {
     "updates": "news",
     "report": "news",
     "breaking": "news",
-    "alert": "news"
+    "alert": "news",
+
+    "all": "all",
+    "everything": "all",
+
+    # Image search shown as media-group albums
+    "album": "album",
+    "gallery": "album"
 }
 
 MODE_EMOJIS = {
     "web": "🌐",
     "news": "📰",
     "vid": "🎥",
-    "img": "🖼️"
+    "img": "🖼️",
+    "all": "🧭"
+}
+
+# Result captions; every field is HTML-escaped before substitution
+CAPTION_TEMPLATES = {
+    "img": (
+        "{emoji} <b>{title}</b>\n\n"
+        "📊 Result {position} of {total}\n"
+        "🔍 Query: {query}\n"
+        "👤 Your session: {session}"
+    ),
+    "default": (
+        '{emoji} <a href="{link}"><b>{title}</b></a>\n\n'
+        "{snippet}\n\n"
+        "📊 Result {position} of {total}\n"
+        "🔍 Query: {query}\n"
+        "👤 Your session: {session}"
+    ),
+    # Album views: a short caption per picture, then a message with the controls
+    "album_item": (
+        "{emoji} <b>{title}</b>\n"
+        "📊 Result {position} of {total}"
+    ),
+    "album": (
+        "📚 <b>Album:</b> {query}\n"
+        "📊 Results {first}-{last} of {total}\n"
+        "👤 Your session: {session}"
+    ),
+    # Inline results stand alone in the chat they are sent to
+    "inline_img": (
+        "{emoji} <b>{title}</b>\n\n"
+        "🔍 Query: {query}"
+    ),
+    "inline": (
+        '{emoji} <a href="{link}"><b>{title}</b></a>\n\n'
+        "{snippet}\n\n"
+        "🔍 Query: {query}"
+    )
 }
 
 RESULTS_KEY_MAPPING = {
@@ -243,461 +513,3306 @@ RESULTS_KEY_MAPPING = {
     "news": "news"
 }
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+# Logging: handlers only enqueue records; a listener thread formats and
+# writes them so the event loop never blocks on stdout.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # "json" or "console" (coloured, for dev)
 
-def log_info(msg):
-    print(f"{Fore.CYAN}ℹ️ INFO: {msg}{Fore.RESET}")
-    logging.info(msg)
+SUCCESS = 25
+logging.addLevelName(SUCCESS, "SUCCESS")
 
-def log_success(msg):
-    print(f"{Fore.GREEN}✅ SUCCESS: {msg}{Fore.RESET}")
-    logging.info(msg)
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line for log shippers"""
 
-def log_warn(msg):
-    print(f"{Fore.YELLOW}⚠️ WARNING: {msg}{Fore.RESET}")
-    logging.warning(msg)
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
 
-def log_error(msg):
-    print(f"{Fore.RED}❌ ERROR: {msg}{Fore.RESET}")
-    logging.error(msg)
+class ConsoleFormatter(logging.Formatter):
+    """Coloured, emoji-tagged lines matching the bot's original console output"""
+    STYLES = {
+        logging.DEBUG: (Fore.WHITE, "🐞 DEBUG"),
+        logging.INFO: (Fore.CYAN, "ℹ️ INFO"),
+        SUCCESS: (Fore.GREEN, "✅ SUCCESS"),
+        logging.WARNING: (Fore.YELLOW, "⚠️ WARNING"),
+        logging.ERROR: (Fore.RED, "❌ ERROR"),
+        logging.CRITICAL: (Fore.RED, "❌ CRITICAL")
+    }
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
-router = Router()
-dp.include_router(router)
+    def format(self, record):
+        colour, tag = self.STYLES.get(record.levelno, (Fore.RESET, record.levelname))
+        line = f"{colour}{tag}: {record.getMessage()}{Fore.RESET}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
 
-# Cache keyed by (user_id, chat_id) - each user has isolated sessions per chat
-user_search_cache = {}
-# Rate limit keyed by user_id for both private and group chats
-rate_limit = {}
+class RawQueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are, so the listener thread does the formatting
 
-def get_help_keyboard(user_id: int, chat_id: int, is_expanded: bool = False):
-    """Generate help keyboard with expand/minimize button"""
-    if is_expanded:
-        callback_data = f"help_minimize_{user_id}_{chat_id}"
-        button_text = BUTTON_TEXTS["minimize"]
-    else:
-        callback_data = f"help_expand_{user_id}_{chat_id}"
-        button_text = BUTTON_TEXTS["expand"]
-    
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=button_text, callback_data=callback_data)
-        ]
-    ])
+    The stock prepare() renders the message and traceback on the calling
+    thread (the event loop) and drops exc_info. Log args here are ids,
+    strings and exceptions, which are not mutated after logging.
+    """
 
-def get_inline_keyboard(user_id: int, chat_id: int):
-    """Generate inline keyboard with callback_data including user_id and chat_id"""
-    log_info(f"Generating inline keyboard for user_id={user_id}, chat_id={chat_id}")
-    prefix_prev = f"prev_{user_id}_{chat_id}"
-    prefix_next = f"next_{user_id}_{chat_id}"
-    prefix_close = f"close_{user_id}_{chat_id}"
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=BUTTON_TEXTS["previous"], callback_data=prefix_prev),
-            InlineKeyboardButton(text=BUTTON_TEXTS["next"], callback_data=prefix_next)
-        ],
-        [
-            InlineKeyboardButton(text=BUTTON_TEXTS["close"], callback_data=prefix_close)
-        ]
-    ])
+    def prepare(self, record):
+        return record
 
-async def query_serper(mode: str, query: str):
-    log_info(f"Calling Serper API with mode='{mode}' and query='{query}'")
-    url = SERPER_URLS.get(mode)
-    if not url:
-        log_error(f"Invalid mode: {mode}")
-        return {}
-    headers = {"X-API-KEY": SERPER_API_KEY, "Content-Type": "application/json"}
-    payload = {"q": query}
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers) as resp:
-                if resp.status != 200:
-                    log_error(f"Serper API returned status {resp.status} for query '{query}'")
-                    return {}
-                data = await resp.json()
-                log_success(f"Received data from Serper API for query '{query}'")
-                return data
-    except Exception as e:
-        log_error(f"Exception during Serper API call: {e}")
-        return {}
+def setup_logging():
+    """Route all logging through a RawQueueHandler drained by a QueueListener"""
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(ConsoleFormatter() if LOG_FORMAT == "console" else JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [RawQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
-def check_rate_limit(user_id: int) -> bool:
-    """Check if user has exceeded rate limit (3 searches per minute)"""
-    now = datetime.now()
-    if user_id not in rate_limit:
-        rate_limit[user_id] = []
-    
-    # Remove old entries (older than 1 minute)
-    rate_limit[user_id] = [timestamp for timestamp in rate_limit[user_id] 
-                          if now - timestamp < timedelta(minutes=1)]
-    
-    # Check if user has exceeded limit
-    if len(rate_limit[user_id]) >= 3:
-        return False
-    
-    # Add current request
-    rate_limit[user_id].append(now)
-    return True
+log_listener = setup_logging()
+logger = logging.getLogger("dummypawn")
 
-async def send_result(msg: types.Message, mode: str, index: int = 0, query_override: str = ""):
-    """Send search result with pagination"""
-    chat_id = msg.chat.id
-    user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"send_result called for chat_id={chat_id}, user_id={user_id}, mode='{mode}', index={index}")
-    
-    # Check rate limit
-    if not check_rate_limit(user_id):
-        await msg.answer(ERROR_MESSAGES["rate_limit"], reply_to_message_id=msg.message_id)
-        log_warn(f"Rate limit exceeded for user {user_id}")
-        return
-    
-    # Determine the query text
-    if query_override:
-        query = query_override.strip()
-    else:
-        text = msg.text or ""
-        if text.startswith("/"):
-            parts = text.split(" ", 1)
-            query = parts[1].strip() if len(parts) > 1 else ""
-        else:
-            query = text.strip()
-    
-    if not query or query.lower().strip() == "dummy":
-        await msg.answer(ERROR_MESSAGES["empty_query"], reply_to_message_id=msg.message_id)
-        log_warn(f"Empty or invalid query from user {user_id} in chat {chat_id}")
-        return
+# Messages use %-style args so they are only formatted when the level is enabled
+def log_debug(msg, *args):
+    logger.debug(msg, *args)
 
-    data = await query_serper(mode, query)
-    if not data:
-        await msg.answer(ERROR_MESSAGES["no_data"], reply_to_message_id=msg.message_id)
-        log_warn(f"No data received from API for query '{query}' user {user_id} in chat {chat_id}")
-        return
+def log_info(msg, *args):
+    logger.info(msg, *args)
 
-    results_key = RESULTS_KEY_MAPPING[mode]
-    results = data.get(results_key, [])
-    if not results:
-        await msg.answer(ERROR_MESSAGES["no_results"].format(mode=mode, query=query), reply_to_message_id=msg.message_id)
-        log_warn(f"No {mode} results found for query '{query}' user {user_id} in chat {chat_id}")
-        return
+def log_success(msg, *args):
+    logger.log(SUCCESS, msg, *args)
 
-    # Cache under (user_id, chat_id)
-    session_timestamp = datetime.now().strftime("%H%M%S")
-    cache_key = (user_id, chat_id)
-    user_search_cache[cache_key] = {
-        "mode": mode,
-        "query": query,
-        "data": data,
-        "index": index,
-        "timestamp": session_timestamp,
-        "chat_id": chat_id
-    }
-    log_info(f"Cached search for user {user_id} in chat {chat_id}, mode '{mode}', query '{query}', total results {len(results)}")
+def log_warn(msg, *args):
+    logger.warning(msg, *args)
 
-    if index >= len(results):
-        await msg.answer(ERROR_MESSAGES["no_more_results"], reply_to_message_id=msg.message_id)
-        log_warn(f"Index {index} out of range for results, user {user_id} in chat {chat_id}")
-        return
+def log_error(msg, *args):
+    logger.error(msg, *args)
 
-    result = results[index]
-    keyboard = get_inline_keyboard(user_id, chat_id)
+# Prometheus-style metrics (text exposition format, no client library)
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-    try:
-        if mode == "img":
-            image_url = result.get("imageUrl", "")
-            title = result.get("title", "")
-            caption = f"{MODE_EMOJIS['img']} <b>{title}</b>\n\n📊 Result {index + 1} of {len(results)}\n🔍 Query: {query}\n👤 Your session: {session_timestamp}"
-            await msg.answer_photo(image_url, caption=caption, reply_markup=keyboard, reply_to_message_id=msg.message_id)
-            log_success(f"Sent image result to user {user_id} in chat {chat_id}")
-        else:
-            link = result.get("link", "")
-            title = result.get("title", "No Title")
-            snippet = result.get("snippet") or result.get("description") or "No description available."
-            photo_url = result.get("thumbnailUrl") or result.get("imageUrl")
-            
-            emoji = MODE_EMOJIS.get(mode, "🔍")
-            caption = f'{emoji} <a href="{link}"><b>{title}</b></a>\n\n{snippet}\n\n📊 Result {index + 1} of {len(results)}\n🔍 Query: {query}\n👤 Your session: {session_timestamp}'
-            
-            if photo_url:
-                await msg.answer_photo(photo=photo_url, caption=caption, reply_markup=keyboard, reply_to_message_id=msg.message_id)
-                log_success(f"Sent photo with caption to user {user_id} in chat {chat_id}")
-            else:
-                await msg.answer(caption, reply_markup=keyboard, reply_to_message_id=msg.message_id)
-                log_success(f"Sent text result to user {user_id} in chat {chat_id}")
-    except Exception as e:
-        log_error(f"Failed to send result message for chat {chat_id}, user {user_id}: {e}")
-        await msg.answer(ERROR_MESSAGES["send_failed"], reply_to_message_id=msg.message_id)
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
 
-@router.callback_query(lambda c: c.data and (
-    c.data.startswith("next_") or c.data.startswith("prev_") or c.data.startswith("close_") or
-    c.data.startswith("help_expand_") or c.data.startswith("help_minimize_")
-))
-async def callback_handler(query: CallbackQuery):
-    """Handle pagination and help expand/minimize callbacks"""
-    data = query.data or ""
-    if not query.message or not query.from_user:
-        await query.answer(ERROR_MESSAGES["invalid_callback"])
-        return
-        
-    log_info(f"Received callback: {data} from user {query.from_user.id} in chat {query.message.chat.id}")
-    
-    # Handle help expand/minimize callbacks
-    if data.startswith("help_expand_") or data.startswith("help_minimize_"):
-        parts = data.split("_")
-        if len(parts) != 4:
-            await query.answer(ERROR_MESSAGES["invalid_data"])
+class Counter:
+    """Monotonic counter, optionally labelled or read from a callback at scrape time"""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.callback = callback
+        self._values = {} if labels else {(): 0}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        if self.callback is not None:
+            yield self.name, "", self.callback()
             return
-            
-        action, expand_minimize, user_id_str, chat_id_str = parts
+        for label_values, value in self._values.items():
+            yield self.name, format_labels(self.labels, label_values), value
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def set(self, *label_values, value: float):
+        self._values[label_values] = value
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+class Histogram:
+    """Cumulative-bucket latency histogram, optionally labelled"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self):
+        for label_values, series in self._values.items():
+            for bound, count in zip(self.buckets, series):
+                labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                yield f"{self.name}_bucket", labels, count
+            labels = format_labels(self.labels + ("le",), label_values + ("+Inf",))
+            yield f"{self.name}_bucket", labels, series[-1]
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum", labels, series[-2]
+            yield f"{self.name}_count", labels, series[-1]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+SERPER_LATENCY = metrics.register(Histogram(
+    "dummypawn_serper_request_seconds", "Serper API call latency", ("mode", "status")
+))
+TELEGRAM_LATENCY = metrics.register(Histogram(
+    "dummypawn_telegram_request_seconds", "Telegram Bot API call latency", ("method", "status")
+))
+SERPER_HEDGES = metrics.register(Counter(
+    "dummypawn_serper_hedged_requests_total", "Backup Serper requests fired after the p95 delay", ("mode",)
+))
+RATE_LIMIT_REJECTIONS = metrics.register(Counter(
+    "dummypawn_rate_limit_rejections_total", "Searches rejected by the rate limiter"
+))
+SESSION_MISSES = metrics.register(Counter(
+    "dummypawn_session_misses_total", "Pagination callbacks with no cached session (no_cache)"
+))
+IMAGE_PROBES = metrics.register(Counter(
+    "dummypawn_image_url_checks_total", "Image URL verdicts by outcome", ("result",)
+))
+NOT_MODIFIED = metrics.register(Counter(
+    "dummypawn_message_not_modified_total", "Edits rejected as 'message is not modified'"
+))
+PAGE_TAPS_COALESCED = metrics.register(Counter(
+    "dummypawn_page_taps_coalesced_total", "Next/Previous taps merged into an already pending edit"
+))
+HANDLERS_IN_FLIGHT = metrics.register(Gauge(
+    "dummypawn_handlers_in_flight", "Updates currently being handled"
+))
+
+SEND_QUEUE_DEPTH = metrics.register(Gauge(
+    "dummypawn_send_queue_depth", "Outbound Telegram calls waiting for a send slot"
+))
+SEND_SHED = metrics.register(Counter(
+    "dummypawn_send_shed_total", "Outbound Telegram calls dropped because the queue was full", ("method",)
+))
+SEND_RETRY_AFTER = metrics.register(Counter(
+    "dummypawn_send_retry_after_total", "429 responses honoured by the send scheduler", ("method",)
+))
+ADMISSION_REJECTIONS = metrics.register(Counter(
+    "dummypawn_search_rejections_total", "Searches answered busy by admission control", ("reason",)
+))
+WORKER_UPDATES = metrics.register(Counter(
+    "dummypawn_worker_updates_total", "Updates the supervisor routed to each worker", ("worker",)
+))
+WORKER_RESTARTS = metrics.register(Counter(
+    "dummypawn_worker_restarts_total", "Worker processes restarted after exiting unexpectedly"
+))
+STATE_BACKEND_ERRORS = metrics.register(Counter(
+    "dummypawn_state_backend_errors_total", "Shared state backend calls that failed", ("operation",)
+))
+
+BACKLOG_DROPPED = metrics.register(Counter(
+    "dummypawn_backlog_dropped_total", "Queued updates skipped at startup by the backlog policy"
+))
+STARTUP_SECONDS = metrics.register(Gauge(
+    "dummypawn_startup_seconds", "Seconds from process start to each startup milestone", ("phase",)
+))
+
+def record_startup(phase: str):
+    elapsed = time.monotonic() - PROCESS_STARTED
+    STARTUP_SECONDS.set(phase, value=elapsed)
+    log_info("Startup: %s after %.2fs", phase.replace("_", " "), elapsed)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Track how many updates are being handled at once"""
+
+    def __init__(self):
+        self.handled_any = False
+
+    async def __call__(self, handler, event, data):
+        HANDLERS_IN_FLIGHT.inc()
         try:
-            user_id = int(user_id_str)
-            chat_id = int(chat_id_str)
-        except ValueError:
-            await query.answer(ERROR_MESSAGES["invalid_ids"])
-            return
-            
-        # Verify correct user and chat
-        if query.from_user.id != user_id:
-            await query.answer(ERROR_MESSAGES["wrong_user"])
-            return
-        
-        if query.message.chat.id != chat_id:
-            await query.answer(ERROR_MESSAGES["wrong_chat"])
-            return
-            
-        # Handle expand/minimize
-        try:
-            if expand_minimize == "expand":
-                new_text = HELP_MESSAGES["expanded"]
-                new_keyboard = get_help_keyboard(user_id, chat_id, is_expanded=True)
-                answer_msg = QUERY_ANSWERS["help_expanded"]
-            else:  # minimize
-                new_text = HELP_MESSAGES["basic"]
-                new_keyboard = get_help_keyboard(user_id, chat_id, is_expanded=False)
-                answer_msg = QUERY_ANSWERS["help_minimized"]
-                
-            await query.message.edit_text(new_text, reply_markup=new_keyboard)
-            await query.answer(answer_msg)
-            log_success(f"Help {expand_minimize}d for user {user_id}")
-            return
-            
-        except Exception as e:
-            if "message is not modified" in str(e):
-                await query.answer(QUERY_ANSWERS["help_same"])
-            else:
-                log_error(f"Failed to update help message: {e}")
-                await query.answer(QUERY_ANSWERS["help_error"])
-            return
-    
-    # Handle pagination callbacks (existing code)
-    parts = data.split("_")
-    if len(parts) != 3:
-        log_warn(f"Unexpected callback_data format: {data}")
-        await query.answer(ERROR_MESSAGES["invalid_data"])
-        return
+            return await handler(event, data)
+        finally:
+            HANDLERS_IN_FLIGHT.dec()
+            if not self.handled_any:
+                self.handled_any = True
+                record_startup("first_update")
 
-    action, user_id_str, chat_id_str = parts
-    try:
-        user_id = int(user_id_str)
-        chat_id = int(chat_id_str)
-    except ValueError:
-        log_warn(f"Non-integer IDs in callback_data: {data}")
-        await query.answer(ERROR_MESSAGES["invalid_ids"])
-        return
+def update_sent_at(update: types.Update):
+    """Unix time the update's event happened, or None when it carries no date"""
+    date = getattr(update.event, "date", None)
+    return date.timestamp() if date is not None else None
 
-    # Verify correct user and chat
-    if query.from_user.id != user_id:
-        await query.answer(ERROR_MESSAGES["wrong_user"])
-        log_warn(f"User {query.from_user.id} tried to press button for user {user_id}")
-        return
-    
-    if query.message.chat.id != chat_id:
-        await query.answer(ERROR_MESSAGES["wrong_chat"])
-        log_warn(f"Callback for chat {chat_id} used in chat {query.message.chat.id}")
+def raw_update_sent_at(update: dict):
+    """update_sent_at() for an undecoded update"""
+    for value in update.values():
+        if isinstance(value, dict):
+            return value.get("date")
+    return None
+
+class BacklogGate:
+    """Applies BACKLOG_POLICY to the updates that queued during downtime
+
+    Telegram reports how many updates are pending at startup, and delivers
+    them before anything newer, so the next that many updates are the
+    backlog. Dated updates older than max_age are skipped under "drop"
+    whenever they arrive.
+    """
+
+    def __init__(self, policy: str, max_age: float, concurrency: int):
+        self.policy = policy
+        self.max_age = max_age
+        self.remaining = 0
+        self.slots = asyncio.Semaphore(max(1, concurrency))
+
+    def start(self, pending: int):
+        self.remaining = pending
+        if pending:
+            log_info("%s updates queued while the bot was down, backlog policy: %s", pending, self.policy)
+
+    def take(self) -> bool:
+        """Whether the next update is part of the backlog"""
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    def is_stale(self, sent_at, in_backlog: bool) -> bool:
+        if self.policy != "drop":
+            return False
+        if sent_at is None:
+            return in_backlog
+        return time.time() - sent_at > self.max_age
+
+    def admit_raw(self, update: dict) -> bool:
+        """Drop check for the supervisor, which routes without handling"""
+        if self.is_stale(raw_update_sent_at(update), self.take()):
+            BACKLOG_DROPPED.inc()
+            return False
+        return True
+
+class BacklogMiddleware(BaseMiddleware):
+    """Skip stale backlog updates, or bound how many run at once"""
+
+    def __init__(self, gate: BacklogGate):
+        self.gate = gate
+
+    async def __call__(self, handler, event, data):
+        in_backlog = self.gate.take()
+        if self.gate.is_stale(update_sent_at(event), in_backlog):
+            BACKLOG_DROPPED.inc()
+            return None
+        if not in_backlog or self.gate.policy != "process":
+            return await handler(event, data)
+        # Semaphore waiters are woken first come, first served, so the
+        # backlog starts in delivery order
+        async with self.gate.slots:
+            return await handler(event, data)
+
+# Handler timing
+HANDLER_LATENCY = metrics.register(Histogram(
+    "dummypawn_handler_seconds", "Wall time of each update handler", ("handler",)
+))
+HANDLER_PHASE_LATENCY = metrics.register(Histogram(
+    "dummypawn_handler_phase_seconds", "Time handlers spent awaiting each dependency", ("handler", "phase")
+))
+
+class HandlerTimer:
+    """Seconds a single handler spent in each phase it awaited"""
+    __slots__ = ("phases", "closed")
+
+    def __init__(self):
+        self.phases = {}
+        self.closed = False
+
+    def add(self, phase: str, seconds: float):
+        # Tasks the handler started may outlive it; only count its own time
+        if not self.closed:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+current_timer = contextvars.ContextVar("current_timer", default=None)
+
+@contextlib.contextmanager
+def timed_phase(phase: str):
+    """Charge the time spent in the block to the running handler, if timed"""
+    timer = current_timer.get()
+    if timer is None:
+        yield
         return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(phase, time.perf_counter() - started)
 
-    # Handle close
-    if action == "close":
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Time handlers and log slow ones with a phase breakdown
+
+    Installed as the routers' inner middleware, where aiogram knows which
+    handler matched. Await time is the sum of the timed phases; they can
+    overlap when a handler waits on several things at once. The rest of
+    the wall time is our own code and event loop contention.
+    """
+
+    def __init__(self, slow_after: float):
+        self.slow_after = slow_after
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        callback = data.get("callback")
+        if callback is not None and callback.action in CALLBACK_HANDLERS:
+            name = CALLBACK_HANDLERS[callback.action].__name__
+        timer = HandlerTimer()
+        token = current_timer.set(timer)
+        started = time.perf_counter()
         try:
-            if hasattr(query.message, 'delete'):
-                await query.message.delete()
-                await query.answer(SUCCESS_MESSAGES["deleted"])
-                log_success(f"Message deleted by user {user_id}")
-            else:
-                await query.answer(ERROR_MESSAGES["cannot_delete"])
-        except Exception as e:
-            log_error(f"Failed to delete message for user {user_id}: {e}")
-            await query.answer(ERROR_MESSAGES["delete_failed"])
-        return
+            return await handler(event, data)
+        finally:
+            wall = time.perf_counter() - started
+            timer.closed = True
+            current_timer.reset(token)
+            HANDLER_LATENCY.observe(wall, name)
+            for phase, seconds in timer.phases.items():
+                HANDLER_PHASE_LATENCY.observe(seconds, name, phase)
+            if self.slow_after > 0 and wall >= self.slow_after:
+                awaited = sum(timer.phases.values())
+                breakdown = ", ".join(
+                    f"{phase} {seconds:.2f}s"
+                    for phase, seconds in sorted(timer.phases.items(), key=lambda item: -item[1])
+                )
+                log_warn(
+                    "Slow handler %s: %.2fs wall, %.2fs awaiting (%s), %.2fs own code",
+                    name, wall, awaited, breakdown or "nothing timed", max(0.0, wall - awaited)
+                )
 
-    # Retrieve cache for this specific user and chat
-    cache_key = (user_id, chat_id)
-    cache = user_search_cache.get(cache_key)
-    if not cache:
-        await query.answer(ERROR_MESSAGES["no_cache"])
-        log_warn(f"No cached search for user {user_id} in chat {chat_id} on callback {data}")
-        return
+class SamplingProfiler:
+    """CPU sampling profiler for the event loop thread
 
-    mode = cache["mode"]
-    data_full = cache["data"]
-    index = cache["index"]
-    results_key = RESULTS_KEY_MAPPING[mode]
-    results = data_full.get(results_key, [])
+    Nothing is installed between runs. During a run a SIGPROF interval timer
+    fires every `interval` seconds of process CPU time, and the signal
+    handler, which Python runs on the main thread, counts the interrupted
+    stack. Time spent waiting in select() costs no samples; samples that do
+    land there are CPU used by other threads (executor, SQLite).
+    """
 
-    # Compute new index
-    if action == "next":
-        new_index = index + 1
-        if new_index >= len(results):
-            await query.answer(ERROR_MESSAGES["no_more"])
-            log_warn(f"User {user_id} reached end of results")
-            return
-    elif action == "prev":
-        new_index = index - 1
-        if new_index < 0:
-            await query.answer(ERROR_MESSAGES["first_result"])
-            log_warn(f"User {user_id} tried to go before first result")
-            return
-    else:
-        await query.answer()
-        return
+    available = hasattr(signal, "setitimer")
 
-    # Update cache index for this specific user and chat
-    user_search_cache[cache_key]["index"] = new_index
-    result = results[new_index]
-    keyboard = get_inline_keyboard(user_id, chat_id)
+    def __init__(self, interval: float, depth: int = 8):
+        self.interval = interval
+        self.depth = depth
+        self.running = False
+        self._stacks = {}
 
-    try:
-        if hasattr(query.message, 'edit_media') and hasattr(query.message, 'edit_text'):
-            if mode == "img":
-                image_url = result.get("imageUrl", "")
-                title = result.get("title", "")
-                session_info = cache.get("timestamp", "")
-                query_info = cache.get("query", "")
-                caption = f"{MODE_EMOJIS['img']} <b>{title}</b>\n\n📊 Result {new_index + 1} of {len(results)}\n🔍 Query: {query_info}\n👤 Your session: {session_info}"
-                try:
-                    await query.message.edit_media(
-                        types.InputMediaPhoto(media=image_url, caption=caption),
-                        reply_markup=keyboard
-                    )
-                    log_success(f"Edited image media for user {user_id}")
-                    await query.answer(SUCCESS_MESSAGES["updated"])
-                except Exception as edit_e:
-                    if "message is not modified" in str(edit_e):
-                        await query.answer(SUCCESS_MESSAGES["already_showing"])
-                        log_info(f"Duplicate content for user {user_id}, index {new_index}")
-                    else:
-                        raise edit_e
-            else:
-                link = result.get("link", "")
-                title = result.get("title", "No Title")
-                snippet = result.get("snippet") or result.get("description") or "No description available."
-                photo_url = result.get("thumbnailUrl") or result.get("imageUrl")
-                
-                emoji = MODE_EMOJIS.get(mode, "🔍")
-                session_info = cache.get("timestamp", "")
-                query_info = cache.get("query", "")
-                caption = f'{emoji} <a href="{link}"><b>{title}</b></a>\n\n{snippet}\n\n📊 Result {new_index + 1} of {len(results)}\n🔍 Query: {query_info}\n👤 Your session: {session_info}'
-                
-                try:
-                    if photo_url:
-                        await query.message.edit_media(
-                            types.InputMediaPhoto(media=photo_url, caption=caption),
-                            reply_markup=keyboard
-                        )
-                        log_success(f"Edited media with photo for user {user_id}")
-                    else:
-                        await query.message.edit_text(caption, reply_markup=keyboard)
-                        log_success(f"Edited text media for user {user_id}")
-                    await query.answer(SUCCESS_MESSAGES["updated"])
-                except Exception as edit_e:
-                    if "message is not modified" in str(edit_e):
-                        await query.answer(SUCCESS_MESSAGES["already_showing"])
-                        log_info(f"Duplicate content for user {user_id}, index {new_index}")
-                    else:
-                        raise edit_e
-        else:
-            await query.answer(ERROR_MESSAGES["cannot_edit"])
-    except Exception as e:
-        log_error(f"Failed to edit message for user {user_id}: {e}")
-        await query.answer(ERROR_MESSAGES["edit_failed"])
+    # Event loop frames every callback runs under; the walk stops there
+    loop_frames = {"_run", "_run_once", "run_forever", "run_until_complete"}
+    asyncio_dir = os.path.dirname(asyncio.__file__)
 
-@router.message(Command("start"))
-async def cmd_start(msg: types.Message):
-    user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"Start command invoked by user {user_id}")
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=BUTTON_TEXTS["updates"], url=UPDATES_CHANNEL),
-            InlineKeyboardButton(text=BUTTON_TEXTS["support"], url=SUPPORT_GROUP)
-        ],
-        [
-            InlineKeyboardButton(text=BUTTON_TEXTS["add_to_group"], url=f"https://t.me/{BOT_USERNAME}?startgroup=true")
+    def _on_sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < self.depth:
+            code = frame.f_code
+            if code.co_name in self.loop_frames and code.co_filename.startswith(self.asyncio_dir):
+                break
+            stack.append((os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        key = tuple(stack)
+        self._stacks[key] = self._stacks.get(key, 0) + 1
+
+    async def run(self, seconds: float) -> dict:
+        """Sample for `seconds`; returns {stack (innermost first): samples}"""
+        self.running = True
+        self._stacks = {}
+        previous = signal.signal(signal.SIGPROF, self._on_sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+            self.running = False
+        return self._stacks
+
+    @staticmethod
+    def in_select(stack) -> bool:
+        return bool(stack) and stack[0][0] == "selectors.py"
+
+    def summarize(self, stacks: dict, seconds: float, top: int) -> str:
+        total = sum(stacks.values())
+        other = sum(count for stack, count in stacks.items() if self.in_select(stack))
+        lines = [
+            f"<b>🔬 Profile: {seconds:g}s, {total} samples "
+            f"(~{total * self.interval:.2f}s CPU, {100 * other / max(total, 1):.0f}% in other threads)</b>"
         ]
-    ])
-    
-    # Select random image from the list
-    random_image = random.choice(IMAGES)
-    
-    try:
-        await msg.answer_photo(
-            photo=random_image,
-            caption=START_MESSAGES["welcome"], 
-            reply_markup=keyboard
+        hot = sorted(
+            ((count, stack) for stack, count in stacks.items() if not self.in_select(stack)),
+            key=lambda item: -item[0]
         )
-        log_success(f"Start message with random image sent to user {user_id}")
-    except Exception as e:
-        log_error(f"Failed to send start message with image: {e}")
-        # Fallback to text message if image fails
+        for count, stack in hot[:top]:
+            frames = "\n        ← ".join(f"{name} ({file}:{line})" for file, name, line in stack) or "(event loop)"
+            lines.append(f"<pre>{100 * count / total:5.1f}%  {html.escape(frames)}</pre>")
+        if not hot:
+            lines.append("No samples on the event loop.")
+        text = "\n".join(lines)
+        # Telegram's message limit; drop whole <pre> blocks
+        while len(text) > 4096 and len(lines) > 1:
+            lines.pop()
+            text = "\n".join(lines)
+        return text
+
+profiler = SamplingProfiler(PROFILE_INTERVAL)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Time every outgoing Bot API call (sendPhoto, editMessageMedia, ...)"""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        status = "error"
         try:
-            await msg.answer(START_MESSAGES["welcome"], reply_markup=keyboard)
-            log_success(f"Start message (text fallback) sent to user {user_id}")
-        except Exception as e2:
-            log_error(f"Failed to send start message fallback: {e2}")
+            with timed_phase("telegram"):
+                response = await make_request(bot, method)
+            status = "ok"
+            return response
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, method.__api_method__, status)
 
-@router.message(Command("help"))
+# Outbound send scheduling
+PRIORITY_EDIT = 0  # interactive callback edits go first
+PRIORITY_NEW = 1   # new result messages
+
+SCHEDULED_METHODS = {
+    "editMessageText": PRIORITY_EDIT,
+    "editMessageMedia": PRIORITY_EDIT,
+    "editMessageCaption": PRIORITY_EDIT,
+    "editMessageReplyMarkup": PRIORITY_EDIT,
+    "sendMessage": PRIORITY_NEW,
+    "sendPhoto": PRIORITY_NEW,
+    "sendMediaGroup": PRIORITY_NEW
+}
+
+def send_cost(method) -> int:
+    """Messages a call counts as against Telegram's flood limits: one per album item"""
+    if method.__api_method__ == "sendMediaGroup":
+        return max(1, len(method.media))
+    return 1
+
+class SendQueueFull(Exception):
+    """Raised instead of queueing an outbound call when the scheduler is overloaded"""
+
+class TokenBucket:
+    """Classic token bucket on the monotonic clock"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens: int = 1) -> float:
+        """Seconds until `tokens` are available
+
+        A cost above the burst only waits for a full bucket; the rest is
+        taken on credit and delays whoever comes next.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        needed = min(tokens, self.burst)
+        wait = 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def reserve(self, tokens: int = 1) -> float:
+        """Take tokens now or in the future; returns how long to wait for them"""
+        wait = self.delay(tokens)
+        self.tokens -= tokens
+        return wait
+
+    def block(self, seconds: float):
+        """Hold the bucket closed, e.g. for Telegram's retry_after"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.burst
+
+class PriorityGate:
+    """Token bucket whose waiters are served by (priority, arrival)
+
+    A caller takes a free token directly. Otherwise it queues, and one pump
+    task per gate sleeps until the next token and hands it to the most
+    urgent waiter, so an edit queued later still goes ahead of new messages.
+    """
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._pump = None
+
+    async def acquire(self, priority: int, tokens: int = 1):
+        if not self._waiters and self.bucket.delay(tokens) == 0:
+            self.bucket.reserve(tokens)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future, tokens))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run_pump())
+        await future
+
+    async def _run_pump(self):
+        while self._waiters:
+            wait = self.bucket.delay(self._waiters[0][3])
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future, tokens = heapq.heappop(self._waiters)
+            if not future.done():
+                self.bucket.reserve(tokens)
+                future.set_result(None)
+
+    def idle(self) -> bool:
+        return not self._waiters and self.bucket.idle()
+
+class SendScheduler(BaseRequestMiddleware):
+    """Session middleware every outgoing send/edit passes through
+
+    Each chat gets its own gate (slower for groups), then a global one;
+    both hand out tokens by priority, so callback edits overtake new result
+    messages in a busy group as well as bot-wide. An album costs a token per
+    item. 429s are retried after
+    Telegram's retry_after, and once too many calls are waiting, new
+    messages are shed with SendQueueFull.
+    """
+
+    def __init__(self, global_rate: float, private_rate: float, group_rate: float,
+                 chat_burst: int, queue_limit: int, max_retries: int):
+        self.global_gate = PriorityGate(TokenBucket(global_rate, global_rate))
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.queue_limit = queue_limit
+        self.max_retries = max_retries
+        self.chat_gates = {}
+        self.pending = 0
+
+    def _chat_gate(self, chat_id) -> PriorityGate:
+        gate = self.chat_gates.get(chat_id)
+        if gate is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.private_rate
+            gate = self.chat_gates[chat_id] = PriorityGate(TokenBucket(rate, self.chat_burst))
+        return gate
+
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        priority = SCHEDULED_METHODS.get(api_method)
+        chat_id = getattr(method, "chat_id", None)
+        if priority is None or chat_id is None:
+            return await make_request(bot, method)
+
+        # Edits get twice the headroom before being shed
+        limit = self.queue_limit if priority == PRIORITY_NEW else self.queue_limit * 2
+        if self.pending >= limit:
+            SEND_SHED.inc(api_method)
+            raise SendQueueFull(f"{api_method} to chat {chat_id} shed, {self.pending} calls queued")
+
+        cost = send_cost(method)
+        self.pending += 1
+        SEND_QUEUE_DEPTH.inc()
+        try:
+            attempt = 0
+            while True:
+                gate = self._chat_gate(chat_id)
+                with timed_phase("send_queue"):
+                    await gate.acquire(priority, cost)
+                    await self.global_gate.acquire(priority, cost)
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    attempt += 1
+                    SEND_RETRY_AFTER.inc(api_method)
+                    if attempt > self.max_retries:
+                        raise
+                    log_warn("Flood limit on %s in chat %s, retrying in %ss", api_method, chat_id, e.retry_after)
+                    gate.bucket.block(e.retry_after)
+        finally:
+            self.pending -= 1
+            SEND_QUEUE_DEPTH.dec()
+
+    def sweep(self) -> int:
+        """Forget per-chat gates that are full again and have no waiters"""
+        idle = [chat_id for chat_id, gate in self.chat_gates.items() if gate.idle()]
+        for chat_id in idle:
+            del self.chat_gates[chat_id]
+        return len(idle)
+
+send_scheduler = SendScheduler(
+    SEND_GLOBAL_RATE, SEND_PRIVATE_RATE, SEND_GROUP_RATE,
+    SEND_CHAT_BURST, SEND_QUEUE_LIMIT, SEND_MAX_RETRIES
+)
+
+# Search admission control
+SEARCH_PRIORITY_HIGH = 0  # private chats, button taps and inline queries
+SEARCH_PRIORITY_LOW = 1   # group triggers
+
+class AdmissionRejected(Exception):
+    """A search was turned away because the bot is saturated"""
+
+class AdmissionController:
+    """Caps how many searches run at once; the rest wait in a bounded queue
+
+    Waiters are admitted by priority, then arrival, and a finished search
+    hands its slot straight to the next one. A full queue turns a newcomer
+    away unless it outranks the lowest-priority waiter, which is rejected
+    instead. Anyone still queued after `deadline` seconds is rejected, so
+    an overloaded bot answers "busy" instead of timing out.
+    """
+
+    def __init__(self, limit: int, queue_limit: int, deadline: float):
+        self.limit = max(1, limit)
+        self.queue_limit = queue_limit
+        self.deadline = deadline
+        self.active = 0
+        # heap of (priority, seq, future)
+        self._waiters = []
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @staticmethod
+    def _rejection(reason: str) -> AdmissionRejected:
+        ADMISSION_REJECTIONS.inc(reason)
+        return AdmissionRejected(reason)
+
+    def _remove(self, entry):
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+
+    async def acquire(self, priority: int):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue_limit:
+            worst = max(self._waiters, default=None)
+            if worst is None or worst[0] <= priority:
+                raise self._rejection("queue_full")
+            self._remove(worst)
+            worst[2].set_exception(self._rejection("displaced"))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            with timed_phase("admission"):
+                # shield: a timeout must not cancel a slot handed over at the same moment
+                await asyncio.wait_for(asyncio.shield(future), self.deadline)
+        except asyncio.TimeoutError:
+            if future.done():
+                future.result()  # granted just in time, or displaced
+                return
+            self._remove(entry)
+            raise self._rejection("deadline")
+        except asyncio.CancelledError:
+            if future.done() and future.exception() is None:
+                self.release()
+            else:
+                self._remove(entry)
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int):
+        """Hold a search slot for the block; raises AdmissionRejected"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+admission = AdmissionController(SEARCH_CONCURRENCY, SEARCH_QUEUE_LIMIT, SEARCH_QUEUE_DEADLINE)
+metrics.register(Gauge(
+    "dummypawn_search_active", "Searches holding an admission slot",
+    callback=lambda: admission.active
+))
+metrics.register(Gauge(
+    "dummypawn_search_queue_depth", "Searches waiting for an admission slot",
+    callback=lambda: admission.queued
+))
+
+bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# Registered first so it is outermost: metrics time the API call, not the queue wait
+bot.session.middleware(send_scheduler)
+bot.session.middleware(TelegramMetricsMiddleware())
+dp = Dispatcher()
+backlog = BacklogGate(BACKLOG_POLICY, BACKLOG_MAX_AGE, BACKLOG_CONCURRENCY)
+dp.update.outer_middleware(BacklogMiddleware(backlog))
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+router = Router()
+dp.include_router(router)
+if HANDLER_TIMING:
+    handler_timing = HandlerTimingMiddleware(SLOW_HANDLER_SECONDS)
+    for observer in (router.message, router.callback_query, router.inline_query):
+        observer.middleware(handler_timing)
+
+@dp.startup()
+async def on_startup():
+    record_startup("ready")
+
+class SearchResult:
+    """One search hit, reduced to the fields the bot actually displays
+
+    `mode` is only set on hits merged from several modes ("all" searches);
+    otherwise the session's mode applies.
+    """
+    __slots__ = ("title", "link", "snippet", "image_url", "thumbnail_url", "mode")
+
+    def __init__(self, title: str, link: str, snippet: str, image_url: str, thumbnail_url: str, mode: str = ""):
+        self.title = title
+        self.link = link
+        self.snippet = snippet
+        self.image_url = image_url
+        self.thumbnail_url = thumbnail_url
+        self.mode = mode
+
+    def to_row(self) -> list:
+        row = [self.title, self.link, self.snippet, self.image_url, self.thumbnail_url]
+        if self.mode:
+            row.append(self.mode)
+        return row
+
+    def tagged(self, mode: str):
+        """Copy labelled with the mode it came from; cached results stay shared"""
+        return SearchResult(self.title, self.link, self.snippet, self.image_url, self.thumbnail_url, mode)
+
+    @classmethod
+    def from_serper(cls, item: dict):
+        return cls(
+            item.get("title") or "",
+            item.get("link") or "",
+            item.get("snippet") or item.get("description") or "",
+            item.get("imageUrl") or "",
+            item.get("thumbnailUrl") or ""
+        )
+
+class SearchSession:
+    """Pagination state for one user's latest search in one chat"""
+    __slots__ = (
+        "mode", "query", "results", "index", "timestamp", "user_id", "chat_id",
+        "message_id", "pages_loaded", "exhausted", "prefetch", "probe", "keyboard", "rendered",
+        "shown", "lock", "album", "version"
+    )
+
+    def __init__(self, mode: str, query: str, results: tuple, index: int, timestamp: str, user_id: int, chat_id: int):
+        self.mode = mode
+        self.query = query
+        self.results = results
+        self.index = index
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.chat_id = chat_id
+        # Id of the bot message showing this session, once sent
+        self.message_id = None
+        self.pages_loaded = 1
+        self.exhausted = len(results) < SERPER_PAGE_SIZE or SERPER_MAX_PAGES <= 1
+        self.prefetch = None
+        self.probe = None
+        # Filled lazily by render_result()
+        self.keyboard = None
+        self.rendered = {}
+        # Index the message currently displays, when known
+        self.shown = None
+        # Serializes Next/Previous steps; created on the first tap
+        self.lock = None
+        # In album view: [first index, last index, album message ids]
+        self.album = None
+        # Bumped on every persisted change, so a stale shared copy is ignored
+        self.version = 0
+
+    def extend(self, results: tuple):
+        """Append a later Serper page; totals in captions change, so drop renders"""
+        self.pages_loaded += 1
+        if len(results) < SERPER_PAGE_SIZE or self.pages_loaded >= SERPER_MAX_PAGES:
+            self.exhausted = True
+        if results:
+            self.results += results
+            self.rendered.clear()
+
+    def to_dict(self) -> dict:
+        """Persistable state; background tasks and renders are rebuilt on demand"""
+        return {
+            "mode": self.mode,
+            "query": self.query,
+            "results": [result.to_row() for result in self.results],
+            "index": self.index,
+            "timestamp": self.timestamp,
+            "message_id": self.message_id,
+            "pages_loaded": self.pages_loaded,
+            "exhausted": self.exhausted,
+            "album": self.album,
+            "version": self.version
+        }
+
+    @classmethod
+    def from_dict(cls, user_id: int, chat_id: int, state: dict):
+        results = tuple(SearchResult(*row) for row in state["results"])
+        session = cls(state["mode"], state["query"], results, state["index"], state["timestamp"], user_id, chat_id)
+        session.message_id = state.get("message_id")
+        session.pages_loaded = state.get("pages_loaded", 1)
+        session.exhausted = state.get("exhausted", True)
+        session.album = state.get("album")
+        session.version = state.get("version", 0)
+        return session
+
+    def close(self):
+        """Cancel background work tied to this session"""
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+            self.prefetch = None
+        if self.probe is not None:
+            self.probe.cancel()
+            self.probe = None
+
+def result_mode(session, result: SearchResult) -> str:
+    return result.mode or session.mode
+
+def result_media_url(mode: str, result: SearchResult) -> str:
+    """Picture shown for a result: the full image in img mode, else the thumbnail"""
+    if mode == "img":
+        return result.image_url or result.thumbnail_url
+    return result.thumbnail_url or result.image_url
+
+def estimate_size(obj, _seen=None) -> int:
+    """Rough deep size in bytes of a session payload (dicts, lists, scalars)"""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += estimate_size(key, _seen) + estimate_size(value, _seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += estimate_size(item, _seen)
+    elif hasattr(obj, "__slots__"):
+        for name in obj.__slots__:
+            size += estimate_size(getattr(obj, name, None), _seen)
+    return size
+
+class SessionStore:
+    """Bounded LRU store of search sessions with idle expiry
+
+    Sessions are evicted least-recently-used first once either the entry
+    count or the estimated byte total goes over its limit, and dropped
+    outright after `idle_ttl` seconds without access. `on_evict` is
+    called for every session that leaves the store, whatever the reason.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, idle_ttl: float, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self.total_bytes = 0
+        # key -> [session, size, last_access]
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        now = time.monotonic()
+        if now - entry[2] > self.idle_ttl:
+            self._remove(key)
+            return default
+        entry[2] = now
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def __setitem__(self, key, session):
+        if key in self._entries:
+            self._remove(key)
+        size = estimate_size(session)
+        self._entries[key] = [session, size, time.monotonic()]
+        self.total_bytes += size
+        self._enforce_limits()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def resize(self, key, session):
+        """Re-measure a session that grew in place, if it is still stored"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] is not session:
+            return
+        size = estimate_size(session)
+        self.total_bytes += size - entry[1]
+        entry[1] = size
+        self._enforce_limits()
+
+    def grow(self, key, session, delta: int):
+        """Account for `delta` bytes a stored session gained in place"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] is not session:
+            return
+        entry[1] += delta
+        self.total_bytes += delta
+        self._enforce_limits()
+
+    def pop(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self._remove(key)
+        return entry[0]
+
+    def _remove(self, key):
+        session, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+        if self.on_evict is not None:
+            self.on_evict(key, session)
+
+    def _enforce_limits(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            log_info("Evicted search session %s (LRU)", key)
+
+    def sweep(self) -> int:
+        """Drop every session idle for longer than idle_ttl"""
+        cutoff = time.monotonic() - self.idle_ttl
+        # Entries are kept in access order, so stale ones are at the front
+        expired = []
+        for key, entry in self._entries.items():
+            if entry[2] > cutoff:
+                break
+            expired.append(key)
+        for key in expired:
+            self._remove(key)
+        return len(expired)
+
+class SlidingWindowLimiter:
+    """At most `limit` hits per `window` seconds for each key
+
+    Each key keeps a fixed-size tuple of its last `limit` hit times on the
+    monotonic clock, so a check is O(1) regardless of traffic. Keys stay in
+    last-hit order, which lets sweep() stop at the first active key.
+    """
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._hits = {}
+
+    def allows(self, key, now: float) -> bool:
+        hits = self._hits.get(key)
+        return hits is None or len(hits) < self.limit or now - hits[0] >= self.window
+
+    def record(self, key, now: float):
+        hits = self._hits.pop(key, ())
+        if len(hits) >= self.limit:
+            hits = hits[1:]
+        self._hits[key] = hits + (now,)
+
+    def refund(self, key):
+        """Give back the key's newest hit"""
+        hits = self._hits.get(key)
+        if hits is None:
+            return
+        if len(hits) > 1:
+            self._hits[key] = hits[:-1]
+        else:
+            del self._hits[key]
+
+    def sweep(self, now: float) -> int:
+        """Forget keys whose newest hit has left the window"""
+        cutoff = now - self.window
+        expired = []
+        for key, hits in self._hits.items():
+            if hits[-1] > cutoff:
+                break
+            expired.append(key)
+        for key in expired:
+            del self._hits[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._hits)
+
+def parse_rate_policy(spec: str):
+    """Parse "3/60" into a limiter; empty or "0" disables the scope"""
+    spec = spec.strip()
+    if not spec or spec == "0":
+        return None
+    limit, _, window = spec.partition("/")
+    return SlidingWindowLimiter(int(limit), float(window or 60))
+
+class RateLimiter:
+    """Per-user, per-chat and global search limits checked together
+
+    A search is only counted when every scope it falls under allows it.
+    Inline queries fall under the inline and global scopes, other searches
+    under the user, chat and global ones.
+    """
+
+    def __init__(self, user_spec: str, chat_spec: str, global_spec: str, inline_spec: str = ""):
+        self.scopes = [
+            (scope, limiter) for scope, limiter in (
+                ("user", parse_rate_policy(user_spec)),
+                ("chat", parse_rate_policy(chat_spec)),
+                ("global", parse_rate_policy(global_spec)),
+                ("inline", parse_rate_policy(inline_spec))
+            ) if limiter is not None
+        ]
+        self.search_scopes = [(scope, limiter) for scope, limiter in self.scopes if scope != "inline"]
+        self.inline_scopes = [(scope, limiter) for scope, limiter in self.scopes if scope in ("inline", "global")]
+
+    def scopes_for(self, inline: bool) -> list:
+        return self.inline_scopes if inline else self.search_scopes
+
+    def hit(self, user_id: int, chat_id: int = 0, inline: bool = False) -> bool:
+        now = time.monotonic()
+        keys = {"user": user_id, "chat": chat_id, "global": None, "inline": user_id}
+        scopes = self.inline_scopes if inline else self.search_scopes
+        for scope, limiter in scopes:
+            if not limiter.allows(keys[scope], now):
+                return False
+        for scope, limiter in scopes:
+            limiter.record(keys[scope], now)
+        return True
+
+    def refund(self, user_id: int, chat_id: int = 0, inline: bool = False):
+        """Undo a hit() that was allowed but whose search never ran"""
+        keys = {"user": user_id, "chat": chat_id, "global": None, "inline": user_id}
+        for scope, limiter in self.scopes_for(inline):
+            limiter.refund(keys[scope])
+
+    def sweep(self) -> int:
+        now = time.monotonic()
+        return sum(limiter.sweep(now) for _, limiter in self.scopes)
+
+    def __len__(self):
+        return sum(len(limiter) for _, limiter in self.scopes)
+
+class FileIdCache:
+    """LRU map of photo source URL -> Telegram file_id
+
+    Once Telegram has fetched a URL we reuse the file_id it returned, so
+    later sends of the same picture skip the download on Telegram's side.
+    """
+
+    def __init__(self, max_entries: int, path: str = ""):
+        self.max_entries = max_entries
+        self.path = path
+        self.dirty = False
+        self._entries = OrderedDict()
+
+    def get(self, url: str):
+        file_id = self._entries.get(url)
+        if file_id is not None:
+            self._entries.move_to_end(url)
+        return file_id
+
+    def remember(self, url: str, message):
+        """Store the largest photo size of a message Telegram just accepted"""
+        photos = getattr(message, "photo", None)
+        if not url or not photos:
+            return
+        file_id = photos[-1].file_id
+        if self._entries.get(url) == file_id:
+            return
+        self._entries[url] = file_id
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self.dirty = True
+
+    def forget(self, url: str):
+        if self._entries.pop(url, None) is not None:
+            self.dirty = True
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            log_warn("Ignoring unreadable file_id cache %s: %s", self.path, e)
+            return
+        for url, file_id in list(entries.items())[-self.max_entries:]:
+            self._entries[url] = file_id
+        log_info("Loaded %s cached file_ids from %s", len(self._entries), self.path)
+
+    def save(self):
+        """Write the cache atomically; run off the event loop"""
+        if not self.path or not self.dirty:
+            return
+        self.dirty = False
+        # Per process, as workers may share the file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(dict(self._entries), f)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+class ImageProber:
+    """Checks ahead of time that result picture URLs are fetchable images
+
+    Verdicts are cached with a TTL; a URL Telegram itself failed to fetch
+    is marked bad directly. Probes run with bounded concurrency and
+    identical URLs are only probed once at a time.
+    """
+
+    def __init__(self, concurrency: int, timeout: float, bad_ttl: float, good_ttl: float, max_entries: int):
+        self.timeout = timeout
+        self.bad_ttl = bad_ttl
+        self.good_ttl = good_ttl
+        self.max_entries = max_entries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # url -> (expires_at, ok)
+        self._status = OrderedDict()
+        self._inflight = {}
+        self._session = None
+
+    def verdict(self, url: str):
+        """True/False for a known URL, None when it has not been checked"""
+        entry = self._status.get(url)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._status[url]
+            return None
+        return entry[1]
+
+    def is_bad(self, url: str) -> bool:
+        return bool(url) and self.verdict(url) is False
+
+    def _record(self, url: str, ok: bool):
+        ttl = self.good_ttl if ok else self.bad_ttl
+        self._status[url] = (time.monotonic() + ttl, ok)
+        self._status.move_to_end(url)
+        while len(self._status) > self.max_entries:
+            self._status.popitem(last=False)
+        IMAGE_PROBES.inc("ok" if ok else "bad")
+
+    def mark_bad(self, url: str):
+        if url:
+            self._record(url, False)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=SERPER_DNS_TTL),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def probe(self, url: str) -> bool:
+        verdict = self.verdict(url)
+        if verdict is not None:
+            return verdict
+        task = self._inflight.get(url)
+        if task is None:
+            task = self._inflight[url] = asyncio.create_task(self._probe(url))
+        return await asyncio.shield(task)
+
+    async def _probe(self, url: str) -> bool:
+        try:
+            async with self._semaphore:
+                ok = await self._fetch_ok(url)
+            self._record(url, ok)
+            if not ok:
+                log_info("Image URL failed probe: %s", url)
+            return ok
+        finally:
+            self._inflight.pop(url, None)
+
+    async def _fetch_ok(self, url: str) -> bool:
+        session = self._get_session()
+        try:
+            async with session.head(url, allow_redirects=True) as resp:
+                if resp.status == 405:
+                    # Some hosts refuse HEAD; ask for the first byte instead
+                    async with session.get(url, headers={"Range": "bytes=0-0"}, allow_redirects=True) as resp:
+                        return self._looks_like_image(resp)
+                return self._looks_like_image(resp)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return False
+
+    @staticmethod
+    def _looks_like_image(resp: aiohttp.ClientResponse) -> bool:
+        if resp.status not in (200, 206):
+            return False
+        if not resp.headers.get("Content-Type", "").startswith("image/"):
+            return False
+        length = resp.headers.get("Content-Length")
+        if resp.status == 200 and length and length.isdigit():
+            return int(length) <= TELEGRAM_PHOTO_URL_MAX_BYTES
+        return True
+
+    def probe_ahead(self, session: SearchSession):
+        """Probe the current result and the next few in the background"""
+        if session.probe is not None:
+            return
+        end = min(len(session.results), session.index + IMAGE_PROBE_AHEAD + 1)
+        urls = []
+        for result in session.results[session.index:end]:
+            url = result_media_url(result_mode(session, result), result)
+            # Anything Telegram already gave us a file_id for is known good
+            if url and file_ids.get(url) is None and self.verdict(url) is None:
+                urls.append(url)
+        if urls:
+            session.probe = asyncio.create_task(self._probe_all(session, urls))
+
+    async def _probe_all(self, session: SearchSession, urls: list):
+        try:
+            await asyncio.gather(*(self.probe(url) for url in urls))
+        finally:
+            session.probe = None
+
+class SqliteStateStore:
+    """Write-behind SQLite persistence for sessions and query results
+
+    The hot path only records what changed; a background task serializes
+    and writes batches on a single worker thread, so handlers never wait on
+    fsync. Nothing is loaded at startup: rows are read back the first time
+    a session or query misses the in-memory caches.
+    """
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = None
+        # One thread owns the connection, which also serializes all access
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-db")
+        self._dirty_sessions = {}
+        self._dirty_queries = {}
+        self._flusher = None
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER, chat_id INTEGER, state TEXT, updated REAL, "
+            "PRIMARY KEY (user_id, chat_id))"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS queries ("
+            "mode TEXT, query TEXT, page INTEGER, results TEXT, expires REAL, "
+            "PRIMARY KEY (mode, query, page))"
+        )
+        db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+        db.execute("CREATE INDEX IF NOT EXISTS queries_expires ON queries (expires)")
+        db.commit()
+        self._db = db
+
+    async def open(self):
+        await self._run(self._open)
+        self._flusher = asyncio.create_task(self._flush_periodically())
+        log_info("State database opened at %s", self.path)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=False)
+
+    # Hot-path side: only note what changed
+    def save_session(self, session):
+        self._dirty_sessions[(session.user_id, session.chat_id)] = session
+
+    def delete_session(self, key):
+        self._dirty_sessions[key] = None
+
+    def save_query(self, key, results: tuple, ttl: float):
+        if ttl > 0:
+            self._dirty_queries[key] = (results, time.time() + ttl)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log_error("Failed to flush state database: %s", e)
+
+    async def flush(self):
+        if not self._dirty_sessions and not self._dirty_queries:
+            return
+        sessions, self._dirty_sessions = self._dirty_sessions, {}
+        queries, self._dirty_queries = self._dirty_queries, {}
+        now = time.time()
+        # Serialize on the loop, from the latest in-memory state
+        upserts = [
+            (key[0], key[1], json.dumps(session.to_dict(), ensure_ascii=False), now)
+            for key, session in sessions.items() if session is not None
+        ]
+        deletes = [key for key, session in sessions.items() if session is None]
+        query_rows = [
+            (key[0], key[1], key[2], json.dumps([r.to_row() for r in results], ensure_ascii=False), expires)
+            for key, (results, expires) in queries.items()
+        ]
+        await self._run(self._write, upserts, deletes, query_rows)
+
+    def _write(self, upserts, deletes, query_rows):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)", upserts)
+            self._db.executemany("DELETE FROM sessions WHERE user_id = ? AND chat_id = ?", deletes)
+            self._db.executemany("INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?)", query_rows)
+
+    # Lazy reads on in-memory cache misses
+    async def load_session(self, key):
+        if key in self._dirty_sessions:
+            return self._dirty_sessions[key]
+        row = await self._run(self._read_session, key)
+        if row is None:
+            return None
+        state, updated = row
+        if time.time() - updated > SESSION_PERSIST_TTL:
+            return None
+        return SearchSession.from_dict(key[0], key[1], json.loads(state))
+
+    def _read_session(self, key):
+        return self._db.execute(
+            "SELECT state, updated FROM sessions WHERE user_id = ? AND chat_id = ?", key
+        ).fetchone()
+
+    async def load_query(self, key):
+        pending = self._dirty_queries.get(key)
+        if pending is not None:
+            return pending[0]
+        row = await self._run(self._read_query, key)
+        if row is None or row[1] <= time.time():
+            return None
+        return tuple(SearchResult(*fields) for fields in json.loads(row[0]))
+
+    def _read_query(self, key):
+        return self._db.execute(
+            "SELECT results, expires FROM queries WHERE mode = ? AND query = ? AND page = ?", key
+        ).fetchone()
+
+    # Small bookkeeping values, written straight through
+    async def load_meta(self, name: str):
+        row = await self._run(self._read_meta, name)
+        return row[0] if row is not None else None
+
+    def _read_meta(self, name: str):
+        return self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+
+    async def save_meta(self, name: str, value: str):
+        await self._run(self._write_meta, name, value)
+
+    def _write_meta(self, name: str, value: str):
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+
+    async def sweep(self) -> int:
+        """Delete expired query rows and sessions older than SESSION_PERSIST_TTL"""
+        return await self._run(self._sweep, time.time())
+
+    def _sweep(self, now: float) -> int:
+        with self._db:
+            removed = self._db.execute("DELETE FROM queries WHERE expires <= ?", (now,)).rowcount
+            removed += self._db.execute(
+                "DELETE FROM sessions WHERE updated < ?", (now - SESSION_PERSIST_TTL,)
+            ).rowcount
+        return removed
+
+class RedisError(Exception):
+    """Error reply from the Redis server"""
+
+class RedisClient:
+    """Minimal RESP2 client over one connection
+
+    Commands are sent in pipelines: one write, then one read per reply, so a
+    batch costs a single round-trip. Callers take turns on the connection; it
+    is dropped and reopened after any failure mid-reply.
+    """
+
+    def __init__(self, url: str, timeout: float):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = urllib.parse.unquote(parsed.username) if parsed.username else None
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.ssl = parsed.scheme == "rediss"
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def encode(command) -> bytes:
+        parts = [b"*%d\r\n" % len(command)]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Redis closed the connection")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            # Returned, not raised, so one bad command does not hide the rest
+            return RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if kind == b"*":
+            count = int(payload)
+            if count < 0:
+                return None
+            return [await self._read_reply() for _ in range(count)]
+        raise ConnectionError(f"Unexpected Redis reply {line[:40]!r}")
+
+    async def _roundtrip(self, commands) -> list:
+        self._writer.write(b"".join(self.encode(command) for command in commands))
+        await self._writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl or None)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        for reply in await self._roundtrip(setup) if setup else ():
+            if isinstance(reply, RedisError):
+                raise reply
+
+    def _drop(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _send(self, commands) -> list:
+        if self._writer is None:
+            await self._connect()
+        return await self._roundtrip(commands)
+
+    async def pipeline(self, *commands) -> list:
+        """Run commands in one round-trip; failed ones come back as RedisError"""
+        async with self._lock:
+            try:
+                return await asyncio.wait_for(self._send(commands), self.timeout)
+            except BaseException:
+                # Replies may be half-read; never reuse the stream
+                self._drop()
+                raise
+
+    async def execute(self, *command):
+        reply = (await self.pipeline(command))[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def close(self):
+        async with self._lock:
+            self._drop()
+
+class StateBackend(abc.ABC):
+    """Where sessions, cached query results and rate-limit counters live
+
+    Every backend also keeps sessions in the process-local SessionStore, which
+    holds what cannot be shared (prefetch tasks, renders). Writes are queued
+    and return immediately; reads are awaited.
+    """
+
+    # True when begin_search() also looks up cached first-page results
+    pipelines_query_lookup = False
+
+    def __init__(self, sessions: SessionStore, limiter: RateLimiter):
+        self.sessions = sessions
+        self.limiter = limiter
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    async def begin_search(self, user_id: int, chat_id: int, query_key, inline: bool = False):
+        """Count a search against the rate limits; returns (allowed, results or None)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def refund_search(self, user_id: int, chat_id: int, inline: bool = False):
+        """Give back what begin_search() counted, for a search turned away before it ran"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def load_session(self, key):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_session(self, session):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_session(self, key):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def load_query(self, key):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_query(self, key, results: tuple, ttl: float):
+        raise NotImplementedError
+
+    async def load_meta(self, name: str):
+        """Bookkeeping value kept across restarts, or None"""
+        return None
+
+    async def save_meta(self, name: str, value: str):
+        pass
+
+    async def sweep(self) -> int:
+        return 0
+
+class LocalStateBackend(StateBackend):
+    """Single-process state: memory, plus the SQLite store when configured"""
+
+    def __init__(self, sessions: SessionStore, limiter: RateLimiter, db: SqliteStateStore = None):
+        super().__init__(sessions, limiter)
+        self.db = db
+
+    async def open(self):
+        if self.db is not None:
+            await self.db.open()
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+
+    async def begin_search(self, user_id: int, chat_id: int, query_key, inline: bool = False):
+        return self.limiter.hit(user_id, chat_id, inline), None
+
+    async def refund_search(self, user_id: int, chat_id: int, inline: bool = False):
+        self.limiter.refund(user_id, chat_id, inline)
+
+    async def load_session(self, key):
+        session = self.sessions.get(key)
+        if session is None and self.db is not None:
+            session = await self.db.load_session(key)
+            if session is not None:
+                self.sessions[key] = session
+                log_info("Restored search session %s from the state database", key)
+        return session
+
+    def save_session(self, session):
+        if self.db is not None:
+            self.db.save_session(session)
+
+    def delete_session(self, key):
+        self.sessions.pop(key)
+        if self.db is not None:
+            self.db.delete_session(key)
+
+    async def load_query(self, key):
+        if self.db is None:
+            return None
+        return await self.db.load_query(key)
+
+    def save_query(self, key, results: tuple, ttl: float):
+        if self.db is not None:
+            self.db.save_query(key, results, ttl)
+
+    async def load_meta(self, name: str):
+        if self.db is None:
+            return None
+        return await self.db.load_meta(name)
+
+    async def save_meta(self, name: str, value: str):
+        if self.db is not None:
+            await self.db.save_meta(name, value)
+
+    async def sweep(self) -> int:
+        if self.db is None:
+            return 0
+        return await self.db.sweep()
+
+# Sliding-window check-and-increment over every scope at once. KEYS are the
+# scope keys; ARGV is now (ms), a unique member, then limit and window (ms)
+# for each key. Returns 1 and records the hit only if all scopes allow it.
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - tonumber(ARGV[2 * i + 2]))
+    if redis.call('ZCARD', key) >= tonumber(ARGV[2 * i + 1]) then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[2])
+    redis.call('PEXPIRE', key, ARGV[2 * i + 2])
+end
+return 1
+"""
+
+class RedisStateBackend(StateBackend):
+    """State shared between workers through a Redis-protocol server
+
+    A search's rate check and first-page cache lookup go out in one pipeline.
+    Session and query writes are queued and flushed together on the next loop
+    iteration. Redis key expiry replaces sweeping. When the server cannot be
+    reached, searches are counted by this process's limiter and reads miss,
+    so the bot degrades to per-process behaviour instead of failing.
+    """
+
+    pipelines_query_lookup = True
+
+    def __init__(self, sessions: SessionStore, limiter: RateLimiter, url: str, prefix: str, timeout: float):
+        super().__init__(sessions, limiter)
+        self.client = RedisClient(url, timeout)
+        self.prefix = prefix
+        self._member_ids = itertools.count()
+        self._dirty_sessions = {}
+        self._dirty_queries = {}
+        self._flusher = None
+
+    def _session_key(self, key) -> str:
+        return f"{self.prefix}session:{key[0]}:{key[1]}"
+
+    def _query_key(self, key) -> str:
+        mode, query, page = key
+        return f"{self.prefix}query:{mode}:{page}:{query}"
+
+    async def open(self):
+        try:
+            await self.client.execute("PING")
+            log_info("Connected to shared state at %s:%s", self.client.host, self.client.port)
+        except Exception as e:
+            STATE_BACKEND_ERRORS.inc("open")
+            log_error("Shared state backend unreachable, will retry on use: %s", e)
+
+    async def close(self):
+        if self._flusher is not None:
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.client.close()
+
+    def _rate_limit_keys(self, user_id: int, chat_id: int, inline: bool) -> list:
+        ids = {"user": user_id, "chat": chat_id, "global": "", "inline": user_id}
+        return [f"{self.prefix}rate:{scope}:{ids[scope]}" for scope, _ in self.limiter.scopes_for(inline)]
+
+    def _rate_limit_command(self, user_id: int, chat_id: int, inline: bool):
+        scopes = self.limiter.scopes_for(inline)
+        keys = self._rate_limit_keys(user_id, chat_id, inline)
+        args = []
+        for _, limiter in scopes:
+            args += [limiter.limit, int(limiter.window * 1000)]
+        now = int(time.time() * 1000)
+        member = f"{now}:{os.getpid()}:{next(self._member_ids)}"
+        return ("EVAL", RATE_LIMIT_SCRIPT, len(keys), *keys, now, member, *args)
+
+    async def begin_search(self, user_id: int, chat_id: int, query_key, inline: bool = False):
+        commands = [("GET", self._query_key(query_key))]
+        if self.limiter.scopes_for(inline):
+            commands.append(self._rate_limit_command(user_id, chat_id, inline))
+        try:
+            replies = await self.client.pipeline(*commands)
+        except Exception as e:
+            STATE_BACKEND_ERRORS.inc("begin_search")
+            log_error("Shared rate limit check failed, counting the search locally: %s", e)
+            return self.limiter.hit(user_id, chat_id, inline), None
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                STATE_BACKEND_ERRORS.inc("begin_search")
+                log_error("Shared state backend rejected a command: %s", reply)
+        if len(replies) < 2:
+            allowed = True
+        elif isinstance(replies[1], RedisError):
+            allowed = self.limiter.hit(user_id, chat_id, inline)
+        else:
+            allowed = replies[1] != 0
+        results = self._decode_results(replies[0])
+        return allowed, results
+
+    async def refund_search(self, user_id: int, chat_id: int, inline: bool = False):
+        # The newest hit in each window: ours or a later one, the count is the same
+        commands = [("ZPOPMAX", key) for key in self._rate_limit_keys(user_id, chat_id, inline)]
+        if not commands:
+            return
+        try:
+            replies = await self.client.pipeline(*commands)
+        except Exception as e:
+            STATE_BACKEND_ERRORS.inc("refund_search")
+            log_error("Failed to refund a rate-limited search in shared state: %s", e)
+            # Most likely counted locally too, while the server was away
+            self.limiter.refund(user_id, chat_id, inline)
+            return
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                STATE_BACKEND_ERRORS.inc("refund_search")
+                log_error("Shared state backend rejected a command: %s", reply)
+
+    @staticmethod
+    def _decode_results(raw):
+        if not isinstance(raw, (bytes, str)):
+            return None
+        return tuple(SearchResult(*fields) for fields in json.loads(raw))
+
+    async def load_session(self, key):
+        local = self.sessions.get(key)
+        if key in self._dirty_sessions:
+            # Written here and not flushed yet, so this process is newest
+            return self._dirty_sessions[key]
+        try:
+            raw = await self.client.execute("GET", self._session_key(key))
+        except Exception as e:
+            STATE_BACKEND_ERRORS.inc("load_session")
+            log_error("Failed to load session %s from shared state: %s", key, e)
+            return local
+        if raw is None:
+            # Closed or expired elsewhere
+            self.sessions.pop(key)
+            return None
+        state = json.loads(raw)
+        if (
+            local is not None and local.mode == state["mode"] and local.query == state["query"]
+            and local.timestamp == state["timestamp"] and local.message_id == state.get("message_id")
+            and local.pages_loaded >= state.get("pages_loaded", 1)
+        ):
+            # Same search as the local copy: keep its tasks and renders, and
+            # take the position only if another worker moved it since. A reply
+            # read before our own write landed must not undo a local step.
+            if state.get("version", 0) > local.version:
+                local.index = state["index"]
+                local.album = state.get("album")
+                local.version = state["version"]
+            return local
+        session = SearchSession.from_dict(key[0], key[1], state)
+        self.sessions[key] = session
+        return session
+
+    def save_session(self, session):
+        self._dirty_sessions[(session.user_id, session.chat_id)] = session
+        self._schedule_flush()
+
+    def delete_session(self, key):
+        self.sessions.pop(key)
+        self._dirty_sessions[key] = None
+        self._schedule_flush()
+
+    async def load_query(self, key):
+        pending = self._dirty_queries.get(key)
+        if pending is not None:
+            return pending[0]
+        try:
+            return self._decode_results(await self.client.execute("GET", self._query_key(key)))
+        except Exception as e:
+            STATE_BACKEND_ERRORS.inc("load_query")
+            log_error("Failed to load cached query from shared state: %s", e)
+            return None
+
+    def save_query(self, key, results: tuple, ttl: float):
+        if ttl > 0:
+            self._dirty_queries[key] = (results, ttl)
+            self._schedule_flush()
+
+    async def load_meta(self, name: str):
+        try:
+            value = await self.client.execute("GET", f"{self.prefix}meta:{name}")
+        except Exception as e:
+            STATE_BACKEND_ERRORS.inc("load_meta")
+            log_warn("Failed to read %s from shared state: %s", name, e)
+            return None
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def save_meta(self, name: str, value: str):
+        try:
+            await self.client.execute("SET", f"{self.prefix}meta:{name}", value)
+        except Exception as e:
+            STATE_BACKEND_ERRORS.inc("save_meta")
+            log_warn("Failed to store %s in shared state: %s", name, e)
+
+    def _schedule_flush(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        # Let the current handler finish queueing writes so they share a pipeline
+        await asyncio.sleep(0)
+        try:
+            while self._dirty_sessions or self._dirty_queries:
+                sessions, self._dirty_sessions = self._dirty_sessions, {}
+                queries, self._dirty_queries = self._dirty_queries, {}
+                commands = []
+                for key, session in sessions.items():
+                    if session is None:
+                        commands.append(("DEL", self._session_key(key)))
+                    else:
+                        commands.append((
+                            "SET", self._session_key(key), json.dumps(session.to_dict(), ensure_ascii=False),
+                            "EX", max(1, int(SESSION_PERSIST_TTL))
+                        ))
+                for key, (results, ttl) in queries.items():
+                    commands.append((
+                        "SET", self._query_key(key), json.dumps([r.to_row() for r in results], ensure_ascii=False),
+                        "EX", max(1, int(ttl))
+                    ))
+                try:
+                    replies = await self.client.pipeline(*commands)
+                except Exception as e:
+                    STATE_BACKEND_ERRORS.inc("flush")
+                    log_error("Failed to write %s changes to shared state: %s", len(commands), e)
+                    continue
+                for reply in replies:
+                    if isinstance(reply, RedisError):
+                        STATE_BACKEND_ERRORS.inc("flush")
+                        log_error("Shared state backend rejected a write: %s", reply)
+        finally:
+            self._flusher = None
+
+# Cache keyed by (user_id, chat_id) - each user has isolated sessions per chat
+user_search_cache = SessionStore(
+    SESSION_MAX_ENTRIES, SESSION_MAX_BYTES, SESSION_IDLE_TTL,
+    on_evict=lambda key, session: session.close()
+)
+# On-disk copy of sessions and query results, when STATE_DB_PATH is set
+state_db = SqliteStateStore(STATE_DB_PATH, STATE_FLUSH_INTERVAL) if STATE_DB_PATH and not REDIS_URL else None
+# Photo URL -> Telegram file_id, shared by /start and search results
+file_ids = FileIdCache(FILE_ID_CACHE_SIZE, FILE_ID_CACHE_PATH)
+# Known-good/known-bad result picture URLs
+image_prober = ImageProber(
+    IMAGE_PROBE_CONCURRENCY, IMAGE_PROBE_TIMEOUT, IMAGE_BAD_TTL, IMAGE_GOOD_TTL, IMAGE_STATUS_MAX_ENTRIES
+)
+# Rate limit keyed by user_id for both private and group chats
+rate_limit = RateLimiter(RATE_LIMIT_USER, RATE_LIMIT_CHAT, RATE_LIMIT_GLOBAL, RATE_LIMIT_INLINE)
+# Sessions, cached query results and rate limits, shared across workers with REDIS_URL
+if REDIS_URL:
+    state_backend = RedisStateBackend(user_search_cache, rate_limit, REDIS_URL, REDIS_KEY_PREFIX, REDIS_TIMEOUT)
+else:
+    state_backend = LocalStateBackend(user_search_cache, rate_limit, state_db)
+
+metrics.register(Gauge(
+    "dummypawn_session_cache_entries", "Search sessions held in memory",
+    callback=lambda: len(user_search_cache)
+))
+metrics.register(Gauge(
+    "dummypawn_session_cache_bytes", "Estimated bytes held by search sessions",
+    callback=lambda: user_search_cache.total_bytes
+))
+# Shared Serper client, created in main() and reused by every search
+serper_session = None
+
+# Callback data: "v1" + unpadded base64 of (action code, user_id, chat_id)
+# packed as big-endian unsigned byte + two signed 64-bit ints. 25 bytes in all,
+# well inside Telegram's 64-byte callback_data limit. callback_data may hold
+# any characters, so the standard alphabet is used: it decodes without the
+# translate step of the URL-safe variant.
+CALLBACK_PREFIX = "v1"
+CALLBACK_LAYOUT = struct.Struct(">Bqq")
+CALLBACK_DATA_MAX_BYTES = 64
+
+ACTION_PREV = 1
+ACTION_NEXT = 2
+ACTION_CLOSE = 3
+ACTION_HELP_EXPAND = 4
+ACTION_HELP_MINIMIZE = 5
+ACTION_ALBUM = 6
+ACTION_ALBUM_PREV = 7
+ACTION_ALBUM_NEXT = 8
+
+# Buttons sent before the packed format used "<action>_<user_id>_<chat_id>"
+LEGACY_CALLBACK_ACTIONS = {
+    "prev": ACTION_PREV,
+    "next": ACTION_NEXT,
+    "close": ACTION_CLOSE,
+    "help_expand": ACTION_HELP_EXPAND,
+    "help_minimize": ACTION_HELP_MINIMIZE
+}
+
+class CallbackArgs:
+    """Decoded callback_data"""
+    __slots__ = ("action", "user_id", "chat_id")
+
+    def __init__(self, action: int, user_id: int, chat_id: int):
+        self.action = action
+        self.user_id = user_id
+        self.chat_id = chat_id
+
+def encode_callback(action: int, user_id: int, chat_id: int) -> str:
+    packed = base64.b64encode(CALLBACK_LAYOUT.pack(action, user_id, chat_id))
+    return CALLBACK_PREFIX + packed.rstrip(b"=").decode()
+
+def decode_callback(data: str):
+    """CallbackArgs for our buttons, None for foreign data
+
+    Raises ValueError for data in one of our formats that does not parse.
+    """
+    if data.startswith(CALLBACK_PREFIX):
+        try:
+            packed = binascii.a2b_base64(data[len(CALLBACK_PREFIX):] + "=")
+            return CallbackArgs(*CALLBACK_LAYOUT.unpack(packed))
+        except (struct.error, binascii.Error) as e:
+            raise ValueError(f"Malformed callback data {data!r}") from e
+    name, _, ids = data.rpartition("_")
+    name, _, user_id = name.rpartition("_")
+    action = LEGACY_CALLBACK_ACTIONS.get(name)
+    if action is None:
+        return None
+    return CallbackArgs(action, int(user_id), int(ids))
+
+# Fail at import, not on a user's tap, if the layout ever outgrows the limit
+if len(encode_callback(255, -2 ** 63, -2 ** 63).encode()) > CALLBACK_DATA_MAX_BYTES:
+    raise RuntimeError("Packed callback data exceeds Telegram's 64-byte limit")
+
+def get_help_keyboard(user_id: int, chat_id: int, is_expanded: bool = False):
+    """Generate help keyboard with expand/minimize button"""
+    if is_expanded:
+        callback_data = encode_callback(ACTION_HELP_MINIMIZE, user_id, chat_id)
+        button_text = BUTTON_TEXTS["minimize"]
+    else:
+        callback_data = encode_callback(ACTION_HELP_EXPAND, user_id, chat_id)
+        button_text = BUTTON_TEXTS["expand"]
+    
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=button_text, callback_data=callback_data)
+        ]
+    ])
+
+def get_inline_keyboard(user_id: int, chat_id: int, album: bool = False):
+    """Generate inline keyboard with callback_data including user_id and chat_id"""
+    log_debug("Generating inline keyboard for user_id=%s, chat_id=%s", user_id, chat_id)
+    last_row = [InlineKeyboardButton(text=BUTTON_TEXTS["close"], callback_data=encode_callback(ACTION_CLOSE, user_id, chat_id))]
+    if album:
+        last_row.insert(0, InlineKeyboardButton(text=BUTTON_TEXTS["album"], callback_data=encode_callback(ACTION_ALBUM, user_id, chat_id)))
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=BUTTON_TEXTS["previous"], callback_data=encode_callback(ACTION_PREV, user_id, chat_id)),
+            InlineKeyboardButton(text=BUTTON_TEXTS["next"], callback_data=encode_callback(ACTION_NEXT, user_id, chat_id))
+        ],
+        last_row
+    ])
+
+def get_album_keyboard(user_id: int, chat_id: int):
+    """Controls sent under an album; media groups cannot carry buttons themselves"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=BUTTON_TEXTS["previous"], callback_data=encode_callback(ACTION_ALBUM_PREV, user_id, chat_id)),
+            InlineKeyboardButton(text=BUTTON_TEXTS["next"], callback_data=encode_callback(ACTION_ALBUM_NEXT, user_id, chat_id))
+        ],
+        [
+            InlineKeyboardButton(text=BUTTON_TEXTS["close"], callback_data=encode_callback(ACTION_CLOSE, user_id, chat_id))
+        ]
+    ])
+
+def create_serper_session() -> aiohttp.ClientSession:
+    """Create the pooled keep-alive session used for all Serper calls"""
+    connector = aiohttp.TCPConnector(
+        limit=SERPER_POOL_SIZE,
+        limit_per_host=SERPER_POOL_SIZE,
+        keepalive_timeout=SERPER_KEEPALIVE,
+        ttl_dns_cache=SERPER_DNS_TTL,
+        use_dns_cache=True
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=SERPER_TOTAL_TIMEOUT,
+        connect=SERPER_CONNECT_TIMEOUT,
+        sock_read=SERPER_READ_TIMEOUT
+    )
+    headers = {"X-API-KEY": SERPER_API_KEY, "Content-Type": "application/json"}
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+
+def get_serper_session() -> aiohttp.ClientSession:
+    """Return the shared Serper session, creating it lazily if main() has not"""
+    global serper_session
+    if serper_session is None or serper_session.closed:
+        serper_session = create_serper_session()
+    return serper_session
+
+async def close_serper_session():
+    """Close the shared Serper session and release pooled connections"""
+    global serper_session
+    if serper_session is not None and not serper_session.closed:
+        await serper_session.close()
+    serper_session = None
+
+# Result rendering shared by the first send and every Next/Previous edit
+CAPTION_FORMATTERS = {name: template.format for name, template in CAPTION_TEMPLATES.items()}
+# Renders memoized per session: the one just made and this many either side
+RENDER_MEMO_RADIUS = 2
+
+class RenderedResult:
+    """Ready-to-send payload for one result; empty media_url means text only"""
+    __slots__ = ("caption", "media_url", "keyboard")
+
+    def __init__(self, caption: str, media_url: str, keyboard: InlineKeyboardMarkup):
+        self.caption = caption
+        self.media_url = media_url
+        self.keyboard = keyboard
+
+def rendered_size(rendered: RenderedResult) -> int:
+    """Bytes a memoized render adds to its session, which already holds the keyboard and URL"""
+    return estimate_size(rendered, {id(rendered.keyboard), id(rendered.media_url)})
+
+def render_result(session: SearchSession, index: int) -> RenderedResult:
+    """Render result `index` of a session, memoized on the session
+
+    Only renders near `index` are kept, and the store is told how much the
+    session grew, so its byte budget covers them.
+    """
+    rendered = session.rendered.get(index)
+    if rendered is not None and not image_prober.is_bad(rendered.media_url):
+        return rendered
+
+    grown = 0
+    if session.keyboard is None:
+        session.keyboard = get_inline_keyboard(session.user_id, session.chat_id, album=session.mode == "img")
+        grown += estimate_size(session.keyboard)
+    result = session.results[index]
+    mode = result_mode(session, result)
+    fields = {
+        "emoji": MODE_EMOJIS.get(mode, "🔍"),
+        "position": index + 1,
+        "total": len(session.results) if session.exhausted else f"{len(session.results)}+",
+        "query": html.escape(session.query),
+        "session": session.timestamp
+    }
+    if mode == "img":
+        caption = CAPTION_FORMATTERS["img"](title=html.escape(result.title), **fields)
+    else:
+        caption = CAPTION_FORMATTERS["default"](
+            link=html.escape(result.link, quote=True),
+            title=html.escape(result.title or "No Title"),
+            snippet=html.escape(result.snippet or "No description available."),
+            **fields
+        )
+    media_url = result_media_url(mode, result)
+    if image_prober.is_bad(media_url):
+        # Dead or non-image picture: fall back to a text-only result
+        media_url = ""
+    rendered = RenderedResult(caption, media_url, session.keyboard)
+    memo = session.rendered
+    stale = memo.get(index)
+    if stale is not None:
+        grown -= rendered_size(stale)
+    memo[index] = rendered
+    grown += rendered_size(rendered)
+    if len(memo) > 2 * RENDER_MEMO_RADIUS + 1:
+        for far in [i for i in memo if abs(i - index) > RENDER_MEMO_RADIUS]:
+            grown -= rendered_size(memo.pop(far))
+    user_search_cache.grow((session.user_id, session.chat_id), session, grown)
+    return rendered
+
+def render_inline_result(mode: str, query: str, result: SearchResult, result_id: str):
+    """One inline answer: a photo in img mode, else an article linking the hit"""
+    emoji = MODE_EMOJIS.get(mode, "🔍")
+    title = result.title or "No Title"
+    if mode == "img":
+        photo_url = result_media_url(mode, result)
+        if not photo_url or image_prober.is_bad(photo_url):
+            return None
+        return types.InlineQueryResultPhoto(
+            id=result_id,
+            photo_url=photo_url,
+            thumbnail_url=result.thumbnail_url or photo_url,
+            title=title,
+            caption=CAPTION_FORMATTERS["inline_img"](
+                emoji=emoji, title=html.escape(title), query=html.escape(query)
+            )
+        )
+    caption = CAPTION_FORMATTERS["inline"](
+        emoji=emoji,
+        link=html.escape(result.link, quote=True),
+        title=html.escape(title),
+        snippet=html.escape(result.snippet or "No description available."),
+        query=html.escape(query)
+    )
+    return types.InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        description=result.snippet or None,
+        url=result.link or None,
+        thumbnail_url=result.thumbnail_url or result.image_url or None,
+        input_message_content=types.InputTextMessageContent(message_text=caption)
+    )
+
+async def answer_photo_cached(msg: types.Message, url: str, **kwargs) -> types.Message:
+    """answer_photo that sends a known file_id instead of the URL when it can"""
+    file_id = file_ids.get(url)
+    if file_id is not None:
+        try:
+            return await msg.answer_photo(file_id, **kwargs)
+        except TelegramBadRequest as e:
+            log_warn("Cached file_id for %s rejected, resending by URL: %s", url, e)
+            file_ids.forget(url)
+    sent = await msg.answer_photo(url, **kwargs)
+    file_ids.remember(url, sent)
+    return sent
+
+async def edit_photo_cached(message: types.Message, url: str, caption: str, reply_markup=None):
+    """edit_media counterpart of answer_photo_cached"""
+    file_id = file_ids.get(url)
+    if file_id is not None:
+        try:
+            return await message.edit_media(
+                types.InputMediaPhoto(media=file_id, caption=caption),
+                reply_markup=reply_markup
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                raise
+            log_warn("Cached file_id for %s rejected, resending by URL: %s", url, e)
+            file_ids.forget(url)
+    edited = await message.edit_media(
+        types.InputMediaPhoto(media=url, caption=caption),
+        reply_markup=reply_markup
+    )
+    file_ids.remember(url, edited)
+    return edited
+
+async def warm_file_ids():
+    """Upload the start images once so /start can send them by file_id"""
+    chat_id = int(FILE_ID_WARMUP_CHAT_ID)
+    warmed = 0
+    for url in IMAGES:
+        if file_ids.get(url) is not None:
+            continue
+        try:
+            sent = await bot.send_photo(chat_id, url, disable_notification=True)
+            file_ids.remember(url, sent)
+            warmed += 1
+            await sent.delete()
+        except Exception as e:
+            log_warn("Failed to warm file_id for %s: %s", url, e)
+    await asyncio.to_thread(file_ids.save)
+    log_success("Warmed %s start image file_ids", warmed)
+
+async def send_rendered(msg: types.Message, payload: RenderedResult, **kwargs) -> types.Message:
+    """Send a rendered result, falling back to text if Telegram rejects the picture"""
+    if payload.media_url:
+        try:
+            return await answer_photo_cached(msg, payload.media_url, caption=payload.caption, reply_markup=payload.keyboard, **kwargs)
+        except TelegramBadRequest as e:
+            log_warn("Photo %s rejected, sending text instead: %s", payload.media_url, e)
+            image_prober.mark_bad(payload.media_url)
+    return await msg.answer(payload.caption, reply_markup=payload.keyboard, **kwargs)
+
+async def edit_rendered(message: types.Message, payload: RenderedResult):
+    """Edit a result message in place to show another rendered result
+
+    Photo messages can only become other photos, so a missing or rejected
+    picture keeps the old one and updates the caption; text messages stay text.
+    """
+    if message.photo:
+        if payload.media_url:
+            try:
+                return await edit_photo_cached(message, payload.media_url, payload.caption, reply_markup=payload.keyboard)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    raise
+                log_warn("Photo %s rejected, updating caption only: %s", payload.media_url, e)
+                image_prober.mark_bad(payload.media_url)
+        return await message.edit_caption(caption=payload.caption, reply_markup=payload.keyboard)
+    return await message.edit_text(payload.caption, reply_markup=payload.keyboard)
+
+async def step_index(session: SearchSession, index: int, step: int):
+    """Index of the next result in direction `step`, or None past either end
+
+    Image results whose picture is known to be bad are skipped, loading
+    later Serper pages as needed.
+    """
+    new_index = index + step
+    while new_index >= 0:
+        if new_index >= len(session.results):
+            if session.exhausted:
+                return None
+            # Usually already prefetched; otherwise wait for the next page
+            loaded = len(session.results)
+            await load_next_page(session)
+            if len(session.results) == loaded:
+                return None
+            continue
+        result = session.results[new_index]
+        if result_mode(session, result) != "img" or not image_prober.is_bad(result_media_url("img", result)):
+            return new_index
+        new_index += step
+    return None
+
+async def collect_album(session: SearchSession, start: int, step: int) -> list:
+    """Indices of up to ALBUM_SIZE showable pictures from `start` in direction `step`
+
+    Known-bad pictures are skipped; going forward loads later pages as needed.
+    """
+    indices = []
+    index = start
+    while len(indices) < ALBUM_SIZE and index >= 0:
+        if index >= len(session.results):
+            if session.exhausted:
+                break
+            loaded = len(session.results)
+            await load_next_page(session)
+            if len(session.results) == loaded:
+                break
+            continue
+        result = session.results[index]
+        url = result_media_url(result_mode(session, result), result)
+        if url and not image_prober.is_bad(url):
+            indices.append(index)
+        index += step
+    return sorted(indices)
+
+def render_album(session: SearchSession, indices: list, use_file_ids: bool = True):
+    """Media group items, their source URLs, and the controls text for an album"""
+    total = len(session.results) if session.exhausted else f"{len(session.results)}+"
+    media = []
+    urls = []
+    for index in indices:
+        result = session.results[index]
+        mode = result_mode(session, result)
+        url = result_media_url(mode, result)
+        urls.append(url)
+        media.append(types.InputMediaPhoto(
+            media=(file_ids.get(url) if use_file_ids else None) or url,
+            caption=CAPTION_FORMATTERS["album_item"](
+                emoji=MODE_EMOJIS.get(mode, "🔍"),
+                title=html.escape(result.title or "No Title"),
+                position=index + 1,
+                total=total
+            )
+        ))
+    text = CAPTION_FORMATTERS["album"](
+        query=html.escape(session.query),
+        first=indices[0] + 1,
+        last=indices[-1] + 1,
+        total=total,
+        session=session.timestamp
+    )
+    return media, urls, text
+
+async def send_album(message: types.Message, session: SearchSession, indices: list, **kwargs) -> types.Message:
+    """Send pictures `indices` as one media group, then the controls message
+
+    One bad picture fails a whole media group, so on rejection every picture
+    is probed and the survivors are sent by URL once more. The session moves
+    to album view; its message is the controls message.
+    """
+    media, urls, text = render_album(session, indices)
+    try:
+        if len(media) == 1:
+            sent = [await answer_photo_cached(message, urls[0], caption=media[0].caption, **kwargs)]
+        else:
+            sent = await message.answer_media_group(media, **kwargs)
+    except TelegramBadRequest as e:
+        log_warn("Album for '%s' rejected, probing its pictures: %s", session.query, e)
+        for url in urls:
+            file_ids.forget(url)
+        verdicts = await asyncio.gather(*(image_prober.probe(url) for url in urls))
+        indices = [index for index, ok in zip(indices, verdicts) if ok]
+        if len(indices) < 2:
+            raise
+        media, urls, text = render_album(session, indices, use_file_ids=False)
+        sent = await message.answer_media_group(media, **kwargs)
+    for url, item in zip(urls, sent):
+        file_ids.remember(url, item)
+    controls = await message.answer(text, reply_markup=get_album_keyboard(session.user_id, session.chat_id))
+    session.album = [indices[0], indices[-1], [item.message_id for item in sent]]
+    # Prefetch and probing look ahead from the last picture shown
+    session.index = indices[-1]
+    session.message_id = controls.message_id
+    session.shown = None
+    return controls
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker
+
+    After `threshold` failures in a row the circuit opens and calls fail
+    fast for `cooldown` seconds; then a single trial call is let through
+    (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            log_success("Serper circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.state != "open":
+                log_warn("Serper circuit opened after %s failures", self.failures)
+            self.opened_at = time.monotonic()
+
+class LatencyWindow:
+    """Recent successful-call latencies, for hedging delays"""
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float):
+        if len(self.samples) < SERPER_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+serper_breaker = CircuitBreaker(SERPER_BREAKER_THRESHOLD, SERPER_BREAKER_COOLDOWN)
+serper_latency = LatencyWindow()
+metrics.register(Gauge(
+    "dummypawn_serper_circuit_open", "1 while the Serper circuit breaker is open or half-open",
+    callback=lambda: int(serper_breaker.state != "closed")
+))
+
+class SerperAttempt:
+    """Outcome of one HTTP call to Serper"""
+    __slots__ = ("status", "data", "retryable", "retry_after")
+
+    def __init__(self, status: str, data=None, retryable: bool = False, retry_after: float = 0.0):
+        self.status = status
+        self.data = data
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+async def serper_post(mode: str, url: str, payload: dict) -> SerperAttempt:
+    """One POST to Serper, timed and classified; never raises except on cancel"""
+    started = time.perf_counter()
+    attempt = SerperAttempt("error", retryable=True)
+    try:
+        session = get_serper_session()
+        async with session.post(url, json=payload) as resp:
+            if resp.status == 200:
+                attempt = SerperAttempt("200", await resp.json())
+                serper_latency.add(time.perf_counter() - started)
+            else:
+                retry_after = resp.headers.get("Retry-After", "")
+                attempt = SerperAttempt(
+                    str(resp.status),
+                    retryable=resp.status in SERPER_RETRYABLE_STATUSES,
+                    retry_after=float(retry_after) if retry_after.isdigit() else 0.0
+                )
+    except asyncio.TimeoutError:
+        attempt = SerperAttempt("timeout", retryable=True)
+    except (aiohttp.ClientError, ValueError) as e:
+        log_warn("Serper request error: %s", e)
+    finally:
+        SERPER_LATENCY.observe(time.perf_counter() - started, mode, attempt.status)
+    return attempt
+
+async def serper_post_hedged(mode: str, url: str, payload: dict) -> SerperAttempt:
+    """serper_post, plus a backup request if the first is slower than p95"""
+    hedge_after = serper_latency.quantile(0.95) if SERPER_HEDGE else None
+    if hedge_after is None:
+        return await serper_post(mode, url, payload)
+
+    tasks = {asyncio.create_task(serper_post(mode, url, payload))}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=max(hedge_after, SERPER_HEDGE_MIN_DELAY))
+        if not done:
+            SERPER_HEDGES.inc(mode)
+            tasks.add(asyncio.create_task(serper_post(mode, url, payload)))
+        attempt = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                attempt = task.result()
+                if attempt.data is not None:
+                    return attempt
+        return attempt
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def backoff_delay(attempt: int, retry_after: float = 0.0) -> float:
+    """Full-jitter exponential backoff, never shorter than Serper's Retry-After"""
+    cap = min(SERPER_BACKOFF_MAX, SERPER_BACKOFF_BASE * (2 ** attempt))
+    return max(random.uniform(0, cap), retry_after)
+
+async def query_serper(mode: str, query: str, page: int = 1):
+    log_info("Calling Serper API with mode='%s', query='%s', page %s", mode, query, page)
+    url = SERPER_URLS.get(mode)
+    if not url:
+        log_error("Invalid mode: %s", mode)
+        return {}
+    payload = {"q": query, "num": SERPER_PAGE_SIZE, "page": page}
+
+    for attempt_no in range(SERPER_MAX_RETRIES + 1):
+        if not serper_breaker.allow():
+            SERPER_LATENCY.observe(0, mode, "circuit_open")
+            log_warn("Serper circuit open, failing fast for query '%s'", query)
+            return {}
+        with timed_phase("serper"):
+            attempt = await serper_post_hedged(mode, url, payload)
+        if attempt.data is not None:
+            serper_breaker.record_success()
+            log_success("Received data from Serper API for query '%s'", query)
+            return attempt.data
+        if not attempt.retryable:
+            # 4xx such as a bad key: not an outage, and retrying will not help
+            serper_breaker.record_success()
+            log_error("Serper API returned status %s for query '%s'", attempt.status, query)
+            return {}
+        serper_breaker.record_failure()
+        if attempt.retry_after > SERPER_BACKOFF_MAX:
+            # Honouring it would keep the user waiting past any useful reply
+            log_warn("Serper asked to retry after %ss for query '%s', giving up", attempt.retry_after, query)
+            return {}
+        if attempt_no < SERPER_MAX_RETRIES:
+            delay = backoff_delay(attempt_no, attempt.retry_after)
+            log_warn("Serper API %s for query '%s', retry %s in %.2fs", attempt.status, query, attempt_no + 1, delay)
+            with timed_phase("serper"):
+                await asyncio.sleep(delay)
+
+    log_error("Serper API failed for query '%s' after %s attempts", query, SERPER_MAX_RETRIES + 1)
+    return {}
+
+class QueryCache:
+    """Process-wide TTL + LRU cache of Serper responses keyed on (mode, query)
+
+    Concurrent lookups for the same key share a single upstream call.
+    """
+
+    def __init__(self, ttls: dict, max_entries: int):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    @staticmethod
+    def make_key(mode: str, query: str, page: int = 1):
+        """Normalize case and whitespace so equivalent queries share an entry"""
+        return (mode, " ".join(query.lower().split()), page)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        ttl = self.ttls.get(key[0], 0)
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def fetch(self, mode: str, query: str, loader, page: int = 1):
+        """Return cached data for (mode, query, page) or load it exactly once"""
+        key = self.make_key(mode, query, page)
+        data = self.get(key)
+        if data is not None:
+            self.stats["hits"] += 1
+            log_info("Query cache hit for mode '%s' and query '%s'", mode, query)
+            return data
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            log_info("Joined in-flight Serper call for mode '%s' and query '%s'", mode, query)
+        else:
+            self.stats["misses"] += 1
+            # Run the upstream call as its own task so one waiter being
+            # cancelled does not cancel it for the others
+            task = asyncio.create_task(self._load(key, mode, query, page, loader))
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key, mode: str, query: str, page: int, loader):
+        try:
+            data = await loader(mode, query, page)
+            # None means the upstream call failed; never pin that in the cache
+            if data is not None:
+                self.put(key, data)
+            return data
+        finally:
+            self._inflight.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+query_cache = QueryCache(QUERY_CACHE_TTLS, QUERY_CACHE_MAX_ENTRIES)
+
+for stat in ("hits", "misses", "coalesced"):
+    metrics.register(Counter(
+        f"dummypawn_query_cache_{stat}_total", f"Shared query cache lookups counted as {stat}",
+        callback=lambda stat=stat: query_cache.stats[stat]
+    ))
+metrics.register(Gauge(
+    "dummypawn_query_cache_entries", "Entries in the shared query cache",
+    callback=lambda: len(query_cache)
+))
+
+def project_results(mode: str, data: dict) -> tuple:
+    """Reduce a decoded Serper response to compact SearchResult records"""
+    items = data.get(RESULTS_KEY_MAPPING[mode], [])
+    return tuple(SearchResult.from_serper(item) for item in items if isinstance(item, dict))
+
+async def fetch_results(mode: str, query: str, page: int = 1):
+    """Call Serper and project the response; None means no data came back"""
+    data = await query_serper(mode, query, page)
+    if not data:
+        return None
+    return project_results(mode, data)
+
+async def fetch_results_stored(mode: str, query: str, page: int = 1):
+    """fetch_results, written behind to the state backend"""
+    results = await fetch_results(mode, query, page)
+    if results is not None:
+        state_backend.save_query(QueryCache.make_key(mode, query, page), results, query_cache.ttls.get(mode, 0))
+    return results
+
+async def fetch_results_shared(mode: str, query: str, page: int = 1):
+    """fetch_results_stored, read through the state backend first"""
+    results = await state_backend.load_query(QueryCache.make_key(mode, query, page))
+    if results is not None:
+        log_info("Loaded query '%s' page %s from the state backend", query, page)
+        return results
+    return await fetch_results_stored(mode, query, page)
+
+async def search_serper(mode: str, query: str, page: int = 1, backend_checked: bool = False):
+    """fetch_results behind the in-process and state backend result caches
+
+    backend_checked skips the backend read when the caller already missed there.
+    """
+    loader = fetch_results_stored if backend_checked else fetch_results_shared
+    return await query_cache.fetch(mode, query, loader, page)
+
+async def get_session(cache_key):
+    """Session for (user_id, chat_id) from memory or the state backend"""
+    with timed_phase("state"):
+        return await state_backend.load_session(cache_key)
+
+def persist_session(session: SearchSession):
+    """Queue a write of the session's current state to the state backend"""
+    session.version += 1
+    state_backend.save_session(session)
+
+async def load_next_page(session: SearchSession):
+    """Append the session's next Serper page, sharing any running prefetch"""
+    task = session.prefetch
+    if task is None:
+        task = session.prefetch = asyncio.create_task(fetch_next_page(session))
+    try:
+        # Shielded so a cancelled callback does not abort a shared prefetch
+        await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # The session was closed or evicted under us; callers see no new results
+        if not task.cancelled() or asyncio.current_task().cancelling():
+            raise
+
+async def fetch_next_page(session: SearchSession):
+    page = session.pages_loaded + 1
+    try:
+        if session.mode not in SERPER_URLS:
+            # An "all" session whose merge did not finish here (restored on
+            # another worker or after a restart) has no further pages
+            session.exhausted = True
+            return
+        results = await search_serper(session.mode, session.query, page)
+        if results is None:
+            # Upstream failure: leave the session open so a later click retries
+            return
+        session.extend(results)
+        persist_session(session)
+        log_info("Loaded page %s for query '%s', %s results now", page, session.query, len(session.results))
+        user_search_cache.resize((session.user_id, session.chat_id), session)
+    finally:
+        session.prefetch = None
+
+def maybe_prefetch(session: SearchSession):
+    """Start fetching the next page once the user is close to the end"""
+    if session.exhausted or session.prefetch is not None:
+        return
+    if len(session.results) - 1 - session.index < PREFETCH_DISTANCE:
+        session.prefetch = asyncio.create_task(fetch_next_page(session))
+
+async def iter_all_results(query: str):
+    """Search every mode at once and yield (mode, results) as each finishes
+
+    Searches still running at ALL_SEARCH_DEADLINE are cancelled. They go
+    through search_serper(), so a cancelled one keeps loading into the shared
+    cache for whoever asks next.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + ALL_SEARCH_DEADLINE
+    pending = {asyncio.create_task(search_serper(mode, query)): mode for mode in ALL_SEARCH_MODES}
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending, timeout=max(0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                log_warn("Dropped %s results for '%s' at the deadline", ", ".join(pending.values()), query)
+                return
+            for task in done:
+                mode = pending.pop(task)
+                try:
+                    results = task.result()
+                except Exception as e:
+                    log_error("%s search for '%s' failed: %s", mode, query, e)
+                    results = None
+                yield mode, results
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def first_all_results(stream):
+    """Results of the first mode that finds anything, tagged with that mode
+
+    Empty when the modes that answered found nothing, None when none answered.
+    """
+    answered = False
+    async for mode, results in stream:
+        if results:
+            return tuple(result.tagged(mode) for result in results)
+        answered = answered or results is not None
+    return () if answered else None
+
+async def merge_all_results(session: SearchSession, stream):
+    """Append the next mode that finds anything to an "all" session
+
+    Runs as the session's prefetch, so paging past the loaded results waits
+    for just the next mode; it chains itself until every mode is in.
+    """
+    async for mode, results in stream:
+        if results:
+            session.results += tuple(result.tagged(mode) for result in results)
+            break
+    else:
+        session.exhausted = True
+        log_info("Merged all-mode results for '%s', %s results", session.query, len(session.results))
+    session.rendered.clear()
+    session.prefetch = None
+    if not session.exhausted:
+        session.prefetch = asyncio.create_task(merge_all_results(session, stream))
+    persist_session(session)
+    user_search_cache.resize((session.user_id, session.chat_id), session)
+
+async def send_result(msg: types.Message, mode: str, index: int = 0, query_override: str = ""):
+    """Send search result with pagination"""
+    chat_id = msg.chat.id
+    user_id = msg.from_user.id if msg.from_user else 0
+    log_info("send_result called for chat_id=%s, user_id=%s, mode='%s', index=%s", chat_id, user_id, mode, index)
+    # Albums are image searches shown as media groups
+    album = mode == "album"
+    if album:
+        mode = "img"
+    
+    # Determine the query text
+    if query_override:
+        query = query_override.strip()
+    else:
+        text = msg.text or ""
+        if text.startswith("/"):
+            parts = text.split(" ", 1)
+            query = parts[1].strip() if len(parts) > 1 else ""
+        else:
+            query = text.strip()
+    
+    if not query or query.lower().strip() == "dummy":
+        await msg.answer(ERROR_MESSAGES["empty_query"], reply_to_message_id=msg.message_id)
+        log_warn("Empty or invalid query from user %s in chat %s", user_id, chat_id)
+        return
+
+    # Rate limit check (RATE_LIMIT_USER, 3 per minute by default), sharing a backend
+    # round-trip with the cached-results lookup
+    query_key = QueryCache.make_key(mode, query)
+    with timed_phase("state"):
+        allowed, results = await state_backend.begin_search(user_id, chat_id, query_key)
+    if not allowed:
+        RATE_LIMIT_REJECTIONS.inc()
+        await msg.answer(ERROR_MESSAGES["rate_limit"], reply_to_message_id=msg.message_id)
+        log_warn("Rate limit exceeded for user %s", user_id)
+        return
+
+    priority = SEARCH_PRIORITY_HIGH if msg.chat.type == ChatType.PRIVATE else SEARCH_PRIORITY_LOW
+    try:
+        async with admission.slot(priority):
+            reply = await run_search(msg, mode, query, index, album, query_key, results)
+    except AdmissionRejected as e:
+        log_warn("Search from user %s in chat %s turned away: %s", user_id, chat_id, e)
+        # Never searched, so it should not cost the user a search
+        await state_backend.refund_search(user_id, chat_id)
+        try:
+            await msg.answer(ERROR_MESSAGES["busy"], reply_to_message_id=msg.message_id)
+        except SendQueueFull:
+            pass
+        return
+    # Sent after the slot is released: the send waits on the chat's flood
+    # gate, and a busy group must not hold slots other chats need
+    await reply
+
+async def run_search(msg: types.Message, mode: str, query: str, index: int, album: bool, query_key, results):
+    """Search, cache the session and render the first result, under an admission slot
+
+    Returns the reply, unsent, for the caller to await once the slot is free.
+    """
+    chat_id = msg.chat.id
+    user_id = msg.from_user.id if msg.from_user else 0
+
+    stream = None
+    if mode == "all":
+        # One rate-limit unit for every mode; show whichever answers first
+        stream = iter_all_results(query)
+        results = await first_all_results(stream)
+    elif results is not None:
+        query_cache.put(query_key, results)
+    else:
+        results = await search_serper(mode, query, backend_checked=state_backend.pipelines_query_lookup)
+    if results is None:
+        log_warn("No data received from API for query '%s' user %s in chat %s", query, user_id, chat_id)
+        return msg.answer(ERROR_MESSAGES["no_data"], reply_to_message_id=msg.message_id)
+
+    if not results:
+        log_warn("No %s results found for query '%s' user %s in chat %s", mode, query, user_id, chat_id)
+        return msg.answer(ERROR_MESSAGES["no_results"].format(mode=mode, query=query), reply_to_message_id=msg.message_id)
+
+    # Cache under (user_id, chat_id)
+    session_timestamp = datetime.now().strftime("%H%M%S")
+    cache_key = (user_id, chat_id)
+    session = SearchSession(mode, query, results, index, session_timestamp, user_id, chat_id)
+    if stream is not None:
+        # Paging past the first mode's results waits on this, like a prefetch
+        session.exhausted = False
+        session.prefetch = asyncio.create_task(merge_all_results(session, stream))
+    user_search_cache[cache_key] = session
+    persist_session(session)
+    log_info("Cached search for user %s in chat %s, mode '%s', query '%s', total results %s", user_id, chat_id, mode, query, len(results))
+
+    if index >= len(results):
+        log_warn("Index %s out of range for results, user %s in chat %s", index, user_id, chat_id)
+        return msg.answer(ERROR_MESSAGES["no_more_results"], reply_to_message_id=msg.message_id)
+
+    if album:
+        indices = await collect_album(session, index, 1)
+        if len(indices) >= 2:
+            return deliver_album(msg, session, indices)
+        # Too few pictures for a media group: show them one at a time
+
+    image_prober.probe_ahead(session)
+    return deliver_result(msg, session, render_result(session, index), index)
+
+async def deliver_result(msg: types.Message, session: SearchSession, payload: RenderedResult, index: int):
+    """First result of a new search, as a reply to the search message"""
+    try:
+        sent = await send_rendered(msg, payload, reply_to_message_id=msg.message_id)
+        log_success("Sent %s result to user %s in chat %s", session.mode, session.user_id, session.chat_id)
+        session.message_id = sent.message_id
+        session.shown = index
+        persist_session(session)
+        maybe_prefetch(session)
+    except SendQueueFull as e:
+        # Replying would only add to the backlog
+        log_warn("Dropped result for chat %s, user %s: %s", session.chat_id, session.user_id, e)
+    except Exception as e:
+        log_error("Failed to send result message for chat %s, user %s: %s", session.chat_id, session.user_id, e)
+        await msg.answer(ERROR_MESSAGES["send_failed"], reply_to_message_id=msg.message_id)
+
+async def deliver_album(msg: types.Message, session: SearchSession, indices: list):
+    """First album of a new search, as a reply to the search message"""
+    try:
+        await send_album(msg, session, indices, reply_to_message_id=msg.message_id)
+        log_success("Sent album of %s pictures to user %s in chat %s", len(indices), session.user_id, session.chat_id)
+        persist_session(session)
+        maybe_prefetch(session)
+        image_prober.probe_ahead(session)
+    except SendQueueFull as e:
+        log_warn("Dropped album for chat %s, user %s: %s", session.chat_id, session.user_id, e)
+    except Exception as e:
+        log_error("Failed to send album for chat %s, user %s: %s", session.chat_id, session.user_id, e)
+        await msg.answer(ERROR_MESSAGES["send_failed"], reply_to_message_id=msg.message_id)
+
+class PageEditCoalescer:
+    """At most one pending edit per session, always to its latest index
+
+    The first tap schedules an edit after a short debounce; taps arriving
+    before it runs, or while it is in flight, only move the session's index
+    and are picked up by the same task, which edits again until the message
+    shows the index the user stopped at. If an edit fails, the session goes
+    back to the result the message still shows and the user is told, since
+    the tap itself was answered before the edit ran.
+    """
+
+    def __init__(self, debounce: float):
+        self.debounce = debounce
+        # (user_id, chat_id) -> [session, message to edit, task]
+        self._pending = {}
+
+    def schedule(self, key, session: SearchSession, message: types.Message):
+        pending = self._pending.get(key)
+        if pending is not None and pending[0] is session:
+            pending[1] = message
+            PAGE_TAPS_COALESCED.inc()
+            return
+        if pending is not None:
+            # A newer search replaced the session; its edits are moot
+            pending[2].cancel()
+        pending = [session, message, None]
+        self._pending[key] = pending
+        pending[2] = asyncio.create_task(self._run(key, pending))
+
+    def cancel(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending[2].cancel()
+
+    async def _run(self, key, pending):
+        session = pending[0]
+        try:
+            while True:
+                await asyncio.sleep(self.debounce)
+                index = session.index
+                if index != session.shown and not await self._edit(session, pending[1], index):
+                    return
+                if session.index == index:
+                    return
+        finally:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+
+    async def _edit(self, session: SearchSession, message: types.Message, index: int) -> bool:
+        """Show `index` in the message; False if the edit failed"""
+        try:
+            await edit_rendered(message, render_result(session, index))
+            session.shown = index
+            log_success("Edited %s result for user %s", session.mode, session.user_id)
+            return True
+        except Exception as e:
+            if "message is not modified" in str(e):
+                NOT_MODIFIED.inc()
+                session.shown = index
+                log_info("Duplicate content for user %s, index %s", session.user_id, index)
+                return True
+            log_error("Failed to edit message for user %s: %s", session.user_id, e)
+        if session.shown is not None:
+            # Next/Previous continue from what the user can see
+            session.index = session.shown
+            persist_session(session)
+        try:
+            await message.answer(ERROR_MESSAGES["edit_failed"], reply_to_message_id=message.message_id)
+        except Exception as e:
+            log_error("Failed to report a failed edit to user %s: %s", session.user_id, e)
+        return False
+
+page_edits = PageEditCoalescer(PAGE_EDIT_DEBOUNCE)
+
+async def handle_help_callback(query: CallbackQuery, callback: CallbackArgs):
+    """Expand or minimize the help message"""
+    user_id, chat_id = callback.user_id, callback.chat_id
+    expand = callback.action == ACTION_HELP_EXPAND
+    try:
+        if expand:
+            new_text = HELP_MESSAGES["expanded"]
+            new_keyboard = get_help_keyboard(user_id, chat_id, is_expanded=True)
+            answer_msg = QUERY_ANSWERS["help_expanded"]
+        else:
+            new_text = HELP_MESSAGES["basic"]
+            new_keyboard = get_help_keyboard(user_id, chat_id, is_expanded=False)
+            answer_msg = QUERY_ANSWERS["help_minimized"]
+            
+        await query.message.edit_text(new_text, reply_markup=new_keyboard)
+        await query.answer(answer_msg)
+        log_success("Help %s for user %s", "expanded" if expand else "minimized", user_id)
+        
+    except Exception as e:
+        if "message is not modified" in str(e):
+            NOT_MODIFIED.inc()
+            await query.answer(QUERY_ANSWERS["help_same"])
+        else:
+            log_error("Failed to update help message: %s", e)
+            await query.answer(QUERY_ANSWERS["help_error"])
+
+async def handle_close_callback(query: CallbackQuery, callback: CallbackArgs):
+    """Delete a result message, and its session if the message is showing it"""
+    user_id = callback.user_id
+    cache_key = (user_id, callback.chat_id)
+    session = await get_session(cache_key)
+    album_ids = []
+    if session is not None and session.message_id == query.message.message_id:
+        page_edits.cancel(cache_key)
+        state_backend.delete_session(cache_key)
+        if session.album is not None:
+            album_ids = session.album[2]
+    try:
+        if album_ids:
+            # The pictures go with their controls, in one call
+            await bot.delete_messages(query.message.chat.id, album_ids + [query.message.message_id])
+            await query.answer(SUCCESS_MESSAGES["deleted"])
+            log_success("Album deleted by user %s", user_id)
+        elif hasattr(query.message, 'delete'):
+            await query.message.delete()
+            await query.answer(SUCCESS_MESSAGES["deleted"])
+            log_success("Message deleted by user %s", user_id)
+        else:
+            await query.answer(ERROR_MESSAGES["cannot_delete"])
+    except Exception as e:
+        log_error("Failed to delete message for user %s: %s", user_id, e)
+        await query.answer(ERROR_MESSAGES["delete_failed"])
+
+async def handle_page_callback(query: CallbackQuery, callback: CallbackArgs):
+    """Move a search session to the next or previous result"""
+    user_id, chat_id = callback.user_id, callback.chat_id
+
+    # Retrieve cache for this specific user and chat
+    cache_key = (user_id, chat_id)
+    cache = await get_session(cache_key)
+    if not cache:
+        SESSION_MISSES.inc()
+        await query.answer(ERROR_MESSAGES["no_cache"])
+        log_warn("No cached search for user %s in chat %s on callback %s", user_id, chat_id, query.data)
+        return
+
+    if not (hasattr(query.message, 'edit_media') and hasattr(query.message, 'edit_text')):
+        await query.answer(ERROR_MESSAGES["cannot_edit"])
+        return
+
+    # Compute new index, skipping image results already known to be dead.
+    # Taps step one at a time, each from where the previous one landed.
+    step = 1 if callback.action == ACTION_NEXT else -1
+    if cache.lock is None:
+        cache.lock = asyncio.Lock()
+    async with cache.lock:
+        new_index = await step_index(cache, cache.index, step)
+        if new_index is not None:
+            # Update cache index for this specific user and chat
+            cache.index = new_index
+
+    if new_index is None:
+        if step > 0:
+            await query.answer(ERROR_MESSAGES["no_more"])
+            log_warn("User %s reached end of results", user_id)
+        else:
+            await query.answer(ERROR_MESSAGES["first_result"])
+            log_warn("User %s tried to go before first result", user_id)
+        return
+
+    persist_session(cache)
+    maybe_prefetch(cache)
+    image_prober.probe_ahead(cache)
+    # Answer now; the edit to wherever the user ends up follows shortly
+    page_edits.schedule(cache_key, cache, query.message)
+    await query.answer(SUCCESS_MESSAGES["updated"])
+
+async def handle_album_callback(query: CallbackQuery, callback: CallbackArgs):
+    """Open an album from a single result, or move an album by one batch
+
+    Each batch is one media group plus a fresh controls message; the
+    previous batch and its controls are removed in a single call.
+    """
+    user_id, chat_id = callback.user_id, callback.chat_id
+    cache_key = (user_id, chat_id)
+    session = await get_session(cache_key)
+    if callback.action == ACTION_ALBUM:
+        if session is None:
+            SESSION_MISSES.inc()
+            await query.answer(ERROR_MESSAGES["no_cache"])
+            return
+    elif session is None or session.album is None or session.message_id != query.message.message_id:
+        await query.answer(ERROR_MESSAGES["album_expired"])
+        return
+
+    if session.lock is None:
+        session.lock = asyncio.Lock()
+    if session.lock.locked():
+        await query.answer(QUERY_ANSWERS["album_busy"])
+        return
+    async with session.lock:
+        if callback.action == ACTION_ALBUM:
+            start, step = session.index, 1
+        elif callback.action == ACTION_ALBUM_NEXT:
+            start, step = session.album[1] + 1, 1
+        else:
+            start, step = session.album[0] - 1, -1
+        try:
+            # Only finding the pictures holds a search slot; the album send
+            # waits on the chat's flood gate and must not keep it
+            async with admission.slot(SEARCH_PRIORITY_HIGH):
+                indices = await collect_album(session, start, step)
+        except AdmissionRejected as e:
+            log_warn("Album from user %s turned away: %s", user_id, e)
+            await query.answer(QUERY_ANSWERS["busy"])
+            return
+        if callback.action == ACTION_ALBUM:
+            if len(indices) < 2:
+                await query.answer(ERROR_MESSAGES["no_album"])
+                return
+            old_ids = [query.message.message_id]
+        elif not indices:
+            await query.answer(ERROR_MESSAGES["no_more"] if step > 0 else ERROR_MESSAGES["first_result"])
+            return
+        else:
+            old_ids = session.album[2] + [query.message.message_id]
+
+        await query.answer(QUERY_ANSWERS["album_loading"])
+        page_edits.cancel(cache_key)
+        try:
+            await send_album(query.message, session, indices)
+        except Exception as e:
+            log_error("Failed to send album for user %s: %s", user_id, e)
+            return
+        persist_session(session)
+        log_success("Showing pictures %s-%s as an album for user %s", indices[0] + 1, indices[-1] + 1, user_id)
+        try:
+            await bot.delete_messages(chat_id, old_ids)
+        except Exception as e:
+            log_warn("Failed to remove the previous album for user %s: %s", user_id, e)
+    maybe_prefetch(session)
+    image_prober.probe_ahead(session)
+
+# Action code -> handler; every action is checked against the pressing user
+# and chat before its handler runs
+# Actions that skip admission control here: cheap ones, and albums, whose
+# handler holds a slot only while it looks for pictures
+UNGATED_CALLBACK_ACTIONS = {
+    ACTION_CLOSE, ACTION_HELP_EXPAND, ACTION_HELP_MINIMIZE,
+    ACTION_ALBUM, ACTION_ALBUM_PREV, ACTION_ALBUM_NEXT
+}
+
+CALLBACK_HANDLERS = {
+    ACTION_PREV: handle_page_callback,
+    ACTION_NEXT: handle_page_callback,
+    ACTION_CLOSE: handle_close_callback,
+    ACTION_HELP_EXPAND: handle_help_callback,
+    ACTION_HELP_MINIMIZE: handle_help_callback,
+    ACTION_ALBUM: handle_album_callback,
+    ACTION_ALBUM_PREV: handle_album_callback,
+    ACTION_ALBUM_NEXT: handle_album_callback
+}
+
+def match_callback(query: CallbackQuery):
+    """Router filter: decode our callback_data once and pass it to the handler"""
+    try:
+        callback = decode_callback(query.data or "")
+    except ValueError:
+        return {"callback": None}
+    if callback is None:
+        return False
+    return {"callback": callback}
+
+@router.callback_query(match_callback)
+async def callback_handler(query: CallbackQuery, callback: CallbackArgs):
+    """Check who pressed a button, then dispatch on its action code"""
+    if not query.message or not query.from_user:
+        await query.answer(ERROR_MESSAGES["invalid_callback"])
+        return
+        
+    log_info("Received callback: %s from user %s in chat %s", query.data, query.from_user.id, query.message.chat.id)
+
+    handler = CALLBACK_HANDLERS.get(callback.action) if callback is not None else None
+    if handler is None:
+        log_warn("Unexpected callback_data format: %s", query.data)
+        await query.answer(ERROR_MESSAGES["invalid_data"])
+        return
+
+    # Verify correct user and chat
+    if query.from_user.id != callback.user_id:
+        await query.answer(ERROR_MESSAGES["wrong_user"])
+        log_warn("User %s tried to press button for user %s", query.from_user.id, callback.user_id)
+        return
+    
+    if query.message.chat.id != callback.chat_id:
+        await query.answer(ERROR_MESSAGES["wrong_chat"])
+        log_warn("Callback for chat %s used in chat %s", callback.chat_id, query.message.chat.id)
+        return
+
+    if callback.action in UNGATED_CALLBACK_ACTIONS:
+        await handler(query, callback)
+        return
+    try:
+        async with admission.slot(SEARCH_PRIORITY_HIGH):
+            await handler(query, callback)
+    except AdmissionRejected as e:
+        log_warn("Callback from user %s turned away: %s", query.from_user.id, e)
+        await query.answer(QUERY_ANSWERS["busy"])
+
+@router.message(Command("start"))
+async def cmd_start(msg: types.Message):
+    user_id = msg.from_user.id if msg.from_user else 0
+    log_info("Start command invoked by user %s", user_id)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=BUTTON_TEXTS["updates"], url=UPDATES_CHANNEL),
+            InlineKeyboardButton(text=BUTTON_TEXTS["support"], url=SUPPORT_GROUP)
+        ],
+        [
+            InlineKeyboardButton(text=BUTTON_TEXTS["add_to_group"], url=f"https://t.me/{BOT_USERNAME}?startgroup=true")
+        ]
+    ])
+    
+    # Select random image from the list
+    random_image = random.choice(IMAGES)
+    
+    try:
+        await answer_photo_cached(
+            msg,
+            random_image,
+            caption=START_MESSAGES["welcome"], 
+            reply_markup=keyboard
+        )
+        log_success("Start message with random image sent to user %s", user_id)
+    except Exception as e:
+        log_error("Failed to send start message with image: %s", e)
+        # Fallback to text message if image fails
+        try:
+            await msg.answer(START_MESSAGES["welcome"], reply_markup=keyboard)
+            log_success("Start message (text fallback) sent to user %s", user_id)
+        except Exception as e2:
+            log_error("Failed to send start message fallback: %s", e2)
+
+@router.message(Command("help"))
 async def cmd_help(msg: types.Message):
     user_id = msg.from_user.id if msg.from_user else 0
     chat_id = msg.chat.id
-    log_info(f"Help command invoked by user {user_id}")
+    log_info("Help command invoked by user %s", user_id)
     
     keyboard = get_help_keyboard(user_id, chat_id, is_expanded=False)
     
     try:
         await msg.answer(HELP_MESSAGES["basic"], reply_markup=keyboard)
-        log_success(f"Help message sent to user {user_id}")
+        log_success("Help message sent to user %s", user_id)
     except Exception as e:
-        log_error(f"Failed to send help message: {e}")
+        log_error("Failed to send help message: %s", e)
 
 @router.message(Command("web"))
 async def cmd_web(msg: types.Message):
     user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"Web search command from user {user_id}")
+    log_info("Web search command from user %s", user_id)
     await send_result(msg, "web")
 
 @router.message(Command("img"))
 async def cmd_img(msg: types.Message):
     user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"Image search command from user {user_id}")
+    log_info("Image search command from user %s", user_id)
     await send_result(msg, "img")
 
 @router.message(Command("vid"))
 async def cmd_vid(msg: types.Message):
     user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"Video search command from user {user_id}")
+    log_info("Video search command from user %s", user_id)
     await send_result(msg, "vid")
 
 @router.message(Command("news"))
 async def cmd_news(msg: types.Message):
     user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"News search command from user {user_id}")
+    log_info("News search command from user %s", user_id)
     await send_result(msg, "news")
     
+@router.message(Command("all"))
+async def cmd_all(msg: types.Message):
+    user_id = msg.from_user.id if msg.from_user else 0
+    log_info("All-mode search command from user %s", user_id)
+    await send_result(msg, "all")
+
 @router.message(Command("ping"))
 async def cmd_ping(msg: types.Message):
     """Handle /ping command - shows latency with hyperlinked Pong!"""
     user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"Ping command from user {user_id}")
+    log_info("Ping command from user %s", user_id)
     
     try:
         # Record start time
@@ -719,15 +3834,59 @@ async def cmd_ping(msg: types.Message):
             disable_web_page_preview=True
         )
         
-        log_success(f"Ping response sent to user {user_id} with latency {latency:.2f}ms")
+        log_success("Ping response sent to user %s with latency %.2fms", user_id, latency)
         
     except Exception as e:
-        log_error(f"Failed to send ping response to user {user_id}: {e}")
+        log_error("Failed to send ping response to user %s: %s", user_id, e)
         # Fallback response if edit fails
         try:
             await msg.answer(f"🏓 Pong! Error measuring latency", reply_to_message_id=msg.message_id)
         except Exception as e2:
-            log_error(f"Failed to send ping fallback to user {user_id}: {e2}")
+            log_error("Failed to send ping fallback to user %s: %s", user_id, e2)
+
+@router.message(Command("debug"))
+async def cmd_debug(msg: types.Message):
+    """Admin-only diagnostics: /debug profile <seconds>"""
+    user_id = msg.from_user.id if msg.from_user else 0
+    if user_id not in ADMIN_IDS:
+        log_warn("Ignoring /debug from non-admin user %s", user_id)
+        return
+    parts = (msg.text or "").split()
+    try:
+        if len(parts) != 3 or parts[1] != "profile":
+            raise ValueError(msg.text)
+        seconds = min(float(parts[2]), PROFILE_MAX_SECONDS)
+        if not seconds > 0:
+            raise ValueError(msg.text)
+    except ValueError:
+        await msg.answer(ERROR_MESSAGES["debug_usage"], reply_to_message_id=msg.message_id)
+        return
+    if not profiler.available:
+        await msg.answer(ERROR_MESSAGES["profile_unavailable"], reply_to_message_id=msg.message_id)
+        return
+    if profiler.running:
+        await msg.answer(ERROR_MESSAGES["profile_running"], reply_to_message_id=msg.message_id)
+        return
+
+    log_info("Admin %s started a %ss profile", user_id, seconds)
+    await msg.answer(SUCCESS_MESSAGES["profile_started"].format(seconds=seconds), reply_to_message_id=msg.message_id)
+    with timed_phase("profiling"):
+        stacks = await profiler.run(seconds)
+    await msg.answer(profiler.summarize(stacks, seconds, PROFILE_TOP_STACKS), reply_to_message_id=msg.message_id)
+
+def parse_search_text(text: str, default_mode="web"):
+    """Split "<query> [type]" into (mode, query)
+
+    A trailing trigger word from SEARCH_TYPE_MAPPING picks the mode and is
+    dropped from the query; otherwise the whole text is searched in
+    default_mode.
+    """
+    parts = text.split()
+    if len(parts) >= 2:
+        mode = SEARCH_TYPE_MAPPING.get(parts[-1])
+        if mode:
+            return mode, " ".join(parts[:-1])
+    return default_mode, " ".join(parts)
 
 # Smart trigger for groups (responds to "dummy" keyword)
 @router.message(lambda msg: msg.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP])
@@ -738,7 +3897,7 @@ async def handle_group_message(msg: types.Message):
         return
 
     user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"Smart trigger detected in group {msg.chat.id} by user {user_id}: {text}")
+    log_info("Smart trigger detected in group %s by user %s: %s", msg.chat.id, user_id, text)
 
     # Parse: "dummy [query] [type]"
     parts = text.split()
@@ -747,13 +3906,10 @@ async def handle_group_message(msg: types.Message):
         return
 
     # Last word is the search type, everything in between is the query
-    search_type = parts[-1]
-    query = " ".join(parts[1:-1])
-
-    mode = SEARCH_TYPE_MAPPING.get(search_type)
+    mode, query = parse_search_text(" ".join(parts[1:]), default_mode=None)
     if not mode:
         await msg.answer(
-            GROUP_MESSAGES["unknown_type"].format(search_type=search_type),
+            GROUP_MESSAGES["unknown_type"].format(search_type=parts[-1]),
             reply_to_message_id=msg.message_id
         )
         return
@@ -773,81 +3929,480 @@ async def handle_private_message(msg: types.Message):
         return
 
     user_id = msg.from_user.id if msg.from_user else 0
-    log_info(f"Smart trigger detected in private chat by user {user_id}: {text}")
+    log_info("Smart trigger detected in private chat by user %s: %s", user_id, text)
 
-    # Check if message ends with a search type
-    parts = text.split()
-    if len(parts) < 2:
-        # Default to web search
-        await send_result(msg, "web", query_override=text)
+    # A trailing search type picks the mode, else default to web search
+    mode, query = parse_search_text(text)
+    await send_result(msg, mode, query_override=query)
+
+@router.inline_query()
+async def handle_inline_query(inline: types.InlineQuery):
+    """Answer "@bot [query] [type]" with a whole Serper page at once
+
+    Answers are not personal and carry the mode's cache TTL, so Telegram
+    serves repeats of a query without asking us again. The offset is the
+    Serper page number.
+    """
+    user_id = inline.from_user.id
+    mode, query = parse_search_text(inline.query.strip().lower())
+    if mode == "album":
+        # Inline image answers are already a grid
+        mode = "img"
+    if len(query) < INLINE_MIN_QUERY_LENGTH:
+        await inline.answer([], cache_time=INLINE_EMPTY_CACHE_TIME)
         return
+    try:
+        page = max(1, int(inline.offset or 1))
+    except ValueError:
+        page = 1
+    log_info("Inline query from user %s: mode '%s', query '%s', page %s", user_id, mode, query, page)
 
-    # Check if last word is a search type
-    last_word = parts[-1]
-    mode = SEARCH_TYPE_MAPPING.get(last_word)
-    if mode:
-        # Query is everything except the last word
-        query = " ".join(parts[:-1])
-        await send_result(msg, mode, query_override=query)
-    else:
-        # Default to web search with full text
-        await send_result(msg, "web", query_override=text)
+    # Only searches that would reach Serper count, against RATE_LIMIT_INLINE
+    # so typing a query does not use up the user's chat searches
+    query_key = QueryCache.make_key(mode, query, page)
+    results = query_cache.get(query_key)
+    if results is None:
+        with timed_phase("state"):
+            allowed, results = await state_backend.begin_search(user_id, user_id, query_key, inline=True)
+        if not allowed:
+            RATE_LIMIT_REJECTIONS.inc()
+            await inline.answer(
+                [], cache_time=0, is_personal=True,
+                button=types.InlineQueryResultsButton(text=INLINE_MESSAGES["rate_limit"], start_parameter="inline")
+            )
+            log_warn("Inline rate limit exceeded for user %s", user_id)
+            return
+        try:
+            async with admission.slot(SEARCH_PRIORITY_HIGH):
+                if mode == "all":
+                    # Every mode within the deadline, as one page
+                    results = ()
+                    async for found_mode, found in iter_all_results(query):
+                        results += tuple(result.tagged(found_mode) for result in found or ())
+                elif results is not None:
+                    query_cache.put(query_key, results)
+                else:
+                    results = await search_serper(mode, query, page, backend_checked=state_backend.pipelines_query_lookup)
+        except AdmissionRejected as e:
+            log_warn("Inline query from user %s turned away: %s", user_id, e)
+            await state_backend.refund_search(user_id, user_id, inline=True)
+            await inline.answer(
+                [], cache_time=0, is_personal=True,
+                button=types.InlineQueryResultsButton(text=INLINE_MESSAGES["busy"], start_parameter="inline")
+            )
+            return
 
-async def set_bot_commands():
-    """Set bot commands for the menu"""
-    commands = [
-        BotCommand(command=cmd["command"], description=cmd["description"])
-        for cmd in BOT_COMMANDS
+    if not results:
+        # Failures and empty pages are not worth caching on Telegram's side
+        await inline.answer(
+            [], cache_time=0,
+            button=types.InlineQueryResultsButton(text=INLINE_MESSAGES["no_results"], start_parameter="inline")
+        )
+        log_warn("No inline %s results for query '%s' page %s", mode, query, page)
+        return
+
+    answers = [
+        answer for answer in (
+            render_inline_result(result.mode or mode, query, result, f"{page}-{i}")
+            for i, result in enumerate(results)
+        ) if answer is not None
     ]
-    await bot.set_my_commands(commands)
-    log_success("Bot commands set successfully")
-
-# Dummy HTTP Server for Deployment Compatibility
-class DummyHandler(BaseHTTPRequestHandler):
-    """Simple HTTP handler for health checks and deployment compatibility"""
-
-    def do_GET(self):
-        """Handle GET requests"""
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b"Telegram bot is running and healthy!")
-
-    def do_HEAD(self):
-        """Handle HEAD requests"""
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-
-    def log_message(self, format, *args):
-        """Suppress HTTP server logs"""
-        pass
+    more = mode != "all" and len(results) >= SERPER_PAGE_SIZE and page < SERPER_MAX_PAGES
+    try:
+        await inline.answer(
+            answers,
+            cache_time=int(query_cache.ttls.get(mode, 0)),
+            is_personal=False,
+            next_offset=str(page + 1) if more else ""
+        )
+        log_success("Answered inline query from user %s with %s %s results", user_id, len(answers), mode)
+    except Exception as e:
+        log_error("Failed to answer inline query from user %s: %s", user_id, e)
+
+async def set_bot_commands():
+    """Set bot commands for the menu, unless the stored copy is current
+
+    A hash of BOT_COMMANDS is kept in the state backend (so this needs
+    STATE_DB_PATH or REDIS_URL to skip anything). Runs alongside startup
+    rather than ahead of it, and a failure only costs the menu.
+    """
+    digest = hashlib.sha256(json.dumps(BOT_COMMANDS, sort_keys=True).encode()).hexdigest()
+    name = f"commands:{bot.id}"
+    try:
+        if await state_backend.load_meta(name) == digest:
+            log_info("Bot commands unchanged, not re-registering them")
+            return
+        commands = [
+            BotCommand(command=cmd["command"], description=cmd["description"])
+            for cmd in BOT_COMMANDS
+        ]
+        await bot.set_my_commands(commands)
+        await state_backend.save_meta(name, digest)
+        log_success("Bot commands set successfully")
+    except Exception as e:
+        log_error("Failed to set bot commands: %s", e)
+
+async def start_backlog():
+    """Tell the backlog gate how many updates queued while the bot was down"""
+    try:
+        info = await bot.get_webhook_info()
+    except Exception as e:
+        log_warn("Could not read the pending update count, treating nothing as backlog: %s", e)
+        return
+    backlog.start(info.pending_update_count)
+
+# HTTP server: metrics, health checks, and Telegram updates in webhook mode
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Prometheus text exposition of the bot's metrics"""
+    return web.Response(
+        text=metrics.render(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+async def handle_healthz(request: web.Request) -> web.Response:
+    """Liveness probe"""
+    return web.Response(text="ok")
+
+def create_web_app(use_webhook: bool, pool=None) -> web.Application:
+    """Build the aiohttp application served on PORT
+
+    With a WorkerPool, webhook updates are routed to workers instead of
+    being handled in this process.
+    """
+    app = web.Application()
+    app.router.add_get("/", handle_metrics)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/healthz", handle_healthz)
+    if use_webhook and pool is not None:
+        app["worker_pool"] = pool
+        app.router.add_post(WEBHOOK_PATH, handle_routed_webhook)
+    elif use_webhook:
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET or None
+        ).register(app, path=WEBHOOK_PATH)
+    return app
+
+async def start_web_server(app: web.Application, host: str = "0.0.0.0", port: int = PORT) -> web.AppRunner:
+    """Serve the app on the bot's own event loop"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    log_info("HTTP server listening on %s:%s", host, port)
+    return runner
+
+def stop_on_signals() -> asyncio.Event:
+    """Event set on SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+async def run_webhook():
+    """Register the webhook and serve updates until SIGINT/SIGTERM"""
+    stop = stop_on_signals()
+
+    await start_backlog()
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    log_success("Webhook set to %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+    await dp.emit_startup(bot=bot)
+    try:
+        await stop.wait()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+
+async def run_polling():
+    """Fall back to long polling when no webhook is configured"""
+    await asyncio.gather(start_backlog(), bot.delete_webhook())
+    log_info("Bot is starting polling...")
+    await dp.start_polling(bot)
+
+# Multi-process mode
+def update_shard_key(update: dict) -> int:
+    """Chat id an update belongs to, or its sender's id when it has no chat"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = value.get("from") or value.get("user")
+        if sender:
+            return sender["id"]
+    return 0
+
+# Start of every successful getUpdates reply, as Telegram formats it
+RAW_UPDATES_PREFIX = '{"ok":true,"result":['
+raw_update_decoder = json.JSONDecoder()
+
+def split_updates(body: bytes) -> list:
+    """[(update, raw bytes)] from a successful getUpdates reply
+
+    Each update is decoded once, for routing, and forwarded as the bytes
+    Telegram sent instead of being encoded again. Raises ValueError for
+    anything else, including error replies.
+    """
+    text = body.decode()
+    if not text.startswith(RAW_UPDATES_PREFIX):
+        raise ValueError("Not a successful getUpdates reply")
+    updates = []
+    pos = len(RAW_UPDATES_PREFIX)
+    try:
+        while text[pos] != "]":
+            update, end = raw_update_decoder.raw_decode(text, pos)
+            updates.append((update, text[pos:end].encode()))
+            pos = end + 1 if text[end] == "," else end
+    except IndexError:
+        raise ValueError("Truncated getUpdates reply") from None
+    return updates
+
+class WorkerProcess:
+    """A worker subprocess fed length-prefixed raw updates on stdin
+
+    supervise() restarts the process whenever it exits until stop() is
+    called; send() waits for a live process.
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.running = asyncio.Event()
+        self.stopping = False
+
+    async def supervise(self):
+        while not self.stopping:
+            env = dict(os.environ, DUMMYPAWN_WORKER_INDEX=str(self.index))
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, *sys.argv, stdin=asyncio.subprocess.PIPE, env=env
+            )
+            self.running.set()
+            log_info("Started worker %s (pid %s)", self.index, self.process.pid)
+            code = await self.process.wait()
+            self.running.clear()
+            if not self.stopping:
+                WORKER_RESTARTS.inc()
+                log_error("Worker %s exited with code %s, restarting", self.index, code)
+                await asyncio.sleep(1)
+
+    async def send(self, raw: bytes):
+        while True:
+            await self.running.wait()
+            stdin = self.process.stdin
+            try:
+                stdin.write(len(raw).to_bytes(4, "big") + raw)
+                await stdin.drain()
+                return
+            except (BrokenPipeError, ConnectionResetError):
+                # Died under us; wait for supervise() to start a new one
+                self.running.clear()
+
+    async def stop(self, timeout: float):
+        """Close stdin so the worker drains in-flight updates and exits"""
+        self.stopping = True
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            log_warn("Worker %s did not exit in %ss, killing it", self.index, timeout)
+            self.process.kill()
+            await self.process.wait()
+
+class WorkerPool:
+    """Routes raw updates to worker processes by chat id"""
+
+    def __init__(self, size: int):
+        self.workers = [WorkerProcess(index) for index in range(size)]
+        self._supervisors = []
+
+    def start(self):
+        self._supervisors = [asyncio.create_task(worker.supervise()) for worker in self.workers]
+
+    async def dispatch(self, update: dict, raw: bytes = None):
+        if not backlog.admit_raw(update):
+            return
+        worker = self.workers[update_shard_key(update) % len(self.workers)]
+        if raw is None:
+            raw = json.dumps(update, ensure_ascii=False).encode()
+        WORKER_UPDATES.inc(str(worker.index))
+        await worker.send(raw)
+
+    async def stop(self, timeout: float = 30):
+        await asyncio.gather(*(worker.stop(timeout) for worker in self.workers))
+        for task in self._supervisors:
+            task.cancel()
+
+async def handle_routed_webhook(request: web.Request) -> web.Response:
+    """Webhook endpoint of the supervisor: route the update to its worker"""
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    raw = await request.read()
+    try:
+        update = json.loads(raw)
+    except ValueError:
+        return web.Response(status=400)
+    await request.app["worker_pool"].dispatch(update, raw)
+    return web.Response()
+
+async def poll_for_workers(pool: WorkerPool, stop: asyncio.Event):
+    """Long-poll getUpdates and route updates to workers
+
+    The supervisor decodes each update once to find its chat and date;
+    workers get Telegram's bytes and do the aiogram parsing and handling.
+    """
+    await asyncio.gather(start_backlog(), bot.delete_webhook())
+    url = bot.session.api.api_url(bot.token, "getUpdates")
+    payload = {"offset": 0, "timeout": 30, "allowed_updates": dp.resolve_used_update_types()}
+    log_info("Supervisor is starting polling for %s workers...", len(pool.workers))
+    record_startup("ready")
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=payload["timeout"] + 10)) as http:
+        while not stop.is_set():
+            try:
+                async with http.post(url, json=payload) as resp:
+                    body = await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log_warn("getUpdates failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+            try:
+                updates = split_updates(body)
+            except ValueError:
+                try:
+                    reply = json.loads(body)
+                except ValueError:
+                    reply = {"description": f"unreadable reply {body[:80]!r}"}
+                if not reply.get("ok"):
+                    log_error("getUpdates returned an error: %s", reply.get("description"))
+                    await asyncio.sleep((reply.get("parameters") or {}).get("retry_after", 1))
+                    continue
+                # Laid out differently than expected; dispatch() encodes each update again
+                updates = [(update, None) for update in reply["result"]]
+            for update, raw in updates:
+                payload["offset"] = update["update_id"] + 1
+                await pool.dispatch(update, raw)
+
+async def run_supervisor():
+    """Own update delivery and fan updates out to WORKERS processes"""
+    pool = WorkerPool(WORKERS)
+    pool.start()
+    use_webhook = bool(WEBHOOK_URL)
+    runner = await start_web_server(create_web_app(use_webhook, pool))
+    await state_backend.open()
+    commands = asyncio.create_task(set_bot_commands())
+    try:
+        if use_webhook:
+            await run_webhook()
+        else:
+            stop = stop_on_signals()
+            polling = asyncio.create_task(poll_for_workers(pool, stop))
+            await asyncio.wait([polling, asyncio.create_task(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+            polling.cancel()
+    except Exception as e:
+        log_error("Error running supervisor: %s", e)
+    finally:
+        commands.cancel()
+        await state_backend.close()
+        await runner.cleanup()
+        await pool.stop()
+        await bot.session.close()
+
+async def handle_worker_update(raw: bytes):
+    try:
+        await dp.feed_raw_update(bot, json.loads(raw))
+    except Exception as e:
+        log_error("Failed to handle routed update: %s", e)
+
+async def serve_worker_pipe():
+    """Worker side: handle updates from stdin until the supervisor closes it"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    handling = set()
+    await dp.emit_startup(bot=bot)
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(4)
+                raw = await reader.readexactly(int.from_bytes(header, "big"))
+            except asyncio.IncompleteReadError:
+                break
+            task = asyncio.create_task(handle_worker_update(raw))
+            handling.add(task)
+            task.add_done_callback(handling.discard)
+        if handling:
+            await asyncio.gather(*handling)
+    finally:
+        await dp.emit_shutdown(bot=bot)
 
-def start_dummy_server():
-    """Start HTTP server for deployment platform compatibility"""
-    port = int(os.environ.get("PORT", 8000))
-    server = HTTPServer(("0.0.0.0", port), DummyHandler)
-    print(f"🌐 HTTP server listening on port {port}")
-    server.serve_forever()
+async def sweep_idle_state():
+    """Periodically drop idle sessions, rate-limit keys and send buckets; persist file_ids"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        removed = user_search_cache.sweep()
+        if removed:
+            log_info("Swept %s idle search sessions, %s left", removed, len(user_search_cache))
+        removed = rate_limit.sweep()
+        if removed:
+            log_info("Swept %s idle rate-limit keys, %s left", removed, len(rate_limit))
+        send_scheduler.sweep()
+        await asyncio.to_thread(file_ids.save)
+        await state_backend.sweep()
 
 async def main():
     """Main function to start the bot"""
     log_info("Starting Dummy Pawn Bot...")
+    is_worker = WORKER_INDEX >= 0
+    if WORKERS > 1 and not is_worker:
+        await run_supervisor()
+        return
+    if is_worker:
+        # The supervisor decides when to stop, by closing stdin
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, signal.SIG_IGN)
+    get_serper_session()
+    file_ids.load()
+    await state_backend.open()
+    background = [asyncio.create_task(sweep_idle_state())]
+    if FILE_ID_WARMUP_CHAT_ID:
+        background.append(asyncio.create_task(warm_file_ids()))
+    use_webhook = bool(WEBHOOK_URL)
+    if is_worker:
+        runner = await start_web_server(create_web_app(False), "127.0.0.1", PORT + 1 + WORKER_INDEX)
+    else:
+        runner = await start_web_server(create_web_app(use_webhook))
     
     try:
-        # Set bot commands
-        await set_bot_commands()
-        
-        # Start polling
-        log_info("Bot is starting polling...")
-        await dp.start_polling(bot)
+        if is_worker:
+            await serve_worker_pipe()
+            return
+
+        background.append(asyncio.create_task(set_bot_commands()))
+        if use_webhook:
+            await run_webhook()
+        else:
+            await run_polling()
     except Exception as e:
-        log_error(f"Error starting bot: {e}")
+        log_error("Error starting bot: %s", e)
     finally:
+        for task in background:
+            task.cancel()
+        file_ids.save()
+        await state_backend.close()
+        await runner.cleanup()
+        await image_prober.close()
+        await close_serper_session()
         await bot.session.close()
 
 if __name__ == "__main__":
-    # Start dummy HTTP server in background thread for deployment compatibility
-    threading.Thread(target=start_dummy_server, daemon=True).start()
-    
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# dummypawn reads its configuration at import time
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("SERPER_API_KEY", "test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
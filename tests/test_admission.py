@@ -0,0 +1,51 @@
+"""Search admission: a slot covers the search, not the flood-gated reply"""
+import asyncio
+import time
+import types
+
+import dummypawn
+
+GROUP_SEND_SECONDS = 0.5
+
+class FakeMessage:
+    """A search message whose replies wait on a slow group flood gate"""
+
+    def __init__(self, chat_id: int, chat_type: str, text: str, replies: list):
+        self.chat = types.SimpleNamespace(id=chat_id, type=chat_type)
+        self.from_user = types.SimpleNamespace(id=abs(chat_id))
+        self.message_id = 1
+        self.text = text
+        self.replies = replies
+
+    async def answer(self, text, **kwargs):
+        if self.chat.type != "private":
+            await asyncio.sleep(GROUP_SEND_SECONDS)
+        self.replies.append((self.chat.id, text, time.monotonic()))
+        return types.SimpleNamespace(message_id=2)
+
+async def fake_search(mode, query, page=1, backend_checked=False):
+    await asyncio.sleep(0.01)
+    return tuple(dummypawn.SearchResult(f"{query} {i}", f"https://example.com/{i}", "", "", "") for i in range(3))
+
+def test_group_send_waiting_on_its_flood_gate_frees_the_slot(monkeypatch):
+    monkeypatch.setattr(dummypawn, "admission", dummypawn.AdmissionController(1, 10, 0.2))
+    monkeypatch.setattr(dummypawn, "user_search_cache", dummypawn.SessionStore(10, 1 << 20, 60))
+    monkeypatch.setattr(dummypawn, "state_backend", dummypawn.LocalStateBackend(
+        dummypawn.user_search_cache, dummypawn.RateLimiter("", "", "")
+    ))
+    monkeypatch.setattr(dummypawn, "search_serper", fake_search)
+
+    async def run():
+        replies = []
+        group = dummypawn.send_result(FakeMessage(-100, "supergroup", "/web raid", replies), "web")
+        private = dummypawn.send_result(FakeMessage(7, "private", "/web cats", replies), "web")
+        group_task = asyncio.create_task(group)
+        await asyncio.sleep(0.05)
+        await private
+        await group_task
+        return replies
+
+    replies = asyncio.run(run())
+    assert [chat_id for chat_id, _, _ in replies] == [7, -100]
+    assert "cats 0" in replies[0][1]
+    assert dummypawn.ERROR_MESSAGES["busy"] not in {text for _, text, _ in replies}
@@ -0,0 +1,50 @@
+"""Log records are formatted on the listener thread, tracebacks included"""
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+import dummypawn
+
+class CapturingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.threads.add(threading.get_ident())
+        self.lines.append(self.format(record))
+
+def log_through_queue(log):
+    capture = CapturingHandler()
+    capture.setFormatter(dummypawn.JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, capture)
+    logger = logging.getLogger("dummypawn.test")
+    logger.propagate = False
+    logger.handlers[:] = [dummypawn.RawQueueHandler(log_queue)]
+    listener.start()
+    try:
+        log(logger)
+    finally:
+        listener.stop()
+    return capture
+
+def test_exception_traceback_reaches_the_json_exc_field():
+    def log(logger):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("Search failed for %s", "cats")
+
+    capture = log_through_queue(log)
+    entry = json.loads(capture.lines[0])
+    assert entry["msg"] == "Search failed for cats"
+    assert "ValueError: boom" in entry["exc"]
+
+def test_records_are_formatted_off_the_calling_thread():
+    capture = log_through_queue(lambda logger: logger.warning("Slow handler %s", "cmd_web"))
+    assert json.loads(capture.lines[0])["msg"] == "Slow handler cmd_web"
+    assert threading.get_ident() not in capture.threads
@@ -0,0 +1,54 @@
+"""Next/Previous edits: rapid taps coalesce, and a failed edit is undone"""
+import asyncio
+
+import dummypawn
+
+KEY = (5, 5)
+
+class FakeMessage:
+    """A text result message that records edits, or refuses them"""
+
+    def __init__(self, fail: bool = False):
+        self.message_id = 99
+        self.photo = None
+        self.fail = fail
+        self.edits = []
+        self.replies = []
+
+    async def edit_text(self, text, reply_markup=None):
+        if self.fail:
+            raise RuntimeError("Bad Request: message to edit not found")
+        self.edits.append(text)
+
+    async def answer(self, text, **kwargs):
+        self.replies.append(text)
+
+def shown_session() -> dummypawn.SearchSession:
+    results = tuple(
+        dummypawn.SearchResult(f"title {i}", f"https://example.com/{i}", "", "", "") for i in range(10)
+    )
+    session = dummypawn.SearchSession("web", "cats", results, 0, "t", *KEY)
+    session.shown = 0
+    return session
+
+async def tap_three_times(session, message):
+    coalescer = dummypawn.PageEditCoalescer(0.02)
+    for _ in range(3):
+        session.index += 1
+        coalescer.schedule(KEY, session, message)
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.1)
+
+def test_rapid_taps_become_one_edit():
+    session, message = shown_session(), FakeMessage()
+    asyncio.run(tap_three_times(session, message))
+    assert len(message.edits) == 1
+    assert "title 3" in message.edits[0]
+    assert session.shown == session.index == 3
+    assert message.replies == []
+
+def test_failed_edit_returns_to_the_shown_result():
+    session, message = shown_session(), FakeMessage(fail=True)
+    asyncio.run(tap_three_times(session, message))
+    assert session.index == session.shown == 0
+    assert message.replies == [dummypawn.ERROR_MESSAGES["edit_failed"]]
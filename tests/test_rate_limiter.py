@@ -0,0 +1,82 @@
+"""Search rate limits: inline queries have their own budget, refunds"""
+import asyncio
+import types
+
+import dummypawn
+
+def test_inline_queries_do_not_use_up_chat_searches():
+    limiter = dummypawn.RateLimiter("3/60", "", "", "5/60")
+    assert all(limiter.hit(1, 1, inline=True) for _ in range(5))
+    assert not limiter.hit(1, 1, inline=True)
+    assert all(limiter.hit(1, 1) for _ in range(3))
+    assert not limiter.hit(1, 1)
+
+def test_chat_searches_do_not_use_up_inline_queries():
+    limiter = dummypawn.RateLimiter("1/60", "", "", "2/60")
+    assert limiter.hit(1, 1)
+    assert not limiter.hit(1, 1)
+    assert limiter.hit(1, 1, inline=True)
+    assert limiter.hit(1, 1, inline=True)
+
+def test_global_limit_covers_both():
+    limiter = dummypawn.RateLimiter("10/60", "", "3/60", "10/60")
+    assert limiter.hit(1, 1)
+    assert limiter.hit(2, 2, inline=True)
+    assert limiter.hit(3, 3)
+    assert not limiter.hit(4, 4, inline=True)
+    assert not limiter.hit(5, 5)
+
+def test_shared_state_keys_inline_queries_separately():
+    limiter = dummypawn.RateLimiter("3/60", "10/60", "100/60", "20/60")
+    backend = dummypawn.RedisStateBackend(
+        dummypawn.SessionStore(10, 1 << 20, 60), limiter, "redis://127.0.0.1:1", "p:", 1.0
+    )
+    command = backend._rate_limit_command(7, -100, False)
+    assert command[2:6] == (3, "p:rate:user:7", "p:rate:chat:-100", "p:rate:global:")
+    command = backend._rate_limit_command(7, 7, True)
+    assert command[2:5] == (2, "p:rate:global:", "p:rate:inline:7")
+    assert command[-4:] == (100, 60000, 20, 60000)
+
+def test_refund_gives_back_the_search_in_every_scope():
+    limiter = dummypawn.RateLimiter("2/60", "2/60", "3/60", "")
+    assert limiter.hit(1, 10)
+    assert limiter.hit(1, 10)
+    assert not limiter.hit(1, 10)
+    limiter.refund(1, 10)
+    assert limiter.hit(1, 10)
+    # Global saw three allowed searches and one refund
+    assert limiter.hit(2, 20)
+    assert not limiter.hit(3, 30)
+
+def test_refund_of_an_inline_query_leaves_chat_searches_alone():
+    limiter = dummypawn.RateLimiter("1/60", "", "", "1/60")
+    assert limiter.hit(1, 1)
+    assert limiter.hit(1, 1, inline=True)
+    limiter.refund(1, 1, inline=True)
+    assert limiter.hit(1, 1, inline=True)
+    assert not limiter.hit(1, 1)
+    limiter.refund(5, 5)
+    assert len(limiter) == 2
+
+class FakeInlineQuery:
+    def __init__(self, user_id: int, text: str):
+        self.from_user = types.SimpleNamespace(id=user_id)
+        self.query = text
+        self.offset = ""
+        self.answers = []
+
+    async def answer(self, results, **kwargs):
+        self.answers.append(kwargs["button"].text)
+
+def test_search_turned_away_by_admission_is_refunded(monkeypatch):
+    limiter = dummypawn.RateLimiter("3/60", "", "", "1/60")
+    monkeypatch.setattr(dummypawn, "state_backend", dummypawn.LocalStateBackend(dummypawn.user_search_cache, limiter))
+    # Every slot taken and no room to queue
+    saturated = dummypawn.AdmissionController(1, 0, 1.0)
+    saturated.active = 1
+    monkeypatch.setattr(dummypawn, "admission", saturated)
+
+    inline = FakeInlineQuery(1, "refund me web")
+    asyncio.run(dummypawn.handle_inline_query(inline))
+    assert inline.answers == [dummypawn.INLINE_MESSAGES["busy"]]
+    assert limiter.hit(1, 1, inline=True)
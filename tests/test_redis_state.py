@@ -0,0 +1,170 @@
+"""Shared state over Redis: concurrent taps never lose a step, outages keep limits"""
+import asyncio
+import json
+
+import pytest
+
+import dummypawn
+
+KEY = (42, 42)
+
+class FakeRedis:
+    """Just enough of a RESP2 server for the state backend, with slow replies"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.fail_eval = False
+        self.data = {}
+        self.server = None
+        self.handlers = set()
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        return "redis://127.0.0.1:%d/0" % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        # Clients have closed by now, so each handler finishes on EOF
+        await asyncio.gather(*self.handlers)
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    async def read_command(reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    def reply(self, args) -> bytes:
+        name = args[0].upper()
+        if name == b"GET":
+            value = self.data.get(args[1])
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if name == b"SET":
+            self.data[args[1]] = args[2]
+            return b"+OK\r\n"
+        if name == b"DEL":
+            return b":%d\r\n" % (self.data.pop(args[1], None) is not None)
+        if name == b"EVAL":
+            if self.fail_eval:
+                return b"-NOSCRIPT scripting is disabled\r\n"
+            return b":1\r\n"
+        return b"+PONG\r\n"
+
+    async def serve(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        while (args := await self.read_command(reader)) is not None:
+            # Replies lag, so reads and writes from concurrent taps interleave
+            await asyncio.sleep(self.delay)
+            writer.write(self.reply(args))
+            await writer.drain()
+        writer.close()
+
+def results(count: int) -> tuple:
+    return tuple(
+        dummypawn.SearchResult(f"t{i}", f"https://example.com/{i}", "", "", "")
+        for i in range(count)
+    )
+
+@pytest.fixture
+def backend(monkeypatch):
+    fake = FakeRedis(delay=0.005)
+
+    async def make(user_limit: str = "0"):
+        url = await fake.start()
+        sessions = dummypawn.SessionStore(100, 1 << 20, 3600)
+        limiter = dummypawn.RateLimiter(user_limit, "0", "0")
+        state = dummypawn.RedisStateBackend(sessions, limiter, url, "test:", 2.0)
+        monkeypatch.setattr(dummypawn, "state_backend", state)
+        return state
+
+    yield fake, make
+
+async def tap(session_key):
+    """The Next path of handle_page_callback, without the Telegram edit"""
+    session = await dummypawn.get_session(session_key)
+    if session.lock is None:
+        session.lock = asyncio.Lock()
+    async with session.lock:
+        session.index = await dummypawn.step_index(session, session.index, 1)
+    dummypawn.persist_session(session)
+
+def test_concurrent_taps_are_not_undone_by_stale_reads(backend):
+    fake, make = backend
+
+    async def run():
+        state = await make()
+        session = dummypawn.SearchSession("web", "cats", results(10), 0, "t", *KEY)
+        state.sessions[KEY] = session
+        dummypawn.persist_session(session)
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*(tap(KEY) for _ in range(5)))
+        await state.close()
+        await fake.stop()
+        return session, json.loads(fake.data[b"test:session:42:42"])
+
+    session, stored = asyncio.run(run())
+    assert session.index == 5
+    assert stored["index"] == 5
+    assert stored["version"] == session.version
+
+def test_newer_remote_position_is_adopted(backend):
+    fake, make = backend
+
+    async def run():
+        state = await make()
+        session = dummypawn.SearchSession("web", "cats", results(10), 0, "t", *KEY)
+        state.sessions[KEY] = session
+        dummypawn.persist_session(session)
+        await asyncio.sleep(0.05)
+        # Another worker stepped twice since our last write
+        moved = dict(session.to_dict(), index=2, version=session.version + 2)
+        fake.data[b"test:session:42:42"] = json.dumps(moved).encode()
+        loaded = await dummypawn.get_session(KEY)
+        await state.close()
+        await fake.stop()
+        return session, loaded
+
+    session, loaded = asyncio.run(run())
+    assert loaded is session
+    assert session.index == 2
+
+def test_failing_rate_script_falls_back_to_the_local_limit(backend):
+    fake, make = backend
+    fake.fail_eval = True
+
+    async def run():
+        state = await make(user_limit="3/60")
+        allowed = [(await state.begin_search(1, 1, ("web", "cats", 1)))[0] for _ in range(10)]
+        await state.close()
+        await fake.stop()
+        return allowed
+
+    assert asyncio.run(run()) == [True] * 3 + [False] * 7
+
+def test_unreachable_server_falls_back_to_the_local_limit():
+    async def run():
+        limiter = dummypawn.RateLimiter("3/60", "", "")
+        # Nothing listens on port 1
+        state = dummypawn.RedisStateBackend(
+            dummypawn.SessionStore(10, 1 << 20, 60), limiter, "redis://127.0.0.1:1", "test:", 1.0
+        )
+        allowed = [(await state.begin_search(1, 1, ("web", "cats", 1)))[0] for _ in range(10)]
+        await state.close()
+        return allowed, len(limiter)
+
+    allowed, tracked = asyncio.run(run())
+    assert allowed == [True] * 3 + [False] * 7
+    assert tracked == 1
+
+def test_incomplete_backend_fails_when_created():
+    class NoWrites(dummypawn.StateBackend):
+        async def begin_search(self, user_id, chat_id, query_key, inline=False):
+            return True, None
+
+    with pytest.raises(TypeError):
+        NoWrites(dummypawn.SessionStore(10, 1 << 20, 60), dummypawn.RateLimiter("", "", ""))
@@ -0,0 +1,86 @@
+"""Outbound sends: callback edits overtake queued new messages per chat"""
+import asyncio
+import time
+
+from aiogram.methods import EditMessageMedia, SendMediaGroup, SendMessage, SendPhoto
+from aiogram.types import InputMediaPhoto
+
+import dummypawn
+
+GROUP = -100123
+
+def scheduler(rate: float) -> dummypawn.SendScheduler:
+    # The global limit is generous, so only the per-chat gate is contended
+    return dummypawn.SendScheduler(
+        global_rate=1000, private_rate=rate, group_rate=rate,
+        chat_burst=1, queue_limit=100, max_retries=0
+    )
+
+async def send_all(sched, methods, gap: float = 0.01):
+    """Issue methods a few ms apart; returns {api method: seconds until sent}"""
+    started = time.monotonic()
+    sent = {}
+
+    async def make_request(bot, method):
+        sent.setdefault(method.__api_method__, time.monotonic() - started)
+
+    tasks = []
+    for method in methods:
+        tasks.append(asyncio.create_task(sched(make_request, None, method)))
+        await asyncio.sleep(gap)
+    await asyncio.gather(*tasks)
+    return sent
+
+def test_edit_overtakes_queued_send_in_a_group():
+    async def run():
+        return await send_all(scheduler(rate=5), [
+            SendMessage(chat_id=GROUP, text="takes the burst token"),
+            SendPhoto(chat_id=GROUP, photo="https://example.com/new.jpg"),
+            EditMessageMedia(chat_id=GROUP, message_id=1, media=InputMediaPhoto(media="https://example.com/e.jpg")),
+        ])
+
+    sent = asyncio.run(run())
+    # One token every 0.2s: the edit takes the first, the queued photo the next
+    assert sent["sendMessage"] < 0.05
+    assert 0.15 < sent["editMessageMedia"] < 0.3
+    assert sent["sendPhoto"] > sent["editMessageMedia"] + 0.15
+
+def test_same_priority_keeps_arrival_order():
+    async def run():
+        started = time.monotonic()
+        order = []
+
+        async def make_request(bot, method):
+            order.append(method.text)
+
+        sched = scheduler(rate=50)
+        tasks = [
+            asyncio.create_task(sched(make_request, None, SendMessage(chat_id=GROUP, text=str(i))))
+            for i in range(5)
+        ]
+        await asyncio.gather(*tasks)
+        return order, time.monotonic() - started
+
+    order, elapsed = asyncio.run(run())
+    assert order == ["0", "1", "2", "3", "4"]
+    assert elapsed > 0.07  # four waits of 20ms: the chat rate still holds
+
+def test_album_costs_a_token_per_item():
+    album = SendMediaGroup(chat_id=GROUP, media=[
+        InputMediaPhoto(media=f"https://example.com/{i}.jpg") for i in range(5)
+    ])
+
+    async def run():
+        return await send_all(scheduler(rate=10), [album, SendMessage(chat_id=GROUP, text="after the album")])
+
+    sent = asyncio.run(run())
+    # The album goes at once on credit; the next message waits out its 5 tokens
+    assert sent["sendMediaGroup"] < 0.05
+    assert 0.45 < sent["sendMessage"] < 0.65
+
+def test_idle_chat_gates_are_swept():
+    sched = scheduler(rate=1000)
+    asyncio.run(send_all(sched, [SendMessage(chat_id=GROUP, text="x")]))
+    time.sleep(0.01)
+    assert sched.sweep() == 1
+    assert not sched.chat_gates
@@ -0,0 +1,188 @@
+"""Serper client against a local fault-injecting fake Serper server"""
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+import dummypawn
+
+PAYLOAD = {"organic": [{"title": "t", "link": "https://example.com", "snippet": "s"}]}
+
+class FakeSerper:
+    """Serves a script of responses, one step per request, then 200s
+
+    Steps: "ok", an HTTP status (int), (status, headers), ("delay", seconds)
+    for a slow success, or "hang" for a reply slower than the read timeout.
+    """
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+        self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        step = self.script.pop(0) if self.script else "ok"
+        if step == "hang":
+            await asyncio.sleep(0.5)
+        elif isinstance(step, int):
+            return web.Response(status=step)
+        elif step[0] == "delay":
+            await asyncio.sleep(step[1])
+        elif step != "ok":
+            return web.Response(status=step[0], headers=step[1])
+        return web.json_response(PAYLOAD)
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post("/search", self.handle)
+        self._runner = web.AppRunner(app, shutdown_timeout=0.1)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        dummypawn.SERPER_URLS["web"] = f"http://127.0.0.1:{port}/search"
+        return self
+
+    async def __aexit__(self, *exc):
+        await dummypawn.close_serper_session()
+        await self._runner.cleanup()
+
+@pytest.fixture(autouse=True)
+def fast_serper(monkeypatch):
+    """Short timeouts and backoff, a fresh breaker and no hedging by default"""
+    monkeypatch.setitem(dummypawn.SERPER_URLS, "web", dummypawn.SERPER_URLS["web"])
+    monkeypatch.setattr(dummypawn, "SERPER_MAX_RETRIES", 2)
+    monkeypatch.setattr(dummypawn, "SERPER_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(dummypawn, "SERPER_BACKOFF_MAX", 0.05)
+    monkeypatch.setattr(dummypawn, "SERPER_READ_TIMEOUT", 0.2)
+    monkeypatch.setattr(dummypawn, "SERPER_TOTAL_TIMEOUT", 1)
+    monkeypatch.setattr(dummypawn, "SERPER_HEDGE", False)
+    monkeypatch.setattr(dummypawn, "serper_breaker", dummypawn.CircuitBreaker(3, 0.2))
+    monkeypatch.setattr(dummypawn, "serper_latency", dummypawn.LatencyWindow())
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_transient_5xx_is_retried_until_success():
+    async def scenario():
+        async with FakeSerper(503, 502) as serper:
+            return await dummypawn.query_serper("web", "cats"), serper.calls
+
+    data, calls = run(scenario())
+    assert data == PAYLOAD
+    assert calls == 3
+    assert dummypawn.serper_breaker.state == "closed"
+
+def test_timeout_is_retried():
+    async def scenario():
+        async with FakeSerper("hang") as serper:
+            return await dummypawn.query_serper("web", "cats"), serper.calls
+
+    data, calls = run(scenario())
+    assert data == PAYLOAD
+    assert calls == 2
+
+def test_4xx_is_not_retried_and_does_not_trip_the_breaker():
+    async def scenario():
+        async with FakeSerper(403) as serper:
+            return await dummypawn.query_serper("web", "cats"), serper.calls
+
+    data, calls = run(scenario())
+    assert data == {}
+    assert calls == 1
+    assert dummypawn.serper_breaker.failures == 0
+
+def test_breaker_opens_and_fails_fast():
+    async def scenario():
+        async with FakeSerper(503, 503, 503, 503) as serper:
+            first = await dummypawn.query_serper("web", "cats")
+            calls_after_first = serper.calls
+            second = await dummypawn.query_serper("web", "dogs")
+            return first, second, calls_after_first, serper.calls
+
+    first, second, calls_after_first, calls = run(scenario())
+    assert first == {} and second == {}
+    assert calls_after_first == 3
+    # Open circuit: the second search never reached the server
+    assert calls == 3
+    assert dummypawn.serper_breaker.state == "open"
+
+def test_half_open_trial_success_closes_the_circuit():
+    async def scenario():
+        async with FakeSerper(503, 503, 503) as serper:
+            await dummypawn.query_serper("web", "cats")
+            assert dummypawn.serper_breaker.state == "open"
+            await asyncio.sleep(0.25)
+            assert dummypawn.serper_breaker.state == "half_open"
+            data = await dummypawn.query_serper("web", "dogs")
+            return data, serper.calls
+
+    data, calls = run(scenario())
+    assert data == PAYLOAD
+    assert calls == 4
+    assert dummypawn.serper_breaker.state == "closed"
+
+def test_half_open_trial_failure_reopens_without_retrying():
+    async def scenario():
+        async with FakeSerper(503, 503, 503, 503) as serper:
+            await dummypawn.query_serper("web", "cats")
+            await asyncio.sleep(0.25)
+            data = await dummypawn.query_serper("web", "dogs")
+            return data, serper.calls
+
+    data, calls = run(scenario())
+    assert data == {}
+    # Exactly one trial call, then the re-opened circuit stops the retries
+    assert calls == 4
+    assert dummypawn.serper_breaker.state == "open"
+
+def test_hedged_request_beats_a_slow_first_call(monkeypatch):
+    monkeypatch.setattr(dummypawn, "SERPER_HEDGE", True)
+    monkeypatch.setattr(dummypawn, "SERPER_HEDGE_MIN_DELAY", 0.05)
+    for _ in range(dummypawn.SERPER_HEDGE_MIN_SAMPLES):
+        dummypawn.serper_latency.add(0.01)
+    hedges_before = sum(dummypawn.SERPER_HEDGES._values.values())
+
+    async def scenario():
+        async with FakeSerper(("delay", 0.4)) as serper:
+            started = time.monotonic()
+            data = await dummypawn.query_serper("web", "cats")
+            return data, time.monotonic() - started, serper.calls
+
+    data, elapsed, calls = run(scenario())
+    assert data == PAYLOAD
+    assert calls == 2
+    assert elapsed < 0.3
+    assert sum(dummypawn.SERPER_HEDGES._values.values()) == hedges_before + 1
+
+def test_retry_after_within_budget_is_honoured(monkeypatch):
+    monkeypatch.setattr(dummypawn, "SERPER_BACKOFF_MAX", 2)
+
+    async def scenario():
+        async with FakeSerper((429, {"Retry-After": "1"})) as serper:
+            started = time.monotonic()
+            data = await dummypawn.query_serper("web", "cats")
+            return data, time.monotonic() - started, serper.calls
+
+    data, elapsed, calls = run(scenario())
+    assert data == PAYLOAD
+    assert calls == 2
+    assert elapsed >= 1.0
+
+def test_retry_after_beyond_budget_fails_fast():
+    async def scenario():
+        async with FakeSerper((429, {"Retry-After": "60"})) as serper:
+            started = time.monotonic()
+            data = await dummypawn.query_serper("web", "cats")
+            return data, time.monotonic() - started, serper.calls
+
+    data, elapsed, calls = run(scenario())
+    assert data == {}
+    assert calls == 1
+    assert elapsed < 0.5
+
+def test_backoff_delay_never_undercuts_retry_after():
+    assert dummypawn.backoff_delay(0, 60) == 60
+    assert 0 <= dummypawn.backoff_delay(5) <= dummypawn.SERPER_BACKOFF_MAX
@@ -0,0 +1,85 @@
+"""Memory held per cached search session, measured with tracemalloc"""
+import json
+import tracemalloc
+
+import dummypawn
+
+SESSIONS = 200
+# Budget per session for a full page of web results
+MAX_SESSION_BYTES = 10 * 1024
+
+def serper_web_response(n: int) -> bytes:
+    """A realistic 10-result /search body, distinct per n so nothing is shared"""
+    return json.dumps({
+        "searchParameters": {"q": f"query {n}", "type": "search", "engine": "google", "num": 10, "page": 1},
+        "knowledgeGraph": {
+            "title": f"Entity {n}", "type": "Organization", "website": f"https://entity{n}.example.com",
+            "imageUrl": f"https://img.example.com/{n}.png",
+            "description": f"Entity {n} is an organization described at some length. " * 4,
+            "attributes": {f"Attribute {i}": f"value {n}-{i}" for i in range(6)},
+        },
+        "organic": [
+            {
+                "title": f"Result {n}-{i}: a typical page title of moderate length",
+                "link": f"https://www.example{i}.com/articles/{n}/some-long-slug-for-the-page",
+                "snippet": f"Snippet {n}-{i}. " + "A couple of sentences that summarise the page content. " * 3,
+                "date": "Jan 1, 2026",
+                "position": i + 1,
+                "sitelinks": [{"title": f"Link {j}", "link": f"https://www.example{i}.com/{n}/{j}"} for j in range(4)],
+                "attributes": {"Missing": f"terms {n}-{i}"},
+            }
+            for i in range(10)
+        ],
+        "peopleAlsoAsk": [
+            {"question": f"Question {n}-{i}?", "snippet": "An answer paragraph. " * 5, "title": "Source",
+             "link": f"https://answers.example.com/{n}/{i}"}
+            for i in range(4)
+        ],
+        "relatedSearches": [{"query": f"related {n} {i}"} for i in range(8)],
+        "credits": 1,
+    }).encode()
+
+def measure(build) -> float:
+    """Bytes still allocated per session once the raw responses are gone"""
+    bodies = [serper_web_response(n) for n in range(SESSIONS)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = [build(n, json.loads(body)) for n, body in enumerate(bodies)]
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert len(sessions) == SESSIONS
+    return held / SESSIONS
+
+def projected_session(n: int, data: dict):
+    results = dummypawn.project_results("web", data)
+    return dummypawn.SearchSession("web", f"query {n}", results, 0, "120000", n, n)
+
+def test_projected_session_stays_under_budget():
+    per_session = measure(projected_session)
+    assert per_session < MAX_SESSION_BYTES, f"{per_session:.0f} bytes per session"
+
+def test_projection_is_much_smaller_than_raw_json():
+    raw = measure(lambda n, data: data)
+    projected = measure(projected_session)
+    assert projected * 3 < raw, f"projected {projected:.0f} B vs raw {raw:.0f} B per session"
+
+def test_estimate_size_tracks_tracemalloc():
+    # The session store's byte budget relies on estimate_size() being close
+    estimated = dummypawn.estimate_size(projected_session(0, json.loads(serper_web_response(0))))
+    measured = measure(projected_session)
+    assert measured / 2 < estimated < measured * 2, f"estimated {estimated} B, measured {measured:.0f} B"
+
+def test_paging_keeps_the_store_budget_accurate(monkeypatch):
+    # Renders memoized while paging must be counted, and must not pile up
+    store = dummypawn.SessionStore(10, 1 << 30, 3600)
+    monkeypatch.setattr(dummypawn, "user_search_cache", store)
+    results = sum((dummypawn.project_results("web", json.loads(serper_web_response(n))) for n in range(5)), ())
+    session = dummypawn.SearchSession("web", "query", results, 0, "120000", 1, 1)
+    store[(1, 1)] = session
+    for index in range(len(results)):
+        dummypawn.render_result(session, index)
+    assert len(session.rendered) <= 2 * dummypawn.RENDER_MEMO_RADIUS + 1
+    actual = dummypawn.estimate_size(session)
+    assert abs(store.total_bytes - actual) < actual * 0.05, f"store {store.total_bytes} B, actual {actual} B"
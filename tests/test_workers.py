@@ -0,0 +1,42 @@
+"""Supervisor side of worker mode: getUpdates replies are split, not re-encoded"""
+import json
+
+import pytest
+
+import dummypawn
+
+def get_updates_reply(updates: list) -> bytes:
+    # Telegram's layout: compact, non-ASCII text left unescaped
+    return json.dumps({"ok": True, "result": updates}, ensure_ascii=False, separators=(",", ":")).encode()
+
+def message_update(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 1700000000, "text": text,
+            "chat": {"id": -100 - update_id, "type": "supergroup"},
+            "from": {"id": 7, "is_bot": False, "first_name": "Zoë"}
+        }
+    }
+
+def test_updates_are_forwarded_as_telegrams_bytes():
+    updates = [message_update(1, "dummy cats image"), message_update(2, "ёжик \"в\" тумане\n")]
+    body = get_updates_reply(updates)
+    split = dummypawn.split_updates(body)
+    assert [update for update, _ in split] == updates
+    for _, raw in split:
+        assert raw in body
+        assert json.loads(raw) in updates
+    assert dummypawn.update_shard_key(split[1][0]) == -102
+
+def test_empty_batch():
+    assert dummypawn.split_updates(get_updates_reply([])) == []
+
+@pytest.mark.parametrize("body", [
+    b'{"ok":false,"error_code":409,"description":"Conflict"}',
+    b'{"ok":true,"result":[{"update_id":1',
+    b"<html>Bad Gateway</html>",
+])
+def test_anything_else_is_rejected(body):
+    with pytest.raises(ValueError):
+        dummypawn.split_updates(body)